@@ -6,7 +6,7 @@ load_dotenv()  # Загружаем переменные окружения из
 import os
 import uuid
 import json
-import io
+import tempfile
 import time
 import traceback # Для вывода ошибок
 import atexit
@@ -51,7 +51,13 @@ import location_finder
 import workflow_db_manager
 import epub_parser
 import workflow_processor
+import provider_rate_limiter
+import model_circuit_breaker
+import workflow_translation_module
 import workflow_cache_manager
+import glossary_index
+import token_estimator
+import comic_image_store
 import html
 import video_analyzer
 import video_chat_handler
@@ -266,6 +272,8 @@ except Exception as e:
 # Регистрируем функцию для остановки планировщика при выходе
 atexit.register(lambda: scheduler.shutdown())
 print("Зарегистрирована остановка планировщика при выходе.")
+# Несохраненная калибровка оценки токенов записывается в БД при выходе
+atexit.register(token_estimator.token_estimator.flush)
 # --- КОНЕЦ ИЗМЕНЕНИЯ APScheduler ---
 
 # --- Вспомогательные функции ---
@@ -825,10 +833,18 @@ def download_epub(book_id):
     target_language = book_info.get('target_language', session.get('target_language', 'russian'))
     update_overall_book_status(book_id); book_info = get_book(book_id)
     if book_info.get('status') not in ["complete", "complete_with_errors"]: return f"Перевод не завершен (Статус: {book_info.get('status')}).", 409
-    epub_bytes = create_translated_epub(book_info, target_language) # book_info уже содержит 'sections'
-    if epub_bytes is None: return "Server error generating EPUB", 500
+    # Пишем EPUB во временный файл и отдаем его с диска (без чтения всей книги в память)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".epub") as tf:
+        t_path = tf.name
+    if create_translated_epub(book_info, target_language, output_path=t_path) is None: # book_info уже содержит 'sections'
+        try: os.remove(t_path)
+        except OSError: pass
+        return "Server error generating EPUB", 500
     base_name = os.path.splitext(book_info.get('filename', 'tr_book'))[0]; out_fn = f"{base_name}_{target_language}_translated.epub"
-    return send_file(io.BytesIO(epub_bytes), mimetype='application/epub+zip', as_attachment=True, download_name=out_fn)
+    response = send_file(t_path, mimetype='application/epub+zip', as_attachment=True, download_name=out_fn)
+    # Файл удаляется после отправки ответа
+    response.call_on_close(lambda: os.path.exists(t_path) and os.remove(t_path))
+    return response
 
 def get_bbc_news():
     """Получает заголовки новостей BBC с NewsAPI."""
@@ -1073,6 +1089,9 @@ def workflow_upload_file():
                        sec_created_count += 1
              print(f"  Создано {sec_created_count} записей о секциях в Workflow DB.")
 
+             # Один раз разбираем EPUB и сохраняем текст секций (этапы читают его по id)
+             workflow_processor.build_section_source_index(book_id)
+
              # --- Запускаем рабочий процесс для книги через очередь ---
              workflow_processor.workflow_queue_manager.add_book_to_queue(book_id, app, admin=admin)
              print(f"  Книга ID {book_id} поставлена в очередь обработки.")
@@ -1225,8 +1244,13 @@ def user_upload_file():
                        sec_created_count += 1
              print(f"  Создано {sec_created_count} записей о секциях в Workflow DB.")
 
-             # Запускаем рабочий процесс через очередь
-             workflow_processor.workflow_queue_manager.add_book_to_queue(book_id, app, admin=admin)
+             # Один раз разбираем EPUB и сохраняем текст секций (этапы читают его по id)
+             workflow_processor.build_section_source_index(book_id)
+
+             # Запускаем рабочий процесс через очередь (пользовательские книги — обычный приоритет)
+             workflow_processor.workflow_queue_manager.add_book_to_queue(
+                 book_id, app, admin=admin, priority=workflow_processor.QUEUE_PRIORITY_USER
+             )
              print(f"  Книга ID {book_id} поставлена в очередь обработки.")
 
              # Создаем сессию пользователя
@@ -1354,9 +1378,8 @@ def workflow_index():
             q_size = 0
             active_book_names = []
             try:
-                # В Python ThreadPoolExecutor использует _work_queue (Queue)
-                if hasattr(workflow_processor.workflow_queue_manager.executor, '_work_queue'):
-                    q_size = workflow_processor.workflow_queue_manager.executor._work_queue.qsize()
+                queue_snapshot = workflow_processor.workflow_queue_manager.get_queue_snapshot()
+                q_size = len(queue_snapshot['queued'])
                 
                 # Получаем названия книг для активных задач
                 for b_id in workflow_processor.workflow_queue_manager.processing_books:
@@ -1498,13 +1521,15 @@ def workflow_api_reset_comic(book_id):
 @app.route('/workflow/api/book/<book_id>/interrupt_comic', methods=['POST'])
 def workflow_api_interrupt_comic(book_id):
     """
-    API endpoint to interrupt comic generation (status only).
+    API endpoint to interrupt comic generation (status + in-flight image requests of this process).
     """
     if request.args.get('admin') != 'true' and request.args.get('user') != 'admin' and session.get('admin_mode') != True:
         return jsonify({'status': 'error', 'message': 'Access denied'}), 403
         
     import workflow_db_manager
+    import comic_generator
     if workflow_db_manager.interrupt_book_comic_workflow(book_id):
+        comic_generator.cancel_comic_generation(book_id)
         return jsonify({'status': 'success', 'message': 'Comic interrupted'})
     else:
         return jsonify({'status': 'error', 'message': 'Failed to interrupt comic'}), 500
@@ -1520,24 +1545,14 @@ def workflow_book_comic_view(book_id):
         return "Book not found", 404
     
     sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
-    # Теперь картинки в БД, поэтому проверяем наличие через БД
+    # Метаданные всех кадров книги одним запросом (сами файлы — в comic_image_store)
+    comic_images_meta = workflow_db_manager.get_comic_images_meta_workflow(book_id)
     comic_sections = []
     for section in sections:
-        # Проверяем наличие изображения в БД БЕЗ загрузки блоба
-        image_ts = workflow_db_manager.check_comic_image_exists(section['section_id'])
-        if image_ts:
-            # Превращаем timestamp в строку для URL
-            from datetime import datetime
-            if isinstance(image_ts, str):
-                 try:
-                     # Пытаемся распарсить строку из БД (обычно "2024-...")
-                     ts_obj = datetime.strptime(image_ts, '%Y-%m-%d %H:%M:%S')
-                     image_ver = int(ts_obj.timestamp())
-                 except:
-                     image_ver = image_ts # fallback
-            else:
-                image_ver = int(image_ts)
-            
+        image_meta = comic_images_meta.get(section['section_id'])
+        if image_meta:
+            # Версия в URL — хэш содержимого: новый кадр получает новый URL, старый кэшируется навсегда
+            image_ver = image_meta['content_hash'][:16]
             section['comic_url'] = url_for('workflow_api_comic_image', section_id=section['section_id']) + f'?v={image_ver}'
             # Загружаем суммаризацию для оверлея
             import workflow_cache_manager
@@ -1600,30 +1615,27 @@ def workflow_api_regenerate_section_comic(section_id):
 @app.route('/workflow/api/comic_image/<int:section_id>')
 def workflow_api_comic_image(section_id):
     """
-    Эндпоинт для получения бинарных данных изображения из БД.
+    Эндпоинт для получения изображения из файлового хранилища (sendfile, ETag = хэш содержимого).
     """
     import workflow_db_manager
-    from flask import Response
-    image_data = workflow_db_manager.get_comic_image_workflow(section_id)
-    if not image_data:
+    image_info = workflow_db_manager.get_comic_image_file_workflow(section_id)
+    if not image_info or not os.path.exists(image_info['path']):
         return "Image not found", 404
 
-    # Определяем тип по сигнатуре (чтобы браузер корректно декодировал)
-    mimetype = 'application/octet-stream'
-    try:
-        if isinstance(image_data, (bytes, bytearray)) and len(image_data) >= 4:
-            if image_data[:8] == b"\x89PNG\r\n\x1a\n":
-                mimetype = 'image/png'
-            elif image_data[:3] == b"\xff\xd8\xff":
-                mimetype = 'image/jpeg'
-            elif image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
-                mimetype = 'image/webp'
-    except Exception:
-        mimetype = 'application/octet-stream'
-
-    resp = Response(image_data, mimetype=mimetype)
-    # Используем более мягкое кэширование: разрешаем кэш, но требуем проверку (ETag/Timestamp в URL решит проблему)
-    resp.headers['Cache-Control'] = 'no-cache, must-revalidate'
+    # Сильный ETag: файл адресуется по содержимому, одинаковый ETag = одинаковые байты.
+    # conditional=True отвечает 304 на совпавший If-None-Match и поддерживает Range.
+    resp = send_file(
+        image_info['path'],
+        mimetype=image_info['mime_type'],
+        conditional=True,
+        etag=image_info['content_hash']
+    )
+    if request.args.get('v') and image_info['content_hash'].startswith(request.args['v']):
+        # URL с версией = хэшем содержимого никогда не меняет ответ
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # Без версии кадр мог быть перегенерирован: кэш разрешен, но с проверкой (дешевый 304)
+        resp.headers['Cache-Control'] = 'no-cache'
     return resp
 
 @app.route('/admin/system_status')
@@ -1653,7 +1665,14 @@ def admin_system_status():
         "disk_free_gb": round(usage.free / (1024**3), 2),
         "disk_used_percent": round((usage.used / usage.total) * 100, 1),
         "db_size_mb": round(db_size / (1024**2), 2),
-        "location": data_path
+        "location": data_path,
+        "queue": workflow_processor.workflow_queue_manager.get_queue_snapshot(),
+        "rate_limiter": provider_rate_limiter.rate_limiter.snapshot(),
+        "circuit_breakers": model_circuit_breaker.circuit_breaker.snapshot(),
+        "translation_memory": workflow_translation_module.get_translation_memory_stats(),
+        "glossary_savings": glossary_index.get_glossary_savings_stats(),
+        "token_estimator": token_estimator.token_estimator.snapshot(),
+        "comic_image_store": comic_image_store.get_store_stats()
     }
     
     return jsonify(status)
@@ -2159,6 +2178,8 @@ def get_workflow_book_status(book_id):
     response_data = workflow_db_manager.get_workflow_book_status(book_id)
     if response_data is None:
         return jsonify({"error": "Book not found"}), 404
+    # Позиция в очереди: 0 — обрабатывается, N — ждет, None — не в очереди
+    response_data['queue_position'] = workflow_processor.workflow_queue_manager.get_queue_position(book_id)
     return jsonify(response_data)
 
 
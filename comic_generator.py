@@ -2,12 +2,12 @@ import os
 import json
 import traceback
 import threading
-import time
-import random
+import gc
 import requests
 import re
 import base64
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
 import google.generativeai as google_genai
 from google import genai as vertex_genai
@@ -16,6 +16,55 @@ import workflow_db_manager
 import workflow_cache_manager
 import workflow_model_config
 import workflow_translation_module
+import http_client
+import provider_rate_limiter
+
+# Сколько картинок одной книги генерируется одновременно
+COMIC_IMAGE_CONCURRENCY = max(1, int(os.getenv("COMIC_IMAGE_CONCURRENCY", "3")))
+# Одновременных запросов к одной модели картинок (общий лимит для всех книг процесса)
+COMIC_MODEL_CONCURRENCY = max(1, int(os.getenv("COMIC_MODEL_CONCURRENCY", "2")))
+# Ошибка генерации: запуск прерван пользователем
+CANCELLED_ERROR = "CANCELLED"
+
+_model_semaphores = {}
+_model_semaphores_lock = threading.Lock()
+
+def _get_model_semaphore(model_name):
+    """Семафор модели картинок (создается при первом обращении)."""
+    with _model_semaphores_lock:
+        semaphore = _model_semaphores.get(model_name)
+        if semaphore is None:
+            semaphore = _model_semaphores[model_name] = threading.BoundedSemaphore(COMIC_MODEL_CONCURRENCY)
+        return semaphore
+
+# Событие отмены текущего запуска генерации по книге. Каждый запуск получает свое событие:
+# запросы, выполнявшиеся при отмене, видят свое (установленное) событие и отбрасывают результат,
+# даже если генерация уже перезапущена.
+_cancel_events = {}
+_cancel_events_lock = threading.Lock()
+
+def _start_comic_run(book_id):
+    with _cancel_events_lock:
+        previous = _cancel_events.get(book_id)
+        if previous is not None:
+            previous.set()
+        event = _cancel_events[book_id] = threading.Event()
+        return event
+
+def _finish_comic_run(book_id, event):
+    with _cancel_events_lock:
+        if _cancel_events.get(book_id) is event:
+            del _cancel_events[book_id]
+
+def cancel_comic_generation(book_id):
+    """Прерывает текущий запуск генерации комикса книги (в этом процессе). True, если запуск был."""
+    with _cancel_events_lock:
+        event = _cancel_events.get(book_id)
+    if event is None:
+        return False
+    event.set()
+    print(f"[ComicGenerator] Генерация комикса для книги {book_id} прервана.")
+    return True
 
 class ComicGenerator:
     CENSORED_IMAGE_URL = "https://upload.wikimedia.org/wikipedia/commons/thumb/7/70/Censored_rubber_stamp.svg/960px-Censored_rubber_stamp.svg.png"
@@ -138,6 +187,7 @@ Book Summaries:
                             image_data = part.inline_data.data
                             break
             
+            provider_rate_limiter.rate_limiter.record('vertex', model_name, 200)
             if image_data:
                 return image_data, None
             
@@ -147,6 +197,8 @@ Book Summaries:
             
             return None, f"IMAGE_SAFETY" if "SAFETY" in finish_reason else f"No image: {finish_reason}"
         except Exception as e:
+            if '429' in str(e) or 'resource_exhausted' in str(e).lower():
+                provider_rate_limiter.rate_limiter.record('vertex', model_name, 429)
             return None, str(e)
 
     def _generate_with_openrouter(self, model_name, prompt_text, book_id, section_id, attempt):
@@ -168,7 +220,8 @@ Book Summaries:
 
         try:
             print(f"[ComicGenerator] [OpenRouter] Requesting image for {section_id} using {model_name}...")
-            response = requests.post(self.OPENROUTER_API_URL, headers=headers, json=data, timeout=120)
+            response = http_client.post(self.OPENROUTER_API_URL, headers=headers, json=data, timeout=120)
+            provider_rate_limiter.rate_limiter.record('openrouter', model_name, response.status_code, response.headers)
             
             if response.status_code != 200:
                 # Ограничиваем лог ошибки, чтобы не выплюнуть случайно бинарщину
@@ -196,19 +249,28 @@ Book Summaries:
                                 return None, f"Failed to decode base64: {be}"
                         else:
                             # Обычный URL
-                            img_resp = requests.get(image_url, timeout=60)
+                            img_resp = http_client.get(image_url, timeout=60)
                             if img_resp.status_code == 200:
                                 return img_resp.content, None
                             return None, f"Failed to download image from URL (Status: {img_resp.status_code})"
             
             return None, "No image found in OpenRouter response"
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            provider_rate_limiter.rate_limiter.record('openrouter', model_name, None)
+            print(f"[ComicGenerator] [OpenRouter] Exception: {e}")
+            return None, str(e)
         except Exception as e:
             print(f"[ComicGenerator] [OpenRouter] Exception: {e}")
             return None, str(e)
 
-    def generate_image(self, prompt_text, book_id, section_id, max_retries=2):
-        """Генерирует изображение, перебирая уровни fallback из конфига."""
+    def generate_image(self, prompt_text, book_id, section_id, max_retries=2, cancel_event=None):
+        """
+        Генерирует изображение, перебирая уровни fallback из конфига.
+        Темп запросов задает provider_rate_limiter (общий с текстовыми моделями провайдера),
+        параллелизм на модель — семафор модели. При установленном cancel_event возвращает (None, CANCELLED_ERROR).
+        """
         levels = ['primary', 'fallback_level1', 'fallback_level2']
+        cancel_event = cancel_event or threading.Event()
         
         for level in levels:
             model_name = workflow_model_config.get_model_for_operation('generate_comic', level)
@@ -219,15 +281,22 @@ Book Summaries:
                 if attempt > 0:
                     wait_time = 10 * attempt
                     print(f"[ComicGenerator] Retry {level} attempt {attempt} for {section_id}, waiting {wait_time}s...")
-                    time.sleep(wait_time)
+                    if cancel_event.wait(wait_time):
+                        return None, CANCELLED_ERROR
+                if cancel_event.is_set():
+                    return None, CANCELLED_ERROR
 
                 # Определяем провайдера СТРОГО
                 is_vertex = model_name.startswith('vertex/') or model_name.startswith('models/') or 'gemini' in model_name.lower()
                 
-                if is_vertex:
-                    image_data, error = self._generate_with_vertex(model_name, prompt_text, book_id, section_id, attempt)
-                else:
-                    image_data, error = self._generate_with_openrouter(model_name, prompt_text, book_id, section_id, attempt)
+                with _get_model_semaphore(model_name):
+                    provider_rate_limiter.rate_limiter.acquire('vertex' if is_vertex else 'openrouter', model_name)
+                    if cancel_event.is_set():
+                        return None, CANCELLED_ERROR
+                    if is_vertex:
+                        image_data, error = self._generate_with_vertex(model_name, prompt_text, book_id, section_id, attempt)
+                    else:
+                        image_data, error = self._generate_with_openrouter(model_name, prompt_text, book_id, section_id, attempt)
 
                 if image_data:
                     return image_data, None
@@ -305,12 +374,19 @@ Book Summaries:
                     actual_model = model_name.replace('literouter/', '')
                     
                     if api_key:
-                        resp = requests.post(
-                            api_url,
-                            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                            json={"model": actual_model, "messages": [{"role": "user", "content": full_prompt}]},
-                            timeout=120
-                        )
+                        # Темп общий с текстовыми запросами перевода к этому провайдеру
+                        provider_rate_limiter.rate_limiter.acquire(api_type, model_name)
+                        try:
+                            resp = http_client.post(
+                                api_url,
+                                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                                json={"model": actual_model, "messages": [{"role": "user", "content": full_prompt}]},
+                                timeout=120
+                            )
+                        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                            provider_rate_limiter.rate_limiter.record(api_type, model_name, None)
+                            raise
+                        provider_rate_limiter.rate_limiter.record(api_type, model_name, resp.status_code, resp.headers)
                         if resp.status_code == 200:
                             result = resp.json()["choices"][0]["message"]["content"]
 
@@ -401,63 +477,89 @@ Book Summaries:
             # Но на всякий случай убедимся, что статус 'processing' во время генерации картинок
             workflow_db_manager.update_book_comic_status_workflow(book_id, 'processing')
 
-            for section in sections:
-                section_id = section['section_id']
-                # ВАЖНО: не загружаем BLOB, иначе растит RSS и может привести к OOM
-                if workflow_db_manager.check_comic_image_exists(section_id):
-                    continue
-
-                summary = workflow_cache_manager.load_section_stage_result(book_id, section_id, 'summarize')
-                if not summary or len(summary.strip()) < 50:
-                    app_instance.logger.info(f"[ComicGenerator] Summary for section {section_id} is too short or empty. Skipping.")
-                    continue
-                
-                app_instance.logger.info(f"[ComicGenerator] Generating image for section {section_id} (Summary length: {len(summary)})...")
-                
-                prompt = None
-                image_data = None
-                error = None
-                try:
-                    for attempt in range(2):
-                        # Генерируем промпт через вспомогательный метод
-                        prompt = self._build_image_prompt(summary, visual_bible_raw, simplified=(attempt > 0))
+            # Продолжение с места остановки: секции с уже сохраненной картинкой пропускаются
+            # ВАЖНО: не загружаем BLOB, иначе растит RSS и может привести к OOM
+            pending_ids = [s['section_id'] for s in sections if not workflow_db_manager.check_comic_image_exists(s['section_id'])]
+            app_instance.logger.info(f"[ComicGenerator] Sections to generate: {len(pending_ids)} of {len(sections)} (concurrency {COMIC_IMAGE_CONCURRENCY}).")
+            if not pending_ids:
+                app_instance.logger.info(f"[ComicGenerator] Finished comic generation loop for book {book_id}")
+                return
 
-                        image_data, error = self.generate_image(prompt, book_id, section_id)
-                        
-                        if image_data:
-                            workflow_db_manager.save_comic_image_workflow(book_id, section_id, image_data)
-                            app_instance.logger.info(f"[ComicGenerator] Successfully saved comic to DB for section {section_id}")
-                            break
-                        elif error == "IMAGE_SAFETY" and attempt == 0:
-                            app_instance.logger.warning(f"[ComicGenerator] Safety filter triggered for section {section_id}. Retrying with simplified prompt.")
-                            continue
-                        else:
-                            app_instance.logger.error(f"[ComicGenerator] Permanent failure for section {section_id} (Error: {error}). Saving CENSORED placeholder.")
-                            self._save_censored_placeholder(book_id, section_id)
-                            break
-                except Exception as e:
-                    app_instance.logger.error(f"[ComicGenerator] Exception processing section {section_id}: {e}")
-                finally:
-                    # Явно освобождаем крупные объекты, чтобы не накапливать RSS на длинных задачах
-                    try:
-                        if prompt is not None:
-                            del prompt
-                        if summary is not None:
-                            del summary
-                        if image_data is not None:
-                            del image_data
-                        import gc
-                        gc.collect()
-                    except Exception:
-                        pass
-                
-                time.sleep(5 + random.randint(1, 3))
+            cancel_event = _start_comic_run(book_id)
+            executor = ThreadPoolExecutor(max_workers=min(COMIC_IMAGE_CONCURRENCY, len(pending_ids)), thread_name_prefix="comic")
+            try:
+                futures = {
+                    executor.submit(self._generate_section_image, book_id, section_id, visual_bible_raw, app_instance, cancel_event): section_id
+                    for section_id in pending_ids
+                }
+                done_count = 0
+                for future in as_completed(futures):
+                    done_count += 1
+                    result = future.result()
+                    app_instance.logger.info(f"[ComicGenerator] Section {futures[future]}: {result} ({done_count}/{len(pending_ids)})")
+                    gc.collect()
+                    # Прерывание через interrupt_comic: событие в этом процессе или статус в БД
+                    if not cancel_event.is_set() and self._comic_status(book_id) != 'processing':
+                        cancel_event.set()
+                    if cancel_event.is_set():
+                        app_instance.logger.info(f"[ComicGenerator] Comic generation for book {book_id} interrupted ({done_count}/{len(pending_ids)} done).")
+                        break
+            finally:
+                # Не ждем выполняющиеся запросы: их результат будет отброшен (событие отмены установлено)
+                executor.shutdown(wait=not cancel_event.is_set(), cancel_futures=True)
+                _finish_comic_run(book_id, cancel_event)
 
             app_instance.logger.info(f"[ComicGenerator] Finished comic generation loop for book {book_id}")
 
+    def _comic_status(self, book_id):
+        book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+        return book_info.get('comic_status') if book_info else None
+
+    def _generate_section_image(self, book_id, section_id, visual_bible_raw, app_instance, cancel_event):
+        """Генерирует и сохраняет картинку одной секции (в рабочем потоке). Возвращает итог для лога."""
+        with app_instance.app_context():
+            if cancel_event.is_set():
+                return 'cancelled'
+            # Картинка могла появиться после составления списка (параллельный запуск)
+            if workflow_db_manager.check_comic_image_exists(section_id):
+                return 'exists'
+
+            summary = workflow_cache_manager.load_section_stage_result(book_id, section_id, 'summarize')
+            if not summary or len(summary.strip()) < 50:
+                app_instance.logger.info(f"[ComicGenerator] Summary for section {section_id} is too short or empty. Skipping.")
+                return 'skipped'
+            
+            app_instance.logger.info(f"[ComicGenerator] Generating image for section {section_id} (Summary length: {len(summary)})...")
+            
+            try:
+                for attempt in range(2):
+                    # Генерируем промпт через вспомогательный метод
+                    prompt = self._build_image_prompt(summary, visual_bible_raw, simplified=(attempt > 0))
+
+                    image_data, error = self.generate_image(prompt, book_id, section_id, cancel_event=cancel_event)
+                    if cancel_event.is_set():
+                        # Генерация прервана — результат не сохраняем
+                        return 'cancelled'
+                    
+                    if image_data:
+                        workflow_db_manager.save_comic_image_workflow(book_id, section_id, image_data)
+                        app_instance.logger.info(f"[ComicGenerator] Successfully saved comic to DB for section {section_id}")
+                        return 'saved'
+                    elif error == "IMAGE_SAFETY" and attempt == 0:
+                        app_instance.logger.warning(f"[ComicGenerator] Safety filter triggered for section {section_id}. Retrying with simplified prompt.")
+                        continue
+                    else:
+                        app_instance.logger.error(f"[ComicGenerator] Permanent failure for section {section_id} (Error: {error}). Saving CENSORED placeholder.")
+                        self._save_censored_placeholder(book_id, section_id)
+                        return 'censored'
+            except Exception as e:
+                app_instance.logger.error(f"[ComicGenerator] Exception processing section {section_id}: {e}")
+                return 'error'
+            return 'failed'
+
     def _save_censored_placeholder(self, book_id, section_id):
         try:
-            resp = requests.get(self.CENSORED_IMAGE_URL, timeout=10)
+            resp = http_client.get(self.CENSORED_IMAGE_URL, timeout=10)
             if resp.status_code == 200:
                 workflow_db_manager.save_comic_image_workflow(book_id, section_id, resp.content)
         except Exception as e:
@@ -0,0 +1,157 @@
+# --- START OF FILE comic_image_store.py ---
+
+"""
+Файловое хранилище кадров комикса с адресацией по содержимому.
+
+Раньше байты картинок лежали BLOB-ами в comic_images внутри workflow.db: база разрасталась,
+VACUUM шел долго, а каждый ответ /workflow/api/comic_image читал BLOB через общее соединение.
+Теперь файл кадра называется по SHA-256 своих байтов (<dir>/<2 символа>/<hash>.<ext>),
+а в БД остаются только метаданные (hash, размер, mime, размеры в пикселях).
+
+Одинаковые картинки (например, заглушка CENSORED) хранятся одним файлом. Поэтому удалять файл
+можно только когда на хэш больше не ссылается ни одна строка comic_images — это решает
+workflow_db_manager (см. remove_unreferenced_comic_images_workflow).
+"""
+
+import os
+import struct
+import hashlib
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+from config import COMIC_IMAGES_DIR
+
+# Абсолютный путь: send_file разрешает относительные пути от app.root_path, а не от cwd
+COMIC_IMAGE_STORE_DIR = os.path.abspath(str(COMIC_IMAGES_DIR))
+
+_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp', 'application/octet-stream': '.bin'}
+# Запись и удаление файлов, а также проверка ссылок в БД перед удалением выполняются под этой
+# блокировкой: иначе файл, найденный put_image как уже существующий, мог бы удалиться до вставки строки.
+store_lock = threading.RLock()
+
+
+def _read_size(data: bytes, offset: int, fmt: str) -> Tuple[int, ...]:
+    return struct.unpack_from(fmt, data, offset)
+
+
+def detect_image_info(data: bytes) -> Tuple[str, Optional[int], Optional[int]]:
+    """(mime, width, height) по сигнатуре и заголовку; размеры None, если не удалось прочитать."""
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            width, height = _read_size(data, 16, '>II')
+            return 'image/png', width, height
+        if data[:3] == b"\xff\xd8\xff":
+            # Ищем маркер SOFn (кроме DHT/JPG/DAC), в нем высота и ширина
+            pos = 2
+            while pos + 9 < len(data):
+                if data[pos] != 0xFF:
+                    pos += 1
+                    continue
+                marker = data[pos + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    pos += 1 if marker == 0xFF else 2
+                    continue
+                length = _read_size(data, pos + 2, '>H')[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = _read_size(data, pos + 5, '>HH')
+                    return 'image/jpeg', width, height
+                pos += 2 + length
+            return 'image/jpeg', None, None
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8 ":
+                width, height = _read_size(data, 26, '<HH')
+                return 'image/webp', width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L":
+                bits = _read_size(data, 21, '<I')[0]
+                return 'image/webp', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                width = int.from_bytes(data[24:27], 'little') + 1
+                height = int.from_bytes(data[27:30], 'little') + 1
+                return 'image/webp', width, height
+            return 'image/webp', None, None
+    except struct.error:
+        pass
+    return 'application/octet-stream', None, None
+
+
+def image_path(content_hash: str, mime_type: str) -> str:
+    """Путь файла кадра по хэшу содержимого."""
+    extension = _EXTENSIONS.get(mime_type, '.bin')
+    return os.path.join(COMIC_IMAGE_STORE_DIR, content_hash[:2], content_hash + extension)
+
+
+def put_image(image_data: bytes) -> Dict[str, object]:
+    """
+    Сохраняет байты картинки (если такого файла еще нет) и возвращает метаданные:
+    {'content_hash', 'size_bytes', 'mime_type', 'width', 'height'}.
+    """
+    content_hash = hashlib.sha256(image_data).hexdigest()
+    mime_type, width, height = detect_image_info(image_data)
+    path = image_path(content_hash, mime_type)
+    with store_lock:
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+    return {
+        'content_hash': content_hash,
+        'size_bytes': len(image_data),
+        'mime_type': mime_type,
+        'width': width,
+        'height': height,
+    }
+
+
+def read_image(content_hash: str, mime_type: str) -> Optional[bytes]:
+    """Байты кадра или None, если файла нет."""
+    try:
+        with open(image_path(content_hash, mime_type), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        print(f"[ComicImageStore] Файл кадра {content_hash} не найден.")
+        return None
+
+
+def delete_images(files: Iterable[Tuple[str, str]]) -> int:
+    """Удаляет файлы (content_hash, mime_type). Вызывать только для хэшей без ссылок в БД."""
+    removed = 0
+    with store_lock:
+        for content_hash, mime_type in files:
+            try:
+                os.remove(image_path(content_hash, mime_type))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[ComicImageStore] Не удалось удалить {content_hash}: {e}")
+    return removed
+
+
+def iter_stored_files():
+    """Генерирует (content_hash, mime_type) всех файлов хранилища."""
+    mime_by_extension = {ext: mime for mime, ext in _EXTENSIONS.items()}
+    if not os.path.isdir(COMIC_IMAGE_STORE_DIR):
+        return
+    for prefix in os.listdir(COMIC_IMAGE_STORE_DIR):
+        directory = os.path.join(COMIC_IMAGE_STORE_DIR, prefix)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            content_hash, extension = os.path.splitext(name)
+            if extension in mime_by_extension:
+                yield content_hash, mime_by_extension[extension]
+
+
+def get_store_stats() -> Dict[str, float]:
+    files = 0
+    total_bytes = 0
+    for content_hash, mime_type in iter_stored_files():
+        try:
+            total_bytes += os.path.getsize(image_path(content_hash, mime_type))
+            files += 1
+        except OSError:
+            pass
+    return {'files': files, 'size_mb': round(total_bytes / (1024 ** 2), 2)}
@@ -15,6 +15,7 @@ CACHE_DIR = BASE_DIR / ".epub_cache"
 UPLOADS_DIR = BASE_DIR / "uploads"
 MEDIA_DIR = UPLOADS_DIR / "media"
 FULL_TRANSLATION_DIR = BASE_DIR / ".translated"
+COMIC_IMAGES_DIR = BASE_DIR / "comic_images"
 
 # --- Настройки загрузки ---
 MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB
@@ -33,7 +34,8 @@ def ensure_directories():
         CACHE_DIR,
         UPLOADS_DIR,
         MEDIA_DIR,
-        FULL_TRANSLATION_DIR
+        FULL_TRANSLATION_DIR,
+        COMIC_IMAGES_DIR
     ]
     
     for directory in directories:
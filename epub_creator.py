@@ -29,10 +29,12 @@ def get_int_from_superscript(marker_str):
     except ValueError: return -1
 
 # --- Основная функция ---
-def create_translated_epub(book_info, target_language):
+def create_translated_epub(book_info, target_language, output_path=None):
     """
     Создает новый EPUB файл в унифицированном формате (Unified Standard Rebuild).
     Обеспечивает максимальную совместимость с FBReader и другими читалками.
+    Если задан output_path, книга записывается в этот файл и возвращается путь (байты в память не читаются),
+    иначе возвращаются байты EPUB.
     """
     print(f"Запуск создания EPUB (Unified Standard) для: {book_info.get('filename', 'N/A')}")
 
@@ -232,6 +234,17 @@ def create_translated_epub(book_info, target_language):
     book.add_item(epub.EpubNav())
 
     # Запись
+    if output_path:
+        try:
+            epub.write_epub(output_path, book, {})
+            return output_path
+        except Exception as e:
+            print(f"  ОШИБКА записи EPUB: {e}")
+            return None
+        finally:
+            import gc
+            gc.collect()
+
     t_path = None
     try:
         with tempfile.NamedTemporaryFile(delete=False, suffix=".epub") as tf:
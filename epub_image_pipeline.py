@@ -0,0 +1,170 @@
+# --- START OF FILE epub_image_pipeline.py ---
+
+"""
+Параллельное сжатие изображений (кадров комикса) при сборке EPUB.
+
+Декодирование, ресайз (LANCZOS) и кодирование в JPEG — CPU-bound работа PIL, поэтому она
+выполняется в пуле процессов. Число процессов подбирается по доступной памяти (сервер — 512MB):
+каждый воркер держит интерпретатор с PIL и один декодированный кадр. Исходные байты подаются
+в пул скользящим окном, чтобы в памяти одновременно было не больше нескольких оригиналов.
+
+Функция воркера лежит в этом легком модуле, чтобы дочерним процессам не требовался
+тяжелый импорт workflow_processor.
+"""
+
+import io
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, Optional
+
+# Сколько памяти пул может занять суммарно и сколько закладываем на один процесс-воркер
+EPUB_IMAGE_POOL_MEMORY_MB = int(os.getenv("EPUB_IMAGE_POOL_MEMORY_MB", "192"))
+EPUB_IMAGE_WORKER_MEMORY_MB = int(os.getenv("EPUB_IMAGE_WORKER_MEMORY_MB", "64"))
+EPUB_IMAGE_MAX_WORKERS = int(os.getenv("EPUB_IMAGE_MAX_WORKERS", "4"))
+# 'process' — пул процессов (по умолчанию), 'thread' — пул потоков (PIL частично отпускает GIL)
+EPUB_IMAGE_POOL_KIND = os.getenv("EPUB_IMAGE_POOL_KIND", "process")
+
+
+def compress_image_to_jpeg_bytes(raw_bytes: bytes, quota_bytes: int, target_width: int,
+                                 target_quality: int, target_format: str = "JPEG") -> bytes:
+    """
+    Адаптивно сжимает картинку под заданную квоту и лимиты.
+    Выполняется в процессе-воркере; при любой ошибке возвращает оригинал.
+    """
+    if not raw_bytes:
+        return raw_bytes
+
+    # Если оригинал уже меньше квоты — не тратим ресурсы на сжатие
+    if len(raw_bytes) <= quota_bytes:
+        return raw_bytes
+
+    try:
+        from PIL import Image
+        # Защита от огромных файлов (Decompression Bomb)
+        Image.MAX_IMAGE_PIXELS = 100000000 # 100MP
+
+        with Image.open(io.BytesIO(raw_bytes)) as im:
+            # JPEG умеет декодировать сразу в уменьшенном масштабе (1/2, 1/4, 1/8) — дешевле по памяти и CPU
+            if im.format == "JPEG" and im.size[0] > target_width * 2:
+                im.draft("RGB", (target_width, int(im.size[1] * target_width / im.size[0])))
+
+            # Если есть прозрачность — накладываем на белый фон, иначе она станет черной
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                background = Image.new("RGB", im.size, (255, 255, 255))
+                im = im.convert("RGBA")
+                background.paste(im, mask=im.split()[3])
+                im = background
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+
+            w, h = im.size
+            # Ресайз только если ширина больше целевой
+            if w > target_width:
+                new_h = int(h * (target_width / float(w)))
+                im = im.resize((target_width, new_h), Image.Resampling.LANCZOS)
+
+            # Однопроходное сохранение с вычисленным качеством
+            buf = io.BytesIO()
+            im.save(buf, format=target_format, quality=target_quality, optimize=True, dpi=(72, 72))
+            return buf.getvalue()
+    except Exception as e:
+        print(f"[EpubImagePipeline] Ошибка адаптивного сжатия: {e}. Используем оригинал.")
+        return raw_bytes
+
+
+def _available_memory_mb() -> Optional[int]:
+    """MemAvailable из /proc/meminfo (Linux) или None."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_worker_count(images_count: int) -> int:
+    """Число воркеров: по CPU, по бюджету памяти пула и по половине свободной памяти системы."""
+    if images_count <= 1:
+        return 1
+    memory_budget_mb = EPUB_IMAGE_POOL_MEMORY_MB
+    available_mb = _available_memory_mb()
+    if available_mb is not None:
+        memory_budget_mb = min(memory_budget_mb, available_mb // 2)
+    by_memory = max(1, memory_budget_mb // max(1, EPUB_IMAGE_WORKER_MEMORY_MB))
+    return max(1, min(EPUB_IMAGE_MAX_WORKERS, os.cpu_count() or 1, by_memory, images_count))
+
+
+def _create_executor(workers: int):
+    if EPUB_IMAGE_POOL_KIND == "process" and workers > 1:
+        try:
+            # fork: воркеры не переимпортируют приложение; в дочернем процессе выполняется только код PIL
+            return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        except (ValueError, OSError) as e:
+            print(f"[EpubImagePipeline] Пул процессов недоступен ({e}), используем потоки.")
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def compress_images(keys: Iterable, load_image: Callable[[object], Optional[bytes]], images_count: int,
+                    quota_bytes: int, target_width: int, target_quality: int,
+                    target_format: str = "JPEG",
+                    on_result: Optional[Callable[[object, bytes], None]] = None) -> Dict[object, bytes]:
+    """
+    Сжимает изображения параллельно. load_image(key) вызывается в текущем потоке (доступ к БД)
+    непосредственно перед отправкой в пул; одновременно в полете не больше workers * 2 оригиналов.
+    Возвращает {key: сжатые байты}; изображения, которые не удалось загрузить, пропускаются.
+    Если задан on_result(key, bytes), он вызывается в текущем потоке по мере готовности,
+    результаты не накапливаются и возвращается пустой словарь.
+    """
+    workers = get_worker_count(images_count)
+    results: Dict[object, bytes] = {}
+    emit = on_result or results.__setitem__
+    print(f"[EpubImagePipeline] Сжатие {images_count} изображений, воркеров: {workers} ({EPUB_IMAGE_POOL_KIND})")
+
+    if workers == 1:
+        for key in keys:
+            raw_bytes = load_image(key)
+            if raw_bytes:
+                emit(key, compress_image_to_jpeg_bytes(raw_bytes, quota_bytes, target_width, target_quality, target_format))
+        return results
+
+    def compress_inline(key):
+        raw_bytes = load_image(key)
+        if raw_bytes:
+            emit(key, compress_image_to_jpeg_bytes(raw_bytes, quota_bytes, target_width, target_quality, target_format))
+
+    def collect(done):
+        for future in done:
+            key = in_flight.pop(future)
+            try:
+                emit(key, future.result())
+            except Exception as e:
+                # Воркер упал (например, процесс убит OOM-killer'ом) — сжимаем в текущем процессе
+                print(f"[EpubImagePipeline] Ошибка сжатия изображения {key} в пуле: {e}. Повтор в текущем процессе.")
+                compress_inline(key)
+
+    max_in_flight = workers * 2
+    in_flight = {}
+    executor = _create_executor(workers)
+    try:
+        for key in keys:
+            if len(in_flight) >= max_in_flight:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+            raw_bytes = load_image(key)
+            if not raw_bytes:
+                continue
+            try:
+                future = executor.submit(compress_image_to_jpeg_bytes, raw_bytes, quota_bytes,
+                                         target_width, target_quality, target_format)
+            except Exception as e: # BrokenProcessPool после падения воркера
+                print(f"[EpubImagePipeline] Пул недоступен ({e}), сжатие в текущем процессе.")
+                emit(key, compress_image_to_jpeg_bytes(raw_bytes, quota_bytes, target_width, target_quality, target_format))
+                continue
+            in_flight[future] = key
+            del raw_bytes
+        collect(wait(in_flight).done)
+    finally:
+        executor.shutdown(wait=True)
+    return results
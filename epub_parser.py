@@ -319,17 +319,20 @@ def _try_decode_content(raw_bytes):
         return None, None
 
 
-def extract_section_text(epub_filepath, section_id, toc_data=None):
+def extract_section_text(epub_filepath, section_id, toc_data=None, book=None):
     """
     Извлекает "чистый" текст из указанного раздела (по ID) EPUB файла.
     Если передан toc_data, ищет заголовки-ссылки в начале секции.
+    Если передан уже распарсенный book, файл повторно не читается.
+    Возвращает "" для пустого раздела и None, если раздел не найден или его не удалось разобрать.
     """
-    if not os.path.exists(epub_filepath):
+    if book is None and not os.path.exists(epub_filepath):
         print(f"ОШИБКА: Файл EPUB не найден: {epub_filepath}")
         return None
 
     try:
-        book = epub.read_epub(epub_filepath)
+        if book is None:
+            book = epub.read_epub(epub_filepath)
         item = book.get_item_with_id(section_id)
 
         if item is None:
@@ -611,4 +614,24 @@ def extract_section_text(epub_filepath, section_id, toc_data=None):
         print(f"ОШИБКА: Не удалось извлечь текст из раздела '{section_id}': {e}")
         import traceback
         traceback.print_exc()
-        return ""
\ No newline at end of file
+        return None
+
+def extract_all_sections_text(epub_filepath, section_ids, toc_data=None):
+    """
+    Извлекает текст сразу для нескольких разделов, открывая и разбирая EPUB один раз.
+    Генератор: отдает пары (section_id, text) по одной, чтобы не держать весь текст книги в памяти.
+    """
+    if not os.path.exists(epub_filepath):
+        print(f"ОШИБКА: Файл EPUB не найден: {epub_filepath}")
+        return
+
+    try:
+        book = epub.read_epub(epub_filepath)
+    except Exception as e:
+        print(f"ОШИБКА: Не удалось прочитать EPUB '{epub_filepath}': {e}")
+        import traceback
+        traceback.print_exc()
+        return
+
+    for section_id in section_ids:
+        yield section_id, extract_section_text(epub_filepath, section_id, toc_data, book=book)
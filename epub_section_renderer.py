@@ -0,0 +1,195 @@
+# --- START OF FILE epub_section_renderer.py ---
+
+"""
+Рендер переведенного текста секции (markdown переводчика + надстрочные сноски) в XHTML для EPUB.
+
+Диалект:
+  - абзацы разделены пустой строкой, перевод строки внутри абзаца -> <br/>;
+  - **жирный**, *курсив* (могут переноситься через строку и вкладываться);
+  - ¹²³ в тексте — ссылка на сноску, строка абзаца, начинающаяся с ¹²³ — определение сноски.
+
+Строчная разметка разбирается одним проходом по одному скомпилированному регулярному выражению
+(экранирование, жирный, курсив и маркеры сносок за раз) вместо цепочки re.sub по каждому абзацу.
+
+Результат кэшируется в workflow_cache_manager по хэшу текста и параметров рендера: пересборка EPUB
+после изменения одной секции заново рендерит только ее.
+"""
+
+import re
+import html
+import hashlib
+import unicodedata
+from collections import defaultdict
+from typing import Optional
+
+import workflow_cache_manager
+
+# Увеличивать при любом изменении разметки на выходе — старые записи кэша станут недействительны
+RENDERER_VERSION = 2
+
+SUPERSCRIPT_DIGITS = '¹²³⁰⁴⁵⁶⁷⁸⁹'
+_SUPERSCRIPT_TO_DIGIT = str.maketrans('¹²³⁰⁴⁵⁶⁷⁸⁹', '1230456789')
+
+INVALID_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+TRAILING_END_MARKER_RE = re.compile(r'(?:\$\s*){3,}\s*$')
+NOTE_LINE_START_RE = re.compile(rf"^\s*([{SUPERSCRIPT_DIGITS}]+)\s*(.*)", re.UNICODE)
+
+# Один токенизатор строчной разметки: жирный | курсив | маркер сноски | перевод строки | спецсимвол HTML.
+# Курсив не заканчивается на первой '*' вложенного **жирного**: *a **b** c* -> <em>a <strong>b</strong> c</em>
+_INLINE_TOKEN_RE = re.compile(
+    rf"\*\*(?P<bold>.*?)\*\*"
+    rf"|\*(?!\*)(?P<italic>(?:\*\*.*?\*\*|[^*])*?)\*(?!\*)"
+    rf"|(?P<marker>[{SUPERSCRIPT_DIGITS}]+)"
+    r"|(?P<newline>\n)"
+    r"|(?P<escape>[&<>\"'])",
+    re.DOTALL
+)
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'}
+
+_TITLE_MD_RE = re.compile(r'\*\*(.*?)\*\*|\*(.*?)\*')
+_TITLE_HEADING_RE = re.compile(r'^#+\s*')
+
+
+def superscript_to_int(marker_str: str) -> int:
+    """Преобразует строку надстрочных цифр в целое число (-1, если не число)."""
+    num_str = (marker_str or '').translate(_SUPERSCRIPT_TO_DIGIT)
+    return int(num_str) if num_str.isdigit() else -1
+
+
+def clean_translated_text(text: str) -> str:
+    """Убирает маркер конца перевода ($$$ в конце) и крайние пробелы."""
+    return TRAILING_END_MARKER_RE.sub('', text or '').strip()
+
+
+def remove_duplicate_title_from_text(text: str, expected_title: str) -> str:
+    """Удаляет первый абзац, если он повторяет заголовок главы (с учетом markdown и '#')."""
+    if not text or not expected_title:
+        return text
+    first_para, sep, rest = text.partition('\n\n')
+    first_para = first_para.strip()
+    if not first_para:
+        return text
+    clean_for_comparison = _TITLE_MD_RE.sub(lambda m: m.group(1) if m.group(1) is not None else m.group(2), first_para)
+    clean_for_comparison = _TITLE_HEADING_RE.sub('', clean_for_comparison).strip().lower()
+    if clean_for_comparison == expected_title.strip().lower():
+        return rest.strip()
+    return text
+
+
+class _InlineRenderer:
+    """Рендер строчной разметки абзаца; нумерует ссылки на сноски внутри главы."""
+
+    def __init__(self, chapter_index: int, note_targets: set):
+        self.chapter_index = chapter_index
+        self.note_targets = note_targets
+        self.ref_counters = defaultdict(int)
+
+    def render(self, text: str, with_markers: bool = True) -> str:
+        out = []
+        pos = 0
+        for m in _INLINE_TOKEN_RE.finditer(text):
+            out.append(text[pos:m.start()])
+            pos = m.end()
+            kind = m.lastgroup
+            if kind == 'bold':
+                out.append(f"<strong>{self.render(m.group('bold'), with_markers)}</strong>")
+            elif kind == 'italic':
+                out.append(f"<em>{self.render(m.group('italic'), with_markers)}</em>")
+            elif kind == 'marker':
+                out.append(self._footnote_ref(m.group('marker')) if with_markers else m.group('marker'))
+            elif kind == 'newline':
+                out.append('<br/>')
+            else:
+                out.append(_ESCAPES[m.group('escape')])
+        out.append(text[pos:])
+        return ''.join(out)
+
+    def _footnote_ref(self, marker: str) -> str:
+        num = superscript_to_int(marker)
+        if num <= 0 or num not in self.note_targets:
+            return marker
+        self.ref_counters[num] += 1
+        occ = self.ref_counters[num]
+        note_id = f"note_{self.chapter_index}_{num}_{occ}"
+        ref_id = f"ref_{self.chapter_index}_{num}_{occ}"
+        return f'<sup class="footnote-ref"><a id="{ref_id}" href="#{note_id}">{marker}</a></sup>'
+
+
+def render_section_body(clean_text: str, chapter_index: int) -> str:
+    """
+    Рендерит очищенный текст секции в XHTML (абзацы и блоки сносок, без заголовка и картинки).
+    Ссылка на сноску становится гиперссылкой, только если в главе есть ее определение.
+    """
+    if not clean_text:
+        return ""
+
+    # 1. Разбиение и классификация абзацев (один проход по строкам)
+    paragraphs = []
+    note_targets = set()
+    for p_raw in clean_text.split('\n\n'):
+        p_strip = p_raw.strip()
+        if not p_strip:
+            continue
+        lines = [line.strip() for line in p_strip.split('\n')]
+        note_matches = [NOTE_LINE_START_RE.match(line) for line in lines]
+        is_def_para = any(note_matches)
+        for nm in note_matches:
+            if nm:
+                num = superscript_to_int(nm.group(1))
+                if num > 0:
+                    note_targets.add(num)
+        paragraphs.append((p_strip, lines, note_matches if is_def_para else None))
+
+    # 2. Рендер
+    inline = _InlineRenderer(chapter_index, note_targets)
+    def_counters = defaultdict(int)
+    parts = []
+    for p_strip, lines, note_matches in paragraphs:
+        if note_matches is None:
+            # Обычный абзац
+            text_clean = INVALID_XML_CHARS_RE.sub('', unicodedata.normalize('NFC', p_strip))
+            parts.append(f"<p>{inline.render(text_clean)}</p>\n")
+            continue
+
+        # Абзац с определениями сносок
+        f_lines = []
+        for line_s, nm in zip(lines, note_matches):
+            if not line_s:
+                continue
+            num = superscript_to_int(nm.group(1)) if nm else -1
+            if num > 0:
+                marker, note_text = nm.groups()
+                def_counters[num] += 1
+                occ = def_counters[num]
+                note_id = f"note_{chapter_index}_{num}_{occ}"
+                ref_id = f"ref_{chapter_index}_{num}_{occ}"
+                n_html = inline.render(INVALID_XML_CHARS_RE.sub('', note_text), with_markers=False)
+                backlink = f' <a href="#{ref_id}" class="footnote-backlink" title="Back">↩</a>'
+                f_lines.append(f'<p class="footnote-definition" id="{note_id}"><small>{marker}</small> {n_html}{backlink}</p>')
+            else:
+                f_lines.append(f'<p>{html.escape(line_s)}</p>')
+        if f_lines:
+            parts.append(f'<div class="footnote-block" style="font-size: 0.9em; border-top: 1px solid #eee; margin-top: 2em; padding-top: 1em;">\n{"".join(f_lines)}\n</div>')
+    return ''.join(parts)
+
+
+def render_section_body_cached(book_id: str, section_id, translated_text: Optional[str],
+                               chapter_title: str, chapter_index: int) -> str:
+    """
+    Очищает текст, убирает дублирующий заголовок и рендерит тело главы, используя кэш рендера.
+    Ключ кэша: хэш текста + заголовок + номер главы (id сносок зависят от него) + версия рендера.
+    """
+    raw_text = translated_text or ''
+    render_key = hashlib.sha256(
+        f"{RENDERER_VERSION}\x00{chapter_index}\x00{chapter_title}\x00{raw_text}".encode('utf-8')
+    ).hexdigest()
+    if book_id and section_id is not None:
+        cached = workflow_cache_manager.load_section_render(book_id, section_id, render_key)
+        if cached is not None:
+            return cached
+
+    clean_text = remove_duplicate_title_from_text(clean_translated_text(raw_text), chapter_title)
+    rendered = render_section_body(clean_text, chapter_index)
+    if book_id and section_id is not None:
+        workflow_cache_manager.save_section_render(book_id, section_id, render_key, rendered)
+    return rendered
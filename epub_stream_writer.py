@@ -0,0 +1,220 @@
+# --- START OF FILE epub_stream_writer.py ---
+
+"""
+Потоковая запись EPUB 3 напрямую в ZIP-файл на диске.
+
+В отличие от ebooklib.EpubBook, который держит в памяти все главы и картинки до write_epub,
+здесь каждая глава/картинка записывается в архив сразу при добавлении, а в памяти остается
+только манифест (имена файлов и заголовки). Пиковое потребление памяти не зависит от размера книги.
+
+Структура архива совпадает с тем, что писал ebooklib: mimetype, META-INF/container.xml,
+EPUB/content.opf, EPUB/nav.xhtml, EPUB/toc.ncx, главы и картинки в EPUB/.
+"""
+
+import os
+import shutil
+import zipfile
+import posixpath
+import datetime
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+from typing import Optional, Tuple
+
+CONTENT_DIR = "EPUB"
+
+_CONTAINER_XML = (
+    '<?xml version="1.0" encoding="utf-8"?>\n'
+    '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+    '  <rootfiles>\n'
+    f'    <rootfile full-path="{CONTENT_DIR}/content.opf" media-type="application/oebps-package+xml"/>\n'
+    '  </rootfiles>\n'
+    '</container>\n'
+)
+
+_IMAGE_MEDIA_TYPES = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+    '.gif': 'image/gif', '.svg': 'image/svg+xml', '.webp': 'image/webp',
+}
+
+
+def guess_image_media_type(file_name: str) -> str:
+    return _IMAGE_MEDIA_TYPES.get(os.path.splitext(file_name)[1].lower(), 'image/jpeg')
+
+
+class EpubStreamWriter:
+    """
+    Пишет EPUB по мере добавления элементов. Использование:
+        writer = EpubStreamWriter(path, identifier, title, language, author)
+        writer.add_cover(...); writer.add_image(...); writer.add_chapter(...)
+        writer.close()  # дописывает content.opf, nav.xhtml, toc.ncx
+    """
+
+    def __init__(self, path, identifier: str, title: str, language: str, author: Optional[str] = None):
+        self.path = str(path)
+        self.identifier = identifier
+        self.title = title
+        self.language = language
+        self.author = author
+        self.manifest = [] # (id, href, media_type, properties)
+        self.chapters = [] # (id, href, title)
+        self.cover_image_id = None
+        self.cover_page_href = None
+        self.zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        # mimetype должен быть первым и без сжатия
+        self.zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', _CONTAINER_XML)
+
+    def _write(self, href: str, data, compress_type: int = zipfile.ZIP_DEFLATED):
+        name = posixpath.join(CONTENT_DIR, href)
+        if isinstance(data, (bytes, str)):
+            self.zip.writestr(name, data, compress_type=compress_type)
+        else:
+            # Файловый объект — копируем кусками
+            info = zipfile.ZipInfo(name, date_time=datetime.datetime.now().timetuple()[:6])
+            info.compress_type = compress_type
+            with self.zip.open(info, 'w') as dst:
+                shutil.copyfileobj(data, dst, 1024 * 1024)
+
+    def add_image(self, item_id: str, href: str, data, media_type: Optional[str] = None):
+        """Добавляет картинку (bytes или файловый объект). JPEG/PNG уже сжаты — пишутся без DEFLATE."""
+        self._write(href, data, zipfile.ZIP_STORED)
+        self.manifest.append((item_id, href, media_type or guess_image_media_type(href), None))
+
+    def add_cover(self, href: str, data, media_type: Optional[str] = None):
+        """Добавляет обложку: картинку с properties="cover-image" и страницу cover.xhtml (как ebooklib.set_cover)."""
+        self._write(href, data, zipfile.ZIP_STORED)
+        self.cover_image_id = 'cover-img'
+        self.manifest.append((self.cover_image_id, href, media_type or guess_image_media_type(href), 'cover-image'))
+        self.cover_page_href = 'cover.xhtml'
+        cover_page = (
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            f'<html xmlns="http://www.w3.org/1999/xhtml" lang={quoteattr(self.language)}>'
+            '<head><title>Cover</title></head><body>'
+            f'<img src={quoteattr(href)} alt="Cover"/></body></html>'
+        )
+        self._write(self.cover_page_href, cover_page)
+        self.manifest.append(('cover', self.cover_page_href, 'application/xhtml+xml', None))
+
+    def add_chapter(self, item_id: str, href: str, title: str, content):
+        """Добавляет главу (готовый XHTML в bytes/str) в архив, манифест, spine и оглавление."""
+        self._write(href, content)
+        self.manifest.append((item_id, href, 'application/xhtml+xml', None))
+        self.chapters.append((item_id, href, title))
+
+    def _nav_xhtml(self) -> str:
+        items = "\n".join(
+            f'      <li><a href={quoteattr(href)}>{escape(title)}</a></li>' for _, href, title in self.chapters
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+            f'lang={quoteattr(self.language)} xml:lang={quoteattr(self.language)}>\n'
+            f'<head><title>{escape(self.title)}</title></head>\n<body>\n'
+            f'  <nav epub:type="toc" id="id" role="doc-toc">\n    <h2>{escape(self.title)}</h2>\n    <ol>\n{items}\n    </ol>\n  </nav>\n'
+            '</body>\n</html>\n'
+        )
+
+    def _toc_ncx(self) -> str:
+        points = "\n".join(
+            f'    <navPoint id={quoteattr(item_id)} playOrder="{i}"><navLabel><text>{escape(title)}</text></navLabel>'
+            f'<content src={quoteattr(href)}/></navPoint>'
+            for i, (item_id, href, title) in enumerate(self.chapters, start=1)
+        )
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+            f'  <head><meta content={quoteattr(self.identifier)} name="dtb:uid"/><meta content="0" name="dtb:depth"/>'
+            '<meta content="0" name="dtb:totalPageCount"/><meta content="0" name="dtb:maxPageNumber"/></head>\n'
+            f'  <docTitle><text>{escape(self.title)}</text></docTitle>\n'
+            f'  <navMap>\n{points}\n  </navMap>\n</ncx>\n'
+        )
+
+    def _content_opf(self) -> str:
+        modified = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        metadata = [
+            f'    <dc:identifier id="id">{escape(self.identifier)}</dc:identifier>',
+            f'    <dc:title>{escape(self.title)}</dc:title>',
+            f'    <dc:language>{escape(self.language)}</dc:language>',
+            f'    <meta property="dcterms:modified">{modified}</meta>',
+        ]
+        if self.author:
+            metadata.append(f'    <dc:creator id="creator">{escape(self.author)}</dc:creator>')
+        if self.cover_image_id:
+            metadata.append(f'    <meta name="cover" content="{self.cover_image_id}"/>')
+
+        manifest = [
+            '    <item href="nav.xhtml" id="nav" media-type="application/xhtml+xml" properties="nav"/>',
+            '    <item href="toc.ncx" id="ncx" media-type="application/x-dtbncx+xml"/>',
+        ]
+        for item_id, href, media_type, properties in self.manifest:
+            props = f' properties={quoteattr(properties)}' if properties else ''
+            manifest.append(f'    <item href={quoteattr(href)} id={quoteattr(item_id)} media-type="{media_type}"{props}/>')
+
+        spine = ['    <itemref idref="nav"/>'] + [f'    <itemref idref={quoteattr(item_id)}/>' for item_id, _, _ in self.chapters]
+        guide = ''
+        if self.cover_page_href:
+            guide = f'  <guide>\n    <reference href="{self.cover_page_href}" title="Cover" type="cover"/>\n  </guide>\n'
+
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">\n'
+            '  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+            + "\n".join(metadata) + '\n  </metadata>\n'
+            '  <manifest>\n' + "\n".join(manifest) + '\n  </manifest>\n'
+            '  <spine toc="ncx">\n' + "\n".join(spine) + '\n  </spine>\n'
+            + guide +
+            '</package>\n'
+        )
+
+    def close(self):
+        """Дописывает навигацию и OPF и закрывает архив."""
+        try:
+            self._write('nav.xhtml', self._nav_xhtml())
+            self._write('toc.ncx', self._toc_ncx())
+            self._write('content.opf', self._content_opf())
+        finally:
+            self.zip.close()
+
+    def abort(self):
+        """Закрывает архив без финализации и удаляет недописанный файл."""
+        try:
+            self.zip.close()
+        except Exception:
+            pass
+        if os.path.exists(self.path):
+            try: os.remove(self.path)
+            except OSError: pass
+
+
+def find_cover_in_epub(epub_path) -> Optional[Tuple[str, str]]:
+    """
+    Ищет обложку в исходном EPUB без загрузки книги целиком: читает только container.xml и OPF.
+    Возвращает (имя файла в архиве, media-type) или None.
+    Порядок поиска как раньше через ebooklib: id 'cover'/'cover-image'/'img-cover', затем 'cover' в имени/id.
+    """
+    with zipfile.ZipFile(epub_path) as zf:
+        container = ET.fromstring(zf.read('META-INF/container.xml'))
+        rootfile = container.find('.//{urn:oasis:names:tc:opendocument:xmlns:container}rootfile')
+        if rootfile is None:
+            return None
+        opf_path = rootfile.get('full-path')
+        opf = ET.fromstring(zf.read(opf_path))
+        opf_dir = posixpath.dirname(opf_path)
+
+        images = []
+        for item in opf.iter('{http://www.idpf.org/2007/opf}item'):
+            media_type = item.get('media-type', '')
+            if media_type.startswith('image/'):
+                href = posixpath.normpath(posixpath.join(opf_dir, item.get('href', '')))
+                images.append((item.get('id', ''), href, media_type, item.get('properties', '')))
+
+        candidates = [img for img in images if 'cover-image' in img[3].split()]
+        for cover_id in ('cover', 'cover-image', 'img-cover'):
+            candidates += [img for img in images if img[0] == cover_id]
+        candidates += [img for img in images if 'cover' in img[1].lower() or 'cover' in img[0].lower()]
+
+        names = set(zf.namelist())
+        for _, href, media_type, _ in candidates:
+            if href in names:
+                return href, media_type
+    return None
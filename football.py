@@ -1,5 +1,6 @@
 import sqlite3
 import requests
+import http_client
 import json
 import time
 import random
@@ -7,6 +8,8 @@ from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Any, List, Tuple
 import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 from io import BytesIO
 try:
@@ -26,6 +29,8 @@ except ImportError as e:
 from config import FOOTBALL_DB_FILE, TEAM_REGISTRY_DB_FILE
 from workflow_model_config import get_model_for_operation
 from workflow_translation_module import WorkflowTranslator
+from sofascore_event_index import SofascoreEventIndex, normalize_team_name
+from odds_api_cache import odds_api_cache
 
 # Попытка импортировать telegram_notifier (может отсутствовать)
 try:
@@ -61,9 +66,13 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 ODDS_API_URL = "https://api.the-odds-api.com/v4"
 # Порог для переключения на следующий ключ (осталось запросов)
 ODDS_API_SWITCH_THRESHOLD = 10
+# Сколько лиг запрашивать из The Odds API параллельно при sync_matches
+ODDS_API_FETCH_WORKERS = int(os.getenv("ODDS_API_FETCH_WORKERS", "4"))
 # Порог коэффициента для определения фаворита (матчи с кэфом <= этому значению считаются "с фаворитом")
 FAVORITE_THRESHOLD = 2.00
 SOFASCORE_API_URL = "https://api.sofascore1.com/api/v1"
+# Сколько индексов событий SofaScore (по одному на список событий даты) держать в памяти
+SOFASCORE_EVENT_INDEX_CACHE_SIZE = 8
 
 # Список User-Agent'ов для SofaScore (случайный выбор, чтобы уменьшить шанс бана)
 SOFASCORE_USER_AGENTS = [
@@ -587,6 +596,8 @@ class FootballManager:
         
         # Словарь для отслеживания лимитов каждого ключа: {key_index: {'remaining': int, 'used': int}}
         self.key_limits = {i: {'remaining': None, 'used': None} for i in range(len(self.api_keys))}
+        # Лимиты и текущий ключ меняются из потоков параллельной загрузки лиг
+        self._odds_api_lock = threading.RLock()
         # Внешний провайдер для текущих счетов (TheSportsDB)
         self.thesportsdb_api_key = os.getenv("THESPORTSDB_API_KEY", "123")
         
@@ -629,6 +640,9 @@ class FootballManager:
         # Хранилище флага "trouble уже отправлен" для favourite_trouble
         # Ключ: fixture_id, Значение: True
         self.favorite_trouble_sent = {}
+
+        # Индексы событий SofaScore по названиям команд: id(список событий) -> SofascoreEventIndex
+        self._sofascore_event_indexes: Dict[int, SofascoreEventIndex] = {}
         
         # Получаем список лиг для сбора (из переменной окружения или по умолчанию)
         leagues_env = os.getenv("FOOTBALL_LEAGUES")
@@ -1425,7 +1439,7 @@ class FootballManager:
                     print(f"[Football] Инициализация лимитов для ключа #{i + 1}...")
                     params = {'apiKey': key}
                     url = f"{ODDS_API_URL}/sports"
-                    response = requests.get(url, params=params, timeout=30)
+                    response = http_client.get(url, params=params, timeout=30)
                     response.raise_for_status()
                     
                     # Временно переключаемся на этот ключ для извлечения лимитов
@@ -1464,9 +1478,26 @@ class FootballManager:
             print(f"[Football ERROR] Ошибка инициализации лимитов API: {e}")
             # Не падаем, если не удалось получить лимиты - продолжим без них
 
-    def _make_api_request(self, endpoint: str, params: dict) -> Optional[list]:
+    def _make_api_request(self, endpoint: str, params: dict, use_cache: bool = True) -> Optional[list]:
         """
-        Выполняет запрос к The Odds API.
+        Выполняет запрос к The Odds API через кэш ответов (см. odds_api_cache):
+        свежий ответ на тот же эндпоинт с теми же параметрами не тратит квоту повторно.
+        
+        Args:
+            endpoint: Путь эндпоинта (например, "/sports/soccer_epl/odds")
+            params: Параметры запроса
+            use_cache: False — запрос мимо кэша (ответ не берется из кэша и не сохраняется в него)
+            
+        Returns:
+            Список данных или None в случае ошибки
+        """
+        if not use_cache:
+            return self._fetch_from_odds_api(endpoint, params)
+        return odds_api_cache.get_or_fetch(endpoint, params, lambda: self._fetch_from_odds_api(endpoint, params))
+
+    def _fetch_from_odds_api(self, endpoint: str, params: dict) -> Optional[list]:
+        """
+        Выполняет запрос к The Odds API (без кэша), учитывает лимиты и ротацию ключей.
         
         Args:
             endpoint: Путь эндпоинта (например, "/sports/soccer_epl/odds")
@@ -1482,21 +1513,25 @@ class FootballManager:
             # Добавляем API ключ в параметры
             params['apiKey'] = self.api_key
             
-            response = requests.get(url, params=params, timeout=30)
+            response = http_client.get(url, params=params, timeout=30)
             
             # Проверяем статус ответа
             if response.status_code == 429:
                 # Too Many Requests - переключаемся на следующий ключ
-                print(f"[Football WARNING] Получен 429 (Too Many Requests) для ключа #{self.current_key_index + 1}. Переключение на следующий ключ...")
-                self._switch_to_next_key()
-                # Повторяем запрос с новым ключом
-                params['apiKey'] = self.api_key
-                response = requests.get(url, params=params, timeout=30)
+                with self._odds_api_lock:
+                    if params['apiKey'] == self.api_key:
+                        print(f"[Football WARNING] Получен 429 (Too Many Requests) для ключа #{self.current_key_index + 1}. Переключение на следующий ключ...")
+                        self._switch_to_next_key()
+                    # Повторяем запрос с новым ключом (мог уже смениться в другом потоке)
+                    params['apiKey'] = self.api_key
+                response = http_client.get(url, params=params, timeout=30)
             
             response.raise_for_status()
             
             # Извлекаем и обновляем лимиты из заголовков ответа
-            self._extract_api_limits_from_headers(response)
+            with self._odds_api_lock:
+                if params['apiKey'] == self.api_key:
+                    self._extract_api_limits_from_headers(response)
             
             data = response.json()
             
@@ -1509,7 +1544,8 @@ class FootballManager:
             if hasattr(e, 'response') and e.response is not None and e.response.status_code == 429:
                 if len(self.api_keys) > 1:
                     print(f"[Football] Пробуем переключиться на следующий ключ после ошибки 429...")
-                    self._switch_to_next_key()
+                    with self._odds_api_lock:
+                        self._switch_to_next_key()
             return None
         except json.JSONDecodeError as e:
             print(f"[Football ERROR] Ошибка парсинга JSON: {e}")
@@ -1659,6 +1695,7 @@ class FootballManager:
         Нормализует название команды для сравнения.
         Убирает пробелы, приводит к нижнему регистру, убирает специальные символы и префиксы.
         Нормализует специальные символы (датские, норвежские, немецкие буквы и т.д.).
+        Результат кэшируется (см. sofascore_event_index.normalize_team_name).
         
         Args:
             name: Исходное название команды
@@ -1666,66 +1703,19 @@ class FootballManager:
         Returns:
             Нормализованное название
         """
-        if not name:
-            return ""
-        
-        # Список префиксов для удаления (распространенные префиксы футбольных клубов)
-        prefixes = [
-            'sk ', 'fc ', 'sc ', 'cf ', 'ac ', 'as ', 'rc ', 'fk ', 'if ', 'bk ',
-            '1. ', '1 ', '2. ', '3. ', 'cd ', 'ud ', 'cf ', 'sd ', 'fc. ', 'sc. ',
-            'royale ', 'royal ', 'r. ', 'r ', 'h. ', 'h ', 'v. ', 'v ', 'vs ', 'vs. ',
-            'the ', 'of ', 'de ', 'la ', 'le ', 'los ', 'las ', 'el ', 'der ', 'die ', 'das ',
-            'afc ', 'cfc ', 'dfc ', 'sfc ', 'pfc ', 'kfc ', 'bfc ', 'vfc ', 'tsv ', 'fsv ',
-            'vv ', 'vv. ', 'vvv ', 'vvv-', 'vvv. ', 'vvv ', 'vvv-', 'vvv. '
-        ]
-        
-        normalized = name.lower().strip()
-        
-        # Удаляем префиксы
-        for prefix in prefixes:
-            if normalized.startswith(prefix):
-                normalized = normalized[len(prefix):].strip()
-        
-        # Нормализуем специальные символы (датские, норвежские, немецкие, испанские и т.д.)
-        # Это поможет сопоставить "Copenhagen" с "København", "München" с "Munich", и т.д.
-        char_replacements = {
-            'ø': 'o', 'Ø': 'o',  # Датская/норвежская буква
-            'æ': 'ae', 'Æ': 'ae',  # Датская/норвежская буква
-            'å': 'aa', 'Å': 'aa',  # Датская/норвежская буква
-            'ö': 'o', 'Ö': 'o',  # Немецкая/шведская буква
-            'ü': 'u', 'Ü': 'u',  # Немецкая буква
-            'ä': 'a', 'Ä': 'a',  # Немецкая/шведская буква
-            'ß': 'ss',  # Немецкая буква
-            'ñ': 'n', 'Ñ': 'n',  # Испанская буква
-            'ç': 'c', 'Ç': 'c',  # Французская/португальская буква
-            'é': 'e', 'É': 'e',  # Французская буква
-            'è': 'e', 'È': 'e',  # Французская буква
-            'ê': 'e', 'Ê': 'e',  # Французская буква
-            'ë': 'e', 'Ë': 'e',  # Французская буква
-            'à': 'a', 'À': 'a',  # Французская буква
-            'á': 'a', 'Á': 'a',  # Испанская буква
-            'â': 'a', 'Â': 'a',  # Французская буква
-            'ã': 'a', 'Ã': 'a',  # Португальская буква
-            'í': 'i', 'Í': 'i',  # Испанская буква
-            'î': 'i', 'Î': 'i',  # Французская буква
-            'ï': 'i', 'Ï': 'i',  # Французская буква
-            'ó': 'o', 'Ó': 'o',  # Испанская буква
-            'ô': 'o', 'Ô': 'o',  # Французская буква
-            'õ': 'o', 'Õ': 'o',  # Португальская буква
-            'ú': 'u', 'Ú': 'u',  # Испанская буква
-            'û': 'u', 'Û': 'u',  # Французская буква
-            'ý': 'y', 'Ý': 'y',  # Чешская буква
-        }
-        for old_char, new_char in char_replacements.items():
-            normalized = normalized.replace(old_char, new_char)
-        
-        # Убираем пробелы, приводим к нижнему регистру, убираем дефисы и подчеркивания
-        normalized = normalized.replace(" ", "").replace("-", "").replace("_", "")
-        
-        # Убираем другие специальные символы (точки, запятые и т.д.)
-        normalized = ''.join(c for c in normalized if c.isalnum())
-        
-        return normalized
+        return normalize_team_name(name)
+
+    def _get_sofascore_event_index(self, sofascore_events: List[Dict]) -> SofascoreEventIndex:
+        """
+        Индекс событий SofaScore по названиям команд. Строится один раз на список событий
+        (результат _fetch_sofascore_events) и переиспользуется для всех матчей этой даты.
+        """
+        index = self._sofascore_event_indexes.get(id(sofascore_events))
+        if index is None or index.events is not sofascore_events:
+            if len(self._sofascore_event_indexes) >= SOFASCORE_EVENT_INDEX_CACHE_SIZE:
+                self._sofascore_event_indexes.pop(next(iter(self._sofascore_event_indexes)))
+            index = self._sofascore_event_indexes[id(sofascore_events)] = SofascoreEventIndex(sofascore_events)
+        return index
 
     def _fetch_live_events(self) -> Optional[List[Dict]]:
         """
@@ -1740,7 +1730,7 @@ class FootballManager:
         headers = SOFASCORE_DEFAULT_HEADERS.copy()
         headers["User-Agent"] = random.choice(SOFASCORE_USER_AGENTS)
         try:
-            response = requests.get(url, headers=headers, timeout=15.0)
+            response = http_client.get(url, headers=headers, timeout=15.0)
             if response.status_code == 200:
                 data = response.json()
                 return data.get('events', [])
@@ -1809,7 +1799,7 @@ class FootballManager:
             
             try:
                 # print(f"[Football SofaScore] Запрос событий на дату {date} (попытка {attempt}/{max_retries})")
-                response = requests.get(url, headers=headers, timeout=15.0)
+                response = http_client.get(url, headers=headers, timeout=15.0)
                 code = response.status_code
                 
                 if code == 200:
@@ -1936,7 +1926,7 @@ class FootballManager:
             url = f"{SOFASCORE_API_URL}/search/events?q={requests.utils.quote(query_team)}&page=0"
             hdrs = SOFASCORE_DEFAULT_HEADERS.copy()
             hdrs["User-Agent"] = random.choice(SOFASCORE_USER_AGENTS)
-            resp = requests.get(url, headers=hdrs, timeout=15.0)
+            resp = http_client.get(url, headers=hdrs, timeout=15.0)
             if resp.status_code != 200:
                 return None
             data = resp.json()
@@ -2006,82 +1996,11 @@ class FootballManager:
             home_normalized = self._normalize_team_name(home_team_odds)
             away_normalized = self._normalize_team_name(away_team_odds)
             
-            # Ищем совпадение в событиях SofaScore
-            for event in sofascore_events:
-                try:
-                    event_id = event.get('id')
-                    if not event_id:
-                        continue
-                    
-                    home_team_obj = event.get('homeTeam', {})
-                    away_team_obj = event.get('awayTeam', {})
-                    
-                    if not home_team_obj or not away_team_obj:
-                        continue
-                    
-                    # Получаем все возможные варианты названий команд из SofaScore
-                    home_team_variants = []
-                    away_team_variants = []
-                    
-                    # Основное название
-                    if home_team_obj.get('name'):
-                        home_team_variants.append(home_team_obj['name'])
-                    if away_team_obj.get('name'):
-                        away_team_variants.append(away_team_obj['name'])
-                    
-                    # Короткое название
-                    if home_team_obj.get('shortName'):
-                        home_team_variants.append(home_team_obj['shortName'])
-                    if away_team_obj.get('shortName'):
-                        away_team_variants.append(away_team_obj['shortName'])
-                    
-                    # Переводы (русский, английский и другие)
-                    home_translations = home_team_obj.get('fieldTranslations', {}).get('nameTranslation', {})
-                    if home_translations:
-                        for lang, translation in home_translations.items():
-                            if translation:
-                                home_team_variants.append(translation)
-                    
-                    away_translations = away_team_obj.get('fieldTranslations', {}).get('nameTranslation', {})
-                    if away_translations:
-                        for lang, translation in away_translations.items():
-                            if translation:
-                                away_team_variants.append(translation)
-                    
-                    # Нормализуем все варианты
-                    home_sf_normalized_set = {self._normalize_team_name(v) for v in home_team_variants if v}
-                    away_sf_normalized_set = {self._normalize_team_name(v) for v in away_team_variants if v}
-                    
-                    # ТОЛЬКО прямой порядок (без реверса — ловили ответные матчи)
-                    teams_match = False
-                    for home_sf_norm in home_sf_normalized_set:
-                        for away_sf_norm in away_sf_normalized_set:
-                            if home_normalized == home_sf_norm and away_normalized == away_sf_norm:
-                                teams_match = True
-                                break
-                            home_partial = (
-                                len(home_normalized) >= 3 and len(home_sf_norm) >= 3 and
-                                (home_normalized in home_sf_norm or home_sf_norm in home_normalized))
-                            away_partial = (
-                                len(away_normalized) >= 3 and len(away_sf_norm) >= 3 and
-                                (away_normalized in away_sf_norm or away_sf_norm in away_normalized))
-                            if home_partial and away_partial:
-                                teams_match = True
-                                break
-                            
-                        if teams_match:
-                            break
-                    
-                    if not teams_match:
-                        continue
-
-                                        # Найдено совпадение по названиям команд (время не проверяем, так как данные уже отфильтрованы по дате)
-                    # print(f"[Football SofaScore] Найдено совпадение: {home_team_odds} vs {away_team_odds} -> event_id={event_id}")
-                    return event_id
-                    
-                except Exception as e:
-                    print(f"[Football SofaScore] Ошибка при обработке события SofaScore: {e}")
-                    continue
+            # Поиск по индексу названий (строится один раз на список событий даты)
+            event = self._get_sofascore_event_index(sofascore_events).find_by_teams(home_team_odds, away_team_odds)
+            if event:
+                # Найдено совпадение по названиям команд (время не проверяем, так как данные уже отфильтрованы по дате)
+                return event.get('id')
             
             # Если не нашли совпадение, выводим детальную информацию для отладки
             if home_team_odds and away_team_odds:
@@ -2135,129 +2054,17 @@ class FootballManager:
                 print(f"[Football SofaScore] Ошибка парсинга времени матча: {e}")
                 return None
             
-            # Ищем совпадение в событиях SofaScore
-            for event in sofascore_events:
-                try:
-                    event_id = event.get('id')
-                    if not event_id:
-                        continue
-                    
-                    home_team_obj = event.get('homeTeam', {})
-                    away_team_obj = event.get('awayTeam', {})
-                    
-                    if not home_team_obj or not away_team_obj:
-                        continue
-                    
-                    # Проверяем время начала матча
-                    start_timestamp = event.get('startTimestamp')
-                    if not start_timestamp:
-                        continue
-                    
-                    try:
-                        # startTimestamp от SofaScore - это Unix timestamp в UTC
-                        event_datetime = datetime.fromtimestamp(start_timestamp, tz=timezone.utc)
-                        time_diff_seconds = abs((match_datetime - event_datetime).total_seconds())
-                        time_diff_minutes = time_diff_seconds / 60
-                        
-                        # Проверяем, что время совпадает в пределах ±5 минут + поправка на часовой пояс
-                        # Если разница близка к целому количеству часов (в пределах ±5 минут),
-                        # то это разница в часовых поясах, и мы ее учитываем
-                        hours_diff = round(time_diff_minutes / 60)
-                        minutes_remainder = abs(time_diff_minutes - hours_diff * 60)
-                        
-                        # Если остаток меньше 5 минут, значит это разница в часовых поясах
-                        if minutes_remainder <= 5:
-                            # Время совпадает с учетом часового пояса
-                            pass  # Продолжаем проверку команд
-                        elif time_diff_minutes <= 5:
-                            # Время совпадает без учета часового пояса (тот же часовой пояс)
-                            pass  # Продолжаем проверку команд
-                        else:
-                            # Время не совпадает
-                            continue
-                    except Exception as e:
-                        continue
-                    
-                    # Для отладки: проверяем, есть ли хотя бы частичное совпадение по командам
-                    # Это поможет понять, почему не находится совпадение
-                    
-                    # Получаем все возможные варианты названий команд из SofaScore
-                    home_team_variants = []
-                    away_team_variants = []
-                    
-                    if home_team_obj.get('name'):
-                        home_team_variants.append(home_team_obj['name'])
-                    if home_team_obj.get('shortName'):
-                        home_team_variants.append(home_team_obj['shortName'])
-                    home_translations = home_team_obj.get('fieldTranslations', {}).get('nameTranslation', {})
-                    if home_translations:
-                        for lang, translation in home_translations.items():
-                            if translation:
-                                home_team_variants.append(translation)
-                    
-                    if away_team_obj.get('name'):
-                        away_team_variants.append(away_team_obj['name'])
-                    if away_team_obj.get('shortName'):
-                        away_team_variants.append(away_team_obj['shortName'])
-                    away_translations = away_team_obj.get('fieldTranslations', {}).get('nameTranslation', {})
-                    if away_translations:
-                        for lang, translation in away_translations.items():
-                            if translation:
-                                away_team_variants.append(translation)
-                    
-                    # Нормализуем все варианты
-                    home_sf_normalized_set = {self._normalize_team_name(v) for v in home_team_variants if v}
-                    away_sf_normalized_set = {self._normalize_team_name(v) for v in away_team_variants if v}
-                    
-                    # Проверяем совпадение хотя бы одной команды (home или away) с учетом частичного совпадения
-                    home_match = False
-                    away_match = False
-                    
-                    # Проверяем home команду
-                    for home_sf_norm in home_sf_normalized_set:
-                        if (home_normalized == home_sf_norm or 
-                            (len(home_normalized) >= 3 and len(home_sf_norm) >= 3 and 
-                             (home_normalized in home_sf_norm or home_sf_norm in home_normalized))):
-                            home_match = True
-                            break
-                    
-                    # Проверяем away команду
-                    for away_sf_norm in away_sf_normalized_set:
-                        if (away_normalized == away_sf_norm or 
-                            (len(away_normalized) >= 3 and len(away_sf_norm) >= 3 and 
-                             (away_normalized in away_sf_norm or away_sf_norm in away_normalized))):
-                            away_match = True
-                            break
-                    
-                    # Проверяем обратный порядок (home vs away или away vs home)
-                    if not home_match:
-                        for away_sf_norm in away_sf_normalized_set:
-                            if (home_normalized == away_sf_norm or 
-                                (len(home_normalized) >= 3 and len(away_sf_norm) >= 3 and 
-                                 (home_normalized in away_sf_norm or away_sf_norm in home_normalized))):
-                                home_match = True
-                                break
-                    
-                    if not away_match:
-                        for home_sf_norm in home_sf_normalized_set:
-                            if (away_normalized == home_sf_norm or 
-                                (len(away_normalized) >= 3 and len(home_sf_norm) >= 3 and 
-                                 (away_normalized in home_sf_norm or home_sf_norm in away_normalized))):
-                                away_match = True
-                                break
-                    
-                    # Если хотя бы одна команда совпадает и время совпадает, считаем это совпадением
-                    if home_match or away_match:
-                        # print(f"[Football SofaScore] Найдено совпадение по команде+времени: {home_team_odds} vs {away_team_odds} -> event_id={event_id} (home_match={home_match}, away_match={away_match})")
-                        # Возвращаем словарь с event_id и данными для сохранения
-                        return {
-                            'event_id': event_id,
-                            'slug': event.get('slug', ''),
-                            'startTimestamp': event.get('startTimestamp')
-                        }
-                    
-                except Exception as e:
-                    continue
+            # Кандидаты по любой из команд из индекса, затем проверка времени
+            event = self._get_sofascore_event_index(sofascore_events).find_by_team_and_time(
+                home_team_odds, away_team_odds, match_datetime
+            )
+            if event:
+                # Возвращаем словарь с event_id и данными для сохранения
+                return {
+                    'event_id': event.get('id'),
+                    'slug': event.get('slug', ''),
+                    'startTimestamp': event.get('startTimestamp')
+                }
             
             # Если не нашли совпадение, выводим детальную информацию для отладки
             if home_team_odds and away_team_odds:
@@ -2397,114 +2204,22 @@ class FootballManager:
             'stale_closed': 0
         }
         
-        now = datetime.now()
-        fixture_ids_from_api = set()  # Для отслеживания матчей из API
-
-        # Обрабатываем каждую лигу
+        # 1. Параллельно загружаем коэффициенты всех лиг (с учетом остатка квоты The Odds API)
+        fetch_started = time.time()
+        league_results = self._fetch_leagues_odds(leagues_to_process)
+        all_matches = []
         for league_key in leagues_to_process:
-            try:
-                # print(f"[Football] Обрабатываем лигу: {league_key}")
-                
-                params = {
-                    "regions": "eu",
-                    "markets": "h2h",
-                    "oddsFormat": "decimal"
-                }
-                
-                                # Запрашиваем матчи для конкретной лиги
-                data = self._make_api_request(f"/sports/{league_key}/odds", params)
-
-                if not data:
-                    print(f"[Football] Нет матчей для лиги {league_key} или ошибка запроса")
-                    stats['leagues_failed'] += 1
-                    continue
-                
-                # print(f"[Football] Получено {len(data)} матчей из лиги {league_key}")
-                stats['leagues_processed'] += 1
-                
-                for match_data in data:
-                    fixture_id = match_data.get('id')
-                    if not fixture_id:
-                        continue
-                    
-                    fixture_ids_from_api.add(fixture_id)
-                    
-                    # Проверяем дату матча (пропускаем только матчи в прошлом)      
-                    commence_time = match_data.get('commence_time')
-                    if not commence_time:
-                        continue
-
-                    # Парсим время начала матча
-                    try:
-                        match_dt = datetime.fromisoformat(commence_time.replace('Z', '+00:00'))
-                        match_dt = match_dt.replace(tzinfo=None)
-                    except Exception as e:
-                        print(f"[Football] Ошибка парсинга времени матча: {e}")     
-                        continue
-
-                    # Извлекаем коэффициенты 1, X, 2 для всех матчей
-                    odds_1_x_2 = self._extract_odds_1_x_2(match_data)
-                    
-                    # Определяем фаворита
-                    fav_info = self._determine_favorite(match_data)
-                    
-                    # Проверяем, существует ли матч в БД
-                    match_exists = self._match_exists(fixture_id)
-                    
-                    # Пропускаем матчи в прошлом ТОЛЬКО если они уже существуют в БД
-                    # Новые матчи добавляем независимо от времени (могут быть идущие матчи, которые еще не были добавлены)
-                    if match_exists and match_dt < now:
-                        stats['skipped_past'] += 1
-                        continue
-                    
-                    # Определяем, есть ли фаворит с кэфом <= FAVORITE_THRESHOLD
-                    has_favorite = fav_info is not None and fav_info['odds'] <= FAVORITE_THRESHOLD
-                    
-                    if has_favorite:
-                        # Матч с фаворитом - заполняем все поля
-                        if match_exists:
-                            # Проверяем статус перед обновлением - не обновляем завершенные матчи
-                            match_status = self._get_match_status(fixture_id)
-                            if match_status == 'finished':
-                                print(f"[Football] Пропущен матч с фаворитом {match_data.get('home_team')} vs {match_data.get('away_team')} - матч завершен")
-                                continue
-                            # Обновляем существующий матч
-                            success = self._update_match(fixture_id, fav_info, match_data, odds_1_x_2)
-                            if success:
-                                stats['updated'] += 1
-                                # print(f"[Football] Обновлен матч с фаворитом {match_data.get('home_team')} vs {match_data.get('away_team')}, кэф: {fav_info['odds']}")
-                                pass
-                        else:
-                            # Добавляем новый матч
-                            success = self._save_match(match_data, fav_info, odds_1_x_2)
-                            if success:
-                                stats['added'] += 1
-                                # print(f"[Football] Добавлен матч с фаворитом {match_data.get('home_team')} vs {match_data.get('away_team')}, кэф: {fav_info['odds']}")
-                    else:
-                        # Матч без фаворита или с кэфом > 1.30 - заполняем только базовые поля
-                        if match_exists:
-                            # Проверяем статус перед обновлением - не обновляем завершенные матчи
-                            match_status = self._get_match_status(fixture_id)
-                            if match_status == 'finished':
-                                print(f"[Football] Пропущен матч без фаворита {match_data.get('home_team')} vs {match_data.get('away_team')} - матч завершен")
-                                continue
-                            # Обновляем существующий матч (без fav)
-                            success = self._update_match_without_fav(fixture_id, match_data, odds_1_x_2)
-                            if success:
-                                stats['updated'] += 1
-                                # print(f"[Football] Обновлен матч без фаворита {match_data.get('home_team')} vs {match_data.get('away_team')}")
-                                pass
-                        else:
-                            # Добавляем новый матч (без fav)
-                            success = self._save_match_without_fav(match_data, odds_1_x_2)
-                            if success:
-                                stats['added'] += 1
-                                # print(f"[Football] Добавлен матч без фаворита {match_data.get('home_team')} vs {match_data.get('away_team')}")
-                
-            except Exception as e:
-                print(f"[Football ERROR] Ошибка при обработке лиги {league_key}: {e}")
+            data = league_results.get(league_key)
+            if not data:
+                print(f"[Football] Нет матчей для лиги {league_key} или ошибка запроса")
                 stats['leagues_failed'] += 1
                 continue
+            stats['leagues_processed'] += 1
+            all_matches.extend(data)
+        print(f"[Football] Загружено {len(all_matches)} матчей из {stats['leagues_processed']} лиг за {time.time() - fetch_started:.1f}с")
+
+        # 2. Все матчи записываются в БД одной транзакцией
+        self._upsert_matches(all_matches, stats)
 
         # Удаляем матчи из БД, которых больше нет в API (опционально, если нужно)
         # Пока не реализовано, так как API может не возвращать все матчи
@@ -2528,6 +2243,145 @@ class FootballManager:
         
         return stats
 
+    def _fetch_leagues_odds(self, leagues: List[str]) -> Dict[str, Optional[list]]:
+        """
+        Запрашивает /sports/{league}/odds для всех лиг пулом потоков.
+        Одновременно в полете не больше запросов, чем осталось в квоте текущего ключа сверх
+        ODDS_API_SWITCH_THRESHOLD: у порога параллелизм падает до одного запроса, чтобы
+        переключение ключей в _extract_api_limits_from_headers срабатывало как при последовательной загрузке.
+        
+        Returns:
+            Словарь {league_key: список матчей или None при ошибке}
+        """
+        results: Dict[str, Optional[list]] = {}
+
+        def fetch(league_key):
+            params = {
+                "regions": "eu",
+                "markets": "h2h",
+                "oddsFormat": "decimal"
+            }
+            return self._make_api_request(f"/sports/{league_key}/odds", params)
+
+        def quota_allows(in_flight_count):
+            with self._odds_api_lock:
+                remaining = self.requests_remaining
+            return remaining is None or remaining - in_flight_count > ODDS_API_SWITCH_THRESHOLD
+
+        def collect(done):
+            for future in done:
+                league_key = in_flight.pop(future)
+                try:
+                    results[league_key] = future.result()
+                except Exception as e:
+                    print(f"[Football ERROR] Ошибка при загрузке лиги {league_key}: {e}")
+                    results[league_key] = None
+
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=max(1, ODDS_API_FETCH_WORKERS)) as executor:
+            for league_key in leagues:
+                while in_flight and (len(in_flight) >= ODDS_API_FETCH_WORKERS or not quota_allows(len(in_flight))):
+                    collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+                in_flight[executor.submit(fetch, league_key)] = league_key
+            collect(wait(in_flight).done)
+        return results
+
+    def _upsert_matches(self, matches: List[Dict], stats: Dict[str, int]):
+        """
+        Добавляет новые и обновляет существующие матчи одной транзакцией.
+        Существование и статусы всех матчей читаются одним запросом (пачками) вместо
+        отдельного соединения на каждую проверку и запись.
+        
+        Args:
+            matches: Матчи из The Odds API (всех лиг)
+            stats: Статистика sync_matches (обновляются added, updated, skipped_past)
+        """
+        now = datetime.now()
+        conn = None
+        try:
+            conn = get_football_db_connection()
+            cursor = conn.cursor()
+
+            # Статусы уже сохраненных матчей: {fixture_id: status}
+            fixture_ids = list({m.get('id') for m in matches if m.get('id')})
+            existing_statuses = {}
+            for i in range(0, len(fixture_ids), 500):
+                batch = fixture_ids[i:i + 500]
+                cursor.execute(
+                    f"SELECT fixture_id, status FROM matches WHERE fixture_id IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                existing_statuses.update({row['fixture_id']: row['status'] for row in cursor.fetchall()})
+
+            for match_data in matches:
+                fixture_id = match_data.get('id')
+                if not fixture_id:
+                    continue
+                
+                # Проверяем дату матча (пропускаем только матчи в прошлом)      
+                commence_time = match_data.get('commence_time')
+                if not commence_time:
+                    continue
+
+                # Парсим время начала матча
+                try:
+                    match_dt = datetime.fromisoformat(commence_time.replace('Z', '+00:00'))
+                    match_dt = match_dt.replace(tzinfo=None)
+                except Exception as e:
+                    print(f"[Football] Ошибка парсинга времени матча: {e}")     
+                    continue
+
+                # Извлекаем коэффициенты 1, X, 2 для всех матчей
+                odds_1_x_2 = self._extract_odds_1_x_2(match_data)
+                
+                # Определяем фаворита
+                fav_info = self._determine_favorite(match_data)
+                
+                match_exists = fixture_id in existing_statuses
+                
+                # Пропускаем матчи в прошлом ТОЛЬКО если они уже существуют в БД
+                # Новые матчи добавляем независимо от времени (могут быть идущие матчи, которые еще не были добавлены)
+                if match_exists and match_dt < now:
+                    stats['skipped_past'] += 1
+                    continue
+                
+                # Проверяем статус перед обновлением - не обновляем завершенные матчи
+                if match_exists and existing_statuses[fixture_id] == 'finished':
+                    print(f"[Football] Пропущен матч {match_data.get('home_team')} vs {match_data.get('away_team')} - матч завершен")
+                    continue
+
+                # Определяем, есть ли фаворит с кэфом <= FAVORITE_THRESHOLD
+                has_favorite = fav_info is not None and fav_info['odds'] <= FAVORITE_THRESHOLD
+                
+                if has_favorite:
+                    # Матч с фаворитом - заполняем все поля
+                    if match_exists:
+                        success = self._update_match(fixture_id, fav_info, match_data, odds_1_x_2, cursor=cursor)
+                    else:
+                        success = self._save_match(match_data, fav_info, odds_1_x_2, cursor=cursor)
+                else:
+                    # Матч без фаворита или с кэфом > 1.30 - заполняем только базовые поля
+                    if match_exists:
+                        success = self._update_match_without_fav(fixture_id, match_data, odds_1_x_2, cursor=cursor)
+                    else:
+                        success = self._save_match_without_fav(match_data, odds_1_x_2, cursor=cursor)
+
+                if success:
+                    stats['updated' if match_exists else 'added'] += 1
+                    if not match_exists:
+                        existing_statuses[fixture_id] = 'scheduled'
+
+            conn.commit()
+        except Exception as e:
+            print(f"[Football ERROR] Ошибка записи матчей в БД: {e}")
+            import traceback
+            print(traceback.format_exc())
+            if conn:
+                conn.rollback()
+        finally:
+            if conn:
+                conn.close()
+
     def collect_tomorrow_matches(self) -> int:
         """
         Алиас для sync_matches для обратной совместимости.
@@ -2715,7 +2569,8 @@ class FootballManager:
             print(traceback.format_exc())
             return None
 
-    def _save_match(self, match_data: Dict, fav_info: Dict, odds_1_x_2: Optional[Dict[str, float]] = None) -> bool:
+    def _save_match(self, match_data: Dict, fav_info: Dict, odds_1_x_2: Optional[Dict[str, float]] = None,
+                    cursor: Optional[sqlite3.Cursor] = None) -> bool:
         """
         Сохраняет матч в БД с фаворитом.
         
@@ -2723,14 +2578,16 @@ class FootballManager:
             match_data: Данные матча от The Odds API
             fav_info: Информация о фаворите
             odds_1_x_2: Словарь с коэффициентами {'odds_1': float, 'odds_x': float, 'odds_2': float}
+            cursor: Курсор общей транзакции (bulk-синхронизация); без него — свое соединение с commit
             
         Returns:
             True если успешно, False если ошибка
         """
         conn = None
         try:
-            conn = get_football_db_connection()
-            cursor = conn.cursor()
+            if cursor is None:
+                conn = get_football_db_connection()
+                cursor = conn.cursor()
             
             # The Odds API использует "id" вместо "fixture_id"
             event_id = match_data.get('id')
@@ -2796,7 +2653,8 @@ class FootballManager:
                 live_odds_2
             ))
 
-            conn.commit()
+            if conn:
+                conn.commit()
             return True
 
         except sqlite3.Error as e:
@@ -2998,7 +2856,8 @@ class FootballManager:
             if conn:
                 conn.close()
 
-    def _update_match(self, fixture_id: str, fav_info: Dict, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None) -> bool:
+    def _update_match(self, fixture_id: str, fav_info: Dict, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None,
+                      cursor: Optional[sqlite3.Cursor] = None) -> bool:
         """
         Обновляет коэффициент существующего матча с фаворитом.
 
@@ -3007,14 +2866,16 @@ class FootballManager:
             fav_info: Информация о фаворите
             match_data: Данные матча от API
             odds_1_x_2: Словарь с коэффициентами {'odds_1': float, 'odds_x': float, 'odds_2': float}
+            cursor: Курсор общей транзакции (bulk-синхронизация); без него — свое соединение с commit
 
         Returns:
             True если успешно, False если ошибка
         """
         conn = None
         try:
-            conn = get_football_db_connection()
-            cursor = conn.cursor()
+            if cursor is None:
+                conn = get_football_db_connection()
+                cursor = conn.cursor()
 
             # Обновляем коэффициент, фаворита, sport_key, коэффициенты 1/X/2 и время обновления
             # initial_odds заполняем ТОЛЬКО если он был NULL (матч ранее был без фаворита)
@@ -3045,7 +2906,8 @@ class FootballManager:
                 fixture_id
             ))
 
-            conn.commit()
+            if conn:
+                conn.commit()
             return True
 
         except sqlite3.Error as e:
@@ -3060,21 +2922,24 @@ class FootballManager:
             if conn:
                 conn.close()
 
-    def _save_match_without_fav(self, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None) -> bool:
+    def _save_match_without_fav(self, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None,
+                                cursor: Optional[sqlite3.Cursor] = None) -> bool:
         """
         Сохраняет матч в БД без фаворита (только базовые поля и коэффициенты 1, X, 2).
         
         Args:
             match_data: Данные матча от The Odds API
             odds_1_x_2: Словарь с коэффициентами {'odds_1': float, 'odds_x': float, 'odds_2': float}
+            cursor: Курсор общей транзакции (bulk-синхронизация); без него — свое соединение с commit
             
         Returns:
             True если успешно, False если ошибка
         """
         conn = None
         try:
-            conn = get_football_db_connection()
-            cursor = conn.cursor()
+            if cursor is None:
+                conn = get_football_db_connection()
+                cursor = conn.cursor()
             
             # The Odds API использует "id" вместо "fixture_id"
             event_id = match_data.get('id')
@@ -3132,7 +2997,8 @@ class FootballManager:
                 live_odds_2
             ))
 
-            conn.commit()
+            if conn:
+                conn.commit()
             return True
 
         except sqlite3.Error as e:
@@ -3147,7 +3013,8 @@ class FootballManager:
             if conn:
                 conn.close()
 
-    def _update_match_without_fav(self, fixture_id: str, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None) -> bool:
+    def _update_match_without_fav(self, fixture_id: str, match_data: Dict, odds_1_x_2: Optional[Dict[str, float]] = None,
+                                  cursor: Optional[sqlite3.Cursor] = None) -> bool:
         """
         Обновляет матч без фаворита (только базовые поля и коэффициенты 1, X, 2).
 
@@ -3155,14 +3022,16 @@ class FootballManager:
             fixture_id: ID матча из API
             match_data: Данные матча от API
             odds_1_x_2: Словарь с коэффициентами {'odds_1': float, 'odds_x': float, 'odds_2': float}
+            cursor: Курсор общей транзакции (bulk-синхронизация); без него — свое соединение с commit
 
         Returns:
             True если успешно, False если ошибка
         """
         conn = None
         try:
-            conn = get_football_db_connection()
-            cursor = conn.cursor()
+            if cursor is None:
+                conn = get_football_db_connection()
+                cursor = conn.cursor()
 
             sport_key = match_data.get('sport_key')
             
@@ -3185,7 +3054,8 @@ class FootballManager:
                 fixture_id
             ))
 
-            conn.commit()
+            if conn:
+                conn.commit()
             return True
 
         except sqlite3.Error as e:
@@ -4041,7 +3911,7 @@ class FootballManager:
                     delay = random.uniform(2.0, 4.0) * (2 ** attempt)  # Экспоненциальный backoff
                     time.sleep(delay)
                 
-                response = requests.get(url, headers=headers, timeout=30)
+                response = http_client.get(url, headers=headers, timeout=30)
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -4100,7 +3970,7 @@ class FootballManager:
                     delay = random.uniform(2.0, 4.0) * (2 ** attempt)
                     time.sleep(delay)
 
-                response = requests.get(url, headers=headers, timeout=30)
+                response = http_client.get(url, headers=headers, timeout=30)
 
                 if response.status_code == 200:
                     data = response.json()
@@ -4218,7 +4088,7 @@ class FootballManager:
                     delay = random.uniform(2.0, 4.0) * (2 ** attempt)
                     time.sleep(delay)
 
-                response = requests.get(url, headers=headers, timeout=30)
+                response = http_client.get(url, headers=headers, timeout=30)
 
                 if response.status_code == 200:
                     data = response.json()
@@ -4269,7 +4139,7 @@ class FootballManager:
         try:
             headers = SOFASCORE_DEFAULT_HEADERS.copy()
             headers["User-Agent"] = random.choice(SOFASCORE_USER_AGENTS)
-            response = requests.get(url, headers=headers, timeout=10)
+            response = http_client.get(url, headers=headers, timeout=10)
             if response.status_code != 200:
                 return None
             
@@ -6765,7 +6635,8 @@ def get_api_limits() -> Dict[str, Any]:
         return {
             'requests_remaining': manager.requests_remaining,
             'requests_used': manager.requests_used,
-            'requests_last_cost': manager.requests_last_cost
+            'requests_last_cost': manager.requests_last_cost,
+            'cache': odds_api_cache.snapshot()
         }
     except Exception as e:
         print(f"[Football ERROR] Ошибка получения лимитов API: {e}")
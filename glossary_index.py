@@ -0,0 +1,238 @@
+# --- START OF FILE glossary_index.py ---
+
+"""
+Глоссарий книги (результат этапа 'analyze') как индекс для отбора записей под конкретный чанк.
+
+Этап анализа возвращает две markdown-таблицы:
+  | Term | Proposed Translation | Rationale |
+  | Name | Recommended Translation | Gender (m/f) | Declension Rule & Notes |
+Раньше весь текст таблиц (часто десятки KB) вставлялся в промпт каждого чанка. Здесь таблицы
+разбираются один раз в записи (термин/имя -> перевод, род, примечания), по всем вариантам написания
+строится автомат Ахо-Корасик, и в промпт чанка попадают только записи, реально встречающиеся в нем.
+
+Если текст анализа не удалось разобрать как таблицы, используется полный текст (как раньше).
+"""
+
+import re
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Tuple
+
+# Оценка токенов по символам — то же соотношение, что в _get_chunk_limit_for_operation
+CHARS_PER_TOKEN = 3
+INDEX_CACHE_SIZE = 16
+# Минимальная длина варианта написания; короче — только целым словом
+MIN_PREFIX_MATCH_LENGTH = 4
+# Части составных имен, по которым не ищем (встречаются везде)
+_NAME_PART_STOPWORDS = {'the', 'of', 'and', 'mr', 'mrs', 'ms', 'dr', 'sir', 'lady', 'lord', 'von', 'van', 'de', 'la', 'le', 'del', 'da'}
+
+_SEPARATOR_ROW_RE = re.compile(r'^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?\s*$')
+_MARKDOWN_RE = re.compile(r'[*_`]+')
+_PARENTHESES_RE = re.compile(r'\(([^)]*)\)')
+_WORD_RE = re.compile(r"[^\W\d_][\w'’-]*", re.UNICODE)
+
+
+class GlossaryEntry:
+    __slots__ = ('table', 'source', 'row', 'translation', 'gender', 'notes', 'variants')
+
+    def __init__(self, table: int, source: str, row: str, cells: List[str], is_name: bool):
+        self.table = table # индекс таблицы (для рендера с исходными заголовками)
+        self.source = source
+        self.row = row # исходная строка таблицы
+        self.translation = cells[1] if len(cells) > 1 else ''
+        self.gender = cells[2] if is_name and len(cells) > 2 else None
+        self.notes = cells[-1] if len(cells) > 2 else ''
+        self.variants = _source_variants(source, is_name)
+
+
+def _split_row(line: str) -> List[str]:
+    return [cell.strip() for cell in line.strip().strip('|').split('|')]
+
+
+def _source_variants(source: str, is_name: bool) -> List[str]:
+    """Варианты написания термина/имени для поиска в тексте (нижний регистр)."""
+    clean = _MARKDOWN_RE.sub('', source).strip()
+    variants = set()
+    # "Основное (альтернативное)" и "A / B" — ищем каждую часть
+    for part in re.split(r'\s+/\s+', _PARENTHESES_RE.sub('', clean)) + _PARENTHESES_RE.findall(clean):
+        part = part.strip(' "\'«»“”')
+        if part:
+            variants.add(part.lower())
+    if is_name:
+        # В тексте персонажа чаще называют по имени или фамилии, а не полностью
+        for word in _WORD_RE.findall(_PARENTHESES_RE.sub('', clean)):
+            if len(word) >= 3 and word[0].isupper() and word.lower() not in _NAME_PART_STOPWORDS:
+                variants.add(word.lower())
+    return sorted(variants)
+
+
+class _AhoCorasick:
+    """Автомат Ахо-Корасик: все вхождения набора образцов за один проход по тексту."""
+
+    def __init__(self, patterns: Dict[str, List[int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[Tuple[int, List[int]]]] = [[]] # (длина образца, id записей)
+        for pattern, entry_ids in patterns.items():
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = nxt
+            self.output[node].append((len(pattern), entry_ids))
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nxt] = self.goto[fallback].get(ch, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """Генерирует (позиция конца, длина образца, id записей)."""
+        node = 0
+        for pos, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, entry_ids in self.output[node]:
+                yield pos, length, entry_ids
+
+
+class GlossaryIndex:
+    def __init__(self, glossary_text: str):
+        self.full_text = glossary_text
+        self.headers: List[Tuple[str, str]] = [] # (строка заголовка, строка-разделитель) каждой таблицы
+        self.entries: List[GlossaryEntry] = []
+        self._parse(glossary_text)
+
+        patterns: Dict[str, List[int]] = {}
+        for entry_id, entry in enumerate(self.entries):
+            for variant in entry.variants:
+                patterns.setdefault(variant, []).append(entry_id)
+        self.matcher = _AhoCorasick(patterns) if patterns else None
+
+    def _parse(self, text: str):
+        table = -1
+        is_name_table = False
+        expect_separator = False
+        for line in (text or '').splitlines():
+            stripped = line.strip()
+            if not stripped.startswith('|'):
+                expect_separator = False
+                continue
+            if expect_separator and _SEPARATOR_ROW_RE.match(stripped):
+                self.headers[table] = (self.headers[table][0], stripped)
+                expect_separator = False
+                continue
+            cells = _split_row(stripped)
+            first = cells[0].lower() if cells else ''
+            if first in ('term', 'name') or (len(cells) > 1 and 'translation' in cells[1].lower()):
+                # Заголовок новой таблицы
+                table += 1
+                is_name_table = first == 'name' or len(cells) >= 4
+                self.headers.append((stripped, '|' + '|'.join('---' for _ in cells) + '|'))
+                expect_separator = True
+                continue
+            if table < 0 or _SEPARATOR_ROW_RE.match(stripped) or not cells or not cells[0]:
+                continue
+            self.entries.append(GlossaryEntry(table, cells[0], stripped, cells, is_name_table))
+
+    def select(self, text: str) -> List[GlossaryEntry]:
+        """Записи, встречающиеся в тексте, в порядке глоссария."""
+        if not self.matcher or not text:
+            return []
+        lowered = text.lower()
+        found = set()
+        for end, length, entry_ids in self.matcher.iter_matches(lowered):
+            start = end - length + 1
+            # Начало — на границе слова; конец — тоже, но длинным вариантам разрешаем окончание (Drone -> Drones)
+            if start > 0 and lowered[start - 1].isalnum():
+                continue
+            if end + 1 < len(lowered) and lowered[end + 1].isalnum() and length < MIN_PREFIX_MATCH_LENGTH:
+                continue
+            found.update(entry_ids)
+        return [self.entries[i] for i in sorted(found)]
+
+    def render(self, entries: List[GlossaryEntry]) -> str:
+        """Markdown-таблицы глоссария только с указанными записями (исходные заголовки таблиц)."""
+        parts = []
+        for table, (header, separator) in enumerate(self.headers):
+            rows = [entry.row for entry in entries if entry.table == table]
+            if rows:
+                parts.append("\n".join([header, separator] + rows))
+        return "\n\n".join(parts)
+
+
+_index_cache: "OrderedDict[str, GlossaryIndex]" = OrderedDict()
+_index_cache_lock = threading.Lock()
+_savings: Dict[str, Dict[str, int]] = {}
+_savings_lock = threading.Lock()
+
+
+def get_glossary_index(glossary_text: str) -> GlossaryIndex:
+    """Индекс глоссария (разбирается один раз на текст анализа и кэшируется)."""
+    key = hashlib.sha1(glossary_text.encode('utf-8')).hexdigest()
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+        if index is not None:
+            _index_cache.move_to_end(key)
+            return index
+    index = GlossaryIndex(glossary_text)
+    with _index_cache_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def prune_glossary_for_text(glossary_text: str, text: str, book_id: Optional[str] = None) -> str:
+    """
+    Глоссарий только с записями, встречающимися в text. Пустая строка — ни одна запись не встречается.
+    Если таблицы не распознаны, возвращается полный текст глоссария.
+    """
+    if not glossary_text:
+        return ''
+    index = get_glossary_index(glossary_text)
+    if not index.entries:
+        pruned = glossary_text
+        selected_count = 0
+    else:
+        selected = index.select(text)
+        selected_count = len(selected)
+        pruned = index.render(selected)
+    record_glossary_usage(book_id, len(glossary_text), len(pruned), len(index.entries), selected_count)
+    return pruned
+
+
+def record_glossary_usage(book_id: Optional[str], full_chars: int, sent_chars: int, entries_total: int, entries_sent: int):
+    with _savings_lock:
+        stats = _savings.setdefault(book_id or 'unknown', {
+            'chunks': 0, 'full_chars': 0, 'sent_chars': 0, 'entries_total': 0, 'entries_sent': 0
+        })
+        stats['chunks'] += 1
+        stats['full_chars'] += full_chars
+        stats['sent_chars'] += sent_chars
+        stats['entries_total'] += entries_total
+        stats['entries_sent'] += entries_sent
+
+
+def get_glossary_savings_stats() -> Dict[str, Dict[str, float]]:
+    """Экономия входных токенов на глоссарии по книгам (с момента запуска процесса)."""
+    with _savings_lock:
+        snapshot = {book_id: dict(stats) for book_id, stats in _savings.items()}
+    for stats in snapshot.values():
+        saved_chars = stats['full_chars'] - stats['sent_chars']
+        stats['est_tokens_saved'] = saved_chars // CHARS_PER_TOKEN
+        stats['saved_percent'] = round(100 * saved_chars / stats['full_chars'], 1) if stats['full_chars'] else 0.0
+    return snapshot
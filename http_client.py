@@ -0,0 +1,64 @@
+# --- START OF FILE http_client.py ---
+
+"""
+Общий HTTP-клиент для вызовов внешних API (LLM-провайдеры, YouTube, Odds API, SofaScore и т.д.).
+
+Вместо requests.post/get (новое TCP+TLS соединение на каждый вызов) используется один
+requests.Session на процесс с пулом keep-alive соединений. Session разделяется между потоками;
+cookies не сохраняются, чтобы вызовы разных модулей не влияли друг на друга.
+"""
+
+import os
+import threading
+import http.cookiejar
+import requests
+from requests.adapters import HTTPAdapter
+
+# Сколько разных хостов держим в пуле по умолчанию и сколько соединений на хост.
+HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "16"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "8"))
+
+# Хосты с большим числом параллельных запросов (секции/чанки книг идут одновременно).
+HOST_POOL_MAXSIZE = {
+    "https://openrouter.ai": int(os.getenv("HTTP_POOL_MAXSIZE_OPENROUTER", "16")),
+    "https://api.literouter.com": int(os.getenv("HTTP_POOL_MAXSIZE_LITEROUTER", "8")),
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+    # Не храним cookies между вызовами: сессия общая для всех модулей и потоков
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+    default_adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+
+    for host_prefix, pool_maxsize in HOST_POOL_MAXSIZE.items():
+        session.mount(host_prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+
+    print(f"[HttpClient] Создана общая HTTP-сессия (пул: {HTTP_POOL_HOSTS} хостов x {HTTP_POOL_MAXSIZE} соединений)")
+    return session
+
+
+def get_session() -> requests.Session:
+    """Возвращает общую для процесса HTTP-сессию (создается при первом вызове)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get(url, **kwargs) -> requests.Response:
+    """Аналог requests.get через общий пул соединений."""
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    """Аналог requests.post через общий пул соединений."""
+    return get_session().post(url, **kwargs)
@@ -1,5 +1,6 @@
 # --- START OF FILE location_finder.py ---
 import requests
+import http_client
 import google.generativeai as genai
 import os
 import traceback
@@ -134,7 +135,7 @@ class LocationFinderAI:
             
             #print(f"{LF_PRINT_PREFIX} [{provider_name}] Отправка запроса к {model_name} для '{person_name}'...")
             
-            response = requests.post(
+            response = http_client.post(
                 f"{api_url}/chat/completions",
                 headers=headers,
                 json=payload,
@@ -367,7 +368,7 @@ def _fetch_news(person_name: str, num_articles: int = 100, days_ago: int = NEWS_
     headers = {'User-Agent': 'LocationFinderApp/1.0 (epub_translator project; paulbunkie@gmail.com)'}
     #print(f"{LF_PRINT_PREFIX} Запрос новостей для '{person_name}' с NewsAPI (с {from_date_str}). Params: qInTitle={params.get('qInTitle')}, pageSize={params.get('pageSize')}")
     try:
-        response = requests.get(NEWS_API_URL, params=params, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+        response = http_client.get(NEWS_API_URL, params=params, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
         #print(f"{LF_PRINT_PREFIX} NewsAPI для '{person_name}' ответил статусом: {response.status_code}")
         response.raise_for_status()
         data = response.json()
@@ -401,7 +402,7 @@ def _geocode_location(location_name: str):
     #print(f"{LF_PRINT_PREFIX} Геокодинг для '{location_name}'...")
     try:
         time.sleep(1.1)
-        response = requests.get(nominatim_url, params=params, headers=headers, timeout=10)
+        response = http_client.get(nominatim_url, params=params, headers=headers, timeout=10)
         response.raise_for_status()
         data = response.json()
         if data and isinstance(data, list) and data[0]:
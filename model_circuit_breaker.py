@@ -0,0 +1,134 @@
+# --- START OF FILE model_circuit_breaker.py ---
+
+"""
+Circuit breaker и оценка "здоровья" моделей для fallback-цепочки WorkflowTranslator.
+
+Для каждой модели хранится скользящее окно последних вызовов (успех + длительность).
+Состояния:
+  closed    — модель используется как обычно;
+  open      — модель недавно стабильно падала, fallback-контроллер ее пропускает;
+  half_open — после паузы пропускается ОДИН пробный запрос: успех закрывает breaker,
+              неудача снова открывает его с удвоенной паузой.
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import Dict, Any
+
+WINDOW_SIZE = 20 # сколько последних вызовов учитывать
+CONSECUTIVE_FAILURES_TO_OPEN = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "3"))
+MIN_CALLS_FOR_RATE = 5 # минимум вызовов в окне для оценки по доле успехов
+MIN_SUCCESS_RATE = 0.3 # ниже — открываем breaker
+OPEN_SECONDS_BASE = int(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "120"))
+OPEN_SECONDS_MAX = 1800
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class _ModelCircuit:
+    def __init__(self):
+        self.state = STATE_CLOSED
+        self.calls = deque(maxlen=WINDOW_SIZE) # (success, latency_seconds)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_seconds = OPEN_SECONDS_BASE
+        self.probe_in_flight = False
+
+    def success_rate(self) -> float:
+        if not self.calls:
+            return 1.0
+        return sum(1 for ok, _ in self.calls if ok) / len(self.calls)
+
+    def avg_latency(self) -> float:
+        latencies = [latency for ok, latency in self.calls if ok]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def health_score(self) -> float:
+        """0..1: доля успехов, слегка штрафуемая за медленные ответы (>60с)."""
+        latency_penalty = min(0.5, self.avg_latency() / 600)
+        return round(max(0.0, self.success_rate() - latency_penalty), 3)
+
+
+class ModelCircuitBreaker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.circuits: Dict[str, _ModelCircuit] = {}
+
+    def _get(self, model_name: str) -> _ModelCircuit:
+        circuit = self.circuits.get(model_name)
+        if circuit is None:
+            circuit = self.circuits[model_name] = _ModelCircuit()
+        return circuit
+
+    def allow_request(self, model_name: str) -> bool:
+        """Можно ли сейчас отправить запрос модели. В half_open резервирует единственную пробу."""
+        with self.lock:
+            circuit = self._get(model_name)
+            if circuit.state == STATE_CLOSED:
+                return True
+            if circuit.state == STATE_OPEN:
+                if time.time() - circuit.opened_at < circuit.open_seconds:
+                    return False
+                circuit.state = STATE_HALF_OPEN
+                print(f"[CircuitBreaker] {model_name}: half_open, пробный запрос")
+            if circuit.probe_in_flight:
+                return False
+            circuit.probe_in_flight = True
+            return True
+
+    def record_success(self, model_name: str, latency_seconds: float):
+        with self.lock:
+            circuit = self._get(model_name)
+            circuit.calls.append((True, latency_seconds))
+            circuit.consecutive_failures = 0
+            circuit.probe_in_flight = False
+            if circuit.state != STATE_CLOSED:
+                print(f"[CircuitBreaker] {model_name}: закрыт после успешной пробы")
+            circuit.state = STATE_CLOSED
+            circuit.open_seconds = OPEN_SECONDS_BASE
+
+    def record_failure(self, model_name: str, latency_seconds: float):
+        with self.lock:
+            circuit = self._get(model_name)
+            circuit.calls.append((False, latency_seconds))
+            circuit.consecutive_failures += 1
+            was_probe = circuit.state == STATE_HALF_OPEN
+            circuit.probe_in_flight = False
+
+            if was_probe:
+                circuit.open_seconds = min(OPEN_SECONDS_MAX, circuit.open_seconds * 2)
+            elif not (circuit.consecutive_failures >= CONSECUTIVE_FAILURES_TO_OPEN or
+                      (len(circuit.calls) >= MIN_CALLS_FOR_RATE and circuit.success_rate() < MIN_SUCCESS_RATE)):
+                return
+            circuit.state = STATE_OPEN
+            circuit.opened_at = time.time()
+            print(f"[CircuitBreaker] {model_name}: открыт на {circuit.open_seconds}с "
+                  f"(ошибок подряд: {circuit.consecutive_failures}, успехов: {circuit.success_rate():.0%})")
+
+    def release(self, model_name: str):
+        """Снимает резерв пробы без оценки (результат не говорит о здоровье модели, например SAFETY)."""
+        with self.lock:
+            circuit = self._get(model_name)
+            circuit.probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            now = time.time()
+            return {
+                model_name: {
+                    'state': c.state,
+                    'health': c.health_score(),
+                    'success_rate': round(c.success_rate(), 3),
+                    'avg_latency_s': round(c.avg_latency(), 1),
+                    'consecutive_failures': c.consecutive_failures,
+                    'reopen_in_s': round(max(0.0, c.opened_at + c.open_seconds - now), 1) if c.state == STATE_OPEN else 0,
+                }
+                for model_name, c in self.circuits.items()
+            }
+
+
+circuit_breaker = ModelCircuitBreaker()
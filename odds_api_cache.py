@@ -0,0 +1,132 @@
+# --- START OF FILE odds_api_cache.py ---
+
+"""
+Кэш ответов The Odds API (каждый запрос к odds-эндпоинтам тратит квоту ключа).
+
+Ключ кэша — эндпоинт + параметры запроса без apiKey, поэтому ротация ключей его не сбрасывает.
+Срок свежести задается политикой по типу эндпоинта: коэффициенты лиги до матча меняются медленно,
+live-коэффициенты конкретного события — быстро. Одновременные запросы одного ключа объединяются:
+в API уходит один запрос, остальные потоки ждут его результат.
+
+The Odds API не отдает ETag/Last-Modified, поэтому условные запросы (304) невозможны —
+экономия квоты достигается только за счет TTL.
+"""
+
+import os
+import re
+import time
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Сроки свежести (секунды) по типам эндпоинтов
+ODDS_CACHE_TTL_SPORTS = int(os.getenv("ODDS_CACHE_TTL_SPORTS", "3600"))       # /sports — список лиг
+ODDS_CACHE_TTL_PREMATCH = int(os.getenv("ODDS_CACHE_TTL_PREMATCH", "300"))    # /sports/{league}/odds
+ODDS_CACHE_TTL_LIVE = int(os.getenv("ODDS_CACHE_TTL_LIVE", "30"))             # /sports/{league}/events/{id}/odds
+ODDS_CACHE_MAX_ENTRIES = int(os.getenv("ODDS_CACHE_MAX_ENTRIES", "500"))
+# Сколько ждать результата чужого запроса с тем же ключом, прежде чем идти в API самому
+ODDS_CACHE_COALESCE_TIMEOUT = 60
+
+_ENDPOINT_POLICIES = [
+    (re.compile(r"^/sports/?$"), ODDS_CACHE_TTL_SPORTS),
+    (re.compile(r"^/sports/[^/]+/odds/?$"), ODDS_CACHE_TTL_PREMATCH),
+    (re.compile(r"^/sports/[^/]+/events/[^/]+/odds/?$"), ODDS_CACHE_TTL_LIVE),
+]
+
+
+def ttl_for_endpoint(endpoint: str) -> int:
+    """Срок свежести ответа эндпоинта; 0 — не кэшировать."""
+    for pattern, ttl in _ENDPOINT_POLICIES:
+        if pattern.match(endpoint):
+            return ttl
+    return 0
+
+
+def make_cache_key(endpoint: str, params: Optional[dict]) -> Tuple:
+    """Ключ кэша: эндпоинт и отсортированные параметры без apiKey."""
+    return (endpoint,) + tuple(sorted((k, str(v)) for k, v in (params or {}).items() if k != 'apiKey'))
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class OddsApiCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[Tuple, Tuple[float, Any]] = {} # key -> (expires_at, data)
+        self.in_flight: Dict[Tuple, _InFlight] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'requests_saved': 0}
+
+    def get_or_fetch(self, endpoint: str, params: Optional[dict], fetch: Callable[[], Any]) -> Any:
+        """
+        Возвращает свежий ответ из кэша или вызывает fetch() (один раз на ключ при конкурентных вызовах).
+        Кэшируются только непустые ответы (None — ошибка, ее не запоминаем).
+        Возвращаемые данные общие для всех вызывающих — их нельзя изменять.
+        """
+        ttl = ttl_for_endpoint(endpoint)
+        if ttl <= 0:
+            return fetch()
+
+        key = make_cache_key(endpoint, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.stats['hits'] += 1
+                self.stats['requests_saved'] += 1
+                return entry[1]
+            waiter = self.in_flight.get(key)
+            if waiter is None:
+                waiter = self.in_flight[key] = _InFlight()
+                owner = True
+                self.stats['misses'] += 1
+            else:
+                owner = False
+                self.stats['coalesced'] += 1
+
+        if not owner:
+            # Тот же запрос уже выполняется в другом потоке — ждем его результат (в том числе ошибку)
+            if waiter.event.wait(ODDS_CACHE_COALESCE_TIMEOUT):
+                with self.lock:
+                    self.stats['requests_saved'] += 1
+                return waiter.result
+            return fetch()
+
+        result = None
+        try:
+            result = fetch()
+        finally:
+            with self.lock:
+                if result is not None:
+                    if len(self.entries) >= ODDS_CACHE_MAX_ENTRIES:
+                        self._evict(time.monotonic())
+                    self.entries[key] = (time.monotonic() + ttl, result)
+                waiter.result = result
+                self.in_flight.pop(key, None)
+            waiter.event.set()
+        return result
+
+    def _evict(self, now: float):
+        """Удаляет просроченные записи, а если их нет — самую старую (вызывать под self.lock)."""
+        expired = [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+        if not expired and self.entries:
+            del self.entries[min(self.entries, key=lambda k: self.entries[k][0])]
+
+    def invalidate(self, endpoint: Optional[str] = None):
+        """Сбрасывает кэш целиком или записи одного эндпоинта."""
+        with self.lock:
+            if endpoint is None:
+                self.entries.clear()
+            else:
+                for key in [k for k in self.entries if k[0] == endpoint]:
+                    del self.entries[key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries))
+
+
+odds_api_cache = OddsApiCache()
@@ -0,0 +1,176 @@
+# --- START OF FILE provider_rate_limiter.py ---
+
+"""
+Адаптивный ограничитель частоты запросов к LLM-провайдерам (общий для всех потоков процесса).
+
+Для каждого провайдера и для каждой модели держится token bucket. Скорость меняется по AIMD:
+успешный ответ — аддитивный рост, 429/5xx/таймаут — мультипликативное снижение и сброс накопленных токенов.
+Заголовки Retry-After и X-RateLimit-Remaining/X-RateLimit-Reset блокируют бакет до указанного времени.
+"""
+
+import os
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any
+
+# Стартовая скорость (запросов в секунду) и размер всплеска для провайдеров.
+# LiteRouter раньше ограничивался жестким sleep(5) перед каждой попыткой — стартуем с той же скорости.
+PROVIDER_RATE_DEFAULTS = {
+    'literouter': (float(os.getenv("RATE_LIMIT_LITEROUTER_RPS", "0.2")), 1),
+    'openrouter': (float(os.getenv("RATE_LIMIT_OPENROUTER_RPS", "2")), 4),
+    'vertex': (float(os.getenv("RATE_LIMIT_VERTEX_RPS", "2")), 4),
+    'google': (float(os.getenv("RATE_LIMIT_GOOGLE_RPS", "1")), 2),
+}
+DEFAULT_RATE = (1.0, 2)
+
+MIN_RATE = 0.02 # не реже одного запроса в 50 секунд
+MAX_RATE = float(os.getenv("RATE_LIMIT_MAX_RPS", "10"))
+ADDITIVE_INCREASE = 0.05 # +rps на каждый успешный ответ
+MODEL_DECREASE_FACTOR = 0.5 # модель, получившая 429/5xx
+PROVIDER_DECREASE_FACTOR = 0.75 # провайдер целиком (лимит мог быть на аккаунт)
+MAX_BLOCK_SECONDS = 600 # не верим Retry-After больше 10 минут
+THROTTLE_STATUS_CODES = (429, 500, 502, 503, 504, 522, 524)
+
+
+class _Bucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.successes = 0
+        self.throttled = 0
+        self.last_status = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — можно сразу)."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        self._refill(now)
+        return {
+            'rate_rps': round(self.rate, 3),
+            'tokens': round(self.tokens, 2),
+            'blocked_for_s': round(max(0.0, self.blocked_until - now), 1),
+            'successes': self.successes,
+            'throttled': self.throttled,
+            'last_status': self.last_status,
+        }
+
+
+class AdaptiveRateLimiter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.provider_buckets: Dict[str, _Bucket] = {}
+        self.model_buckets: Dict[str, _Bucket] = {}
+
+    def _get_buckets(self, provider: str, model_name: str):
+        """Бакеты провайдера и модели (вызывать под self.lock)."""
+        rate, capacity = PROVIDER_RATE_DEFAULTS.get(provider, DEFAULT_RATE)
+        provider_bucket = self.provider_buckets.get(provider)
+        if provider_bucket is None:
+            provider_bucket = self.provider_buckets[provider] = _Bucket(rate, capacity)
+        model_bucket = self.model_buckets.get(model_name)
+        if model_bucket is None:
+            model_bucket = self.model_buckets[model_name] = _Bucket(rate, capacity)
+        return provider_bucket, model_bucket
+
+    def acquire(self, provider: str, model_name: str):
+        """Блокирует поток, пока бакеты провайдера и модели не разрешат запрос."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                provider_bucket, model_bucket = self._get_buckets(provider, model_name)
+                now = time.monotonic()
+                wait = max(provider_bucket.wait_time(now), model_bucket.wait_time(now))
+                if wait <= 0:
+                    provider_bucket.tokens -= 1
+                    model_bucket.tokens -= 1
+                    break
+            # Спим частями, чтобы успевать за изменениями (например, снятием блокировки)
+            sleep_for = min(wait, 5.0)
+            time.sleep(sleep_for)
+            waited += sleep_for
+        if waited >= 1:
+            print(f"[RateLimiter] {provider}/{model_name}: ожидание {waited:.1f}с перед запросом")
+
+    def record(self, provider: str, model_name: str, status_code: Optional[int], headers=None):
+        """
+        Учитывает результат запроса. status_code=None — таймаут/сетевая ошибка (считается как перегрузка).
+        """
+        block_seconds = _parse_block_seconds(status_code, headers)
+        with self.lock:
+            provider_bucket, model_bucket = self._get_buckets(provider, model_name)
+            now = time.monotonic()
+            for bucket in (provider_bucket, model_bucket):
+                bucket.last_status = status_code
+
+            if status_code is not None and status_code < 400:
+                for bucket in (provider_bucket, model_bucket):
+                    bucket.successes += 1
+                    bucket.rate = min(MAX_RATE, bucket.rate + ADDITIVE_INCREASE)
+            elif status_code is None or status_code in THROTTLE_STATUS_CODES:
+                model_bucket.throttled += 1
+                provider_bucket.throttled += 1
+                model_bucket.rate = max(MIN_RATE, model_bucket.rate * MODEL_DECREASE_FACTOR)
+                provider_bucket.rate = max(MIN_RATE, provider_bucket.rate * PROVIDER_DECREASE_FACTOR)
+                # Накопленный всплеск сгорает: иначе следующие capacity запросов уйдут сразу, несмотря на снижение скорости
+                for bucket in (provider_bucket, model_bucket):
+                    bucket._refill(now)
+                    bucket.tokens = min(bucket.tokens, 0.0)
+
+            if block_seconds:
+                model_bucket.blocked_until = max(model_bucket.blocked_until, now + block_seconds)
+                print(f"[RateLimiter] {provider}/{model_name}: пауза {block_seconds:.1f}с по заголовкам ответа (статус {status_code})")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Текущее состояние для /admin/system_status."""
+        with self.lock:
+            now = time.monotonic()
+            return {
+                'providers': {name: b.snapshot(now) for name, b in self.provider_buckets.items()},
+                'models': {name: b.snapshot(now) for name, b in self.model_buckets.items()},
+            }
+
+
+def _parse_block_seconds(status_code: Optional[int], headers) -> float:
+    """Сколько секунд не слать запросы по заголовкам Retry-After / X-RateLimit-*."""
+    if not headers:
+        return 0.0
+    try:
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            return min(MAX_BLOCK_SECONDS, max(0.0, seconds))
+
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset and float(remaining) <= 0:
+            reset_value = float(reset)
+            if reset_value > 1e12: # epoch в миллисекундах (OpenRouter)
+                seconds = reset_value / 1000 - time.time()
+            elif reset_value > 1e9: # epoch в секундах
+                seconds = reset_value - time.time()
+            else: # относительное значение в секундах
+                seconds = reset_value
+            return min(MAX_BLOCK_SECONDS, max(0.0, seconds))
+    except Exception as e:
+        print(f"[RateLimiter] Не удалось разобрать заголовки лимитов: {e}")
+    return 0.0
+
+
+rate_limiter = AdaptiveRateLimiter()
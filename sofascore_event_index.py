@@ -0,0 +1,195 @@
+# --- START OF FILE sofascore_event_index.py ---
+
+"""
+Индекс событий SofaScore по нормализованным названиям команд.
+
+Раньше каждый матч сопоставлялся перебором всех событий дня: для каждого события заново
+нормализовались все варианты названий (name, shortName, переводы) и сравнивались все пары
+home×away подстроками. Индекс строится один раз на список событий (результат
+_fetch_sofascore_events) и отвечает на запрос за время, не зависящее от числа событий:
+
+  - точный словарь: нормализованный вариант названия -> [(позиция события, сторона)];
+  - "вариант содержится в запросе": перебираются подстроки запроса длиной >= 3 (их мало);
+  - "запрос содержится в варианте": кандидаты из инвертированного индекса триграмм, затем проверка.
+
+Семантика совпадений та же, что у прежнего перебора (частичное совпадение — подстрока
+в любую сторону, минимум 3 символа), при нескольких кандидатах берется первое событие в списке.
+"""
+
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Dict, List, Optional, Set, Tuple
+
+MIN_PARTIAL_LENGTH = 3 # частичное совпадение только для названий от 3 символов
+NORMALIZE_CACHE_SIZE = 8192
+
+HOME = 'home'
+AWAY = 'away'
+
+# Распространенные префиксы футбольных клубов (проверяются по порядку, как раньше)
+_TEAM_NAME_PREFIXES = [
+    'sk ', 'fc ', 'sc ', 'cf ', 'ac ', 'as ', 'rc ', 'fk ', 'if ', 'bk ',
+    '1. ', '1 ', '2. ', '3. ', 'cd ', 'ud ', 'cf ', 'sd ', 'fc. ', 'sc. ',
+    'royale ', 'royal ', 'r. ', 'r ', 'h. ', 'h ', 'v. ', 'v ', 'vs ', 'vs. ',
+    'the ', 'of ', 'de ', 'la ', 'le ', 'los ', 'las ', 'el ', 'der ', 'die ', 'das ',
+    'afc ', 'cfc ', 'dfc ', 'sfc ', 'pfc ', 'kfc ', 'bfc ', 'vfc ', 'tsv ', 'fsv ',
+    'vv ', 'vv. ', 'vvv ', 'vvv-', 'vvv. ', 'vvv ', 'vvv-', 'vvv. '
+]
+
+# Датские, норвежские, немецкие, испанские, французские и т.д. буквы -> латиница.
+# Помогает сопоставить "Copenhagen" с "København", "München" с "Munich" и т.п.
+_TEAM_NAME_CHAR_TABLE = str.maketrans({
+    'ø': 'o', 'æ': 'ae', 'å': 'aa', 'ö': 'o', 'ü': 'u', 'ä': 'a', 'ß': 'ss',
+    'ñ': 'n', 'ç': 'c', 'é': 'e', 'è': 'e', 'ê': 'e', 'ë': 'e',
+    'à': 'a', 'á': 'a', 'â': 'a', 'ã': 'a', 'í': 'i', 'î': 'i', 'ï': 'i',
+    'ó': 'o', 'ô': 'o', 'õ': 'o', 'ú': 'u', 'û': 'u', 'ý': 'y',
+})
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_team_name(name: str) -> str:
+    """
+    Нормализует название команды для сравнения: нижний регистр, без префиксов клуба,
+    национальные буквы -> латиница, только буквы и цифры. Результат кэшируется.
+    """
+    if not name:
+        return ""
+
+    normalized = name.lower().strip()
+    for prefix in _TEAM_NAME_PREFIXES:
+        if normalized.startswith(prefix):
+            normalized = normalized[len(prefix):].strip()
+
+    normalized = normalized.translate(_TEAM_NAME_CHAR_TABLE)
+    return ''.join(c for c in normalized if c.isalnum())
+
+
+def team_name_variants(team_obj: Dict) -> List[str]:
+    """Все варианты названия команды SofaScore: name, shortName и переводы."""
+    variants = []
+    if team_obj.get('name'):
+        variants.append(team_obj['name'])
+    if team_obj.get('shortName'):
+        variants.append(team_obj['shortName'])
+    translations = (team_obj.get('fieldTranslations') or {}).get('nameTranslation') or {}
+    variants.extend(t for t in translations.values() if t)
+    return variants
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def sofascore_time_matches(match_datetime: datetime, start_timestamp) -> bool:
+    """
+    Время события совпадает с временем матча: в пределах 5 минут или с разницей
+    на целое число часов ±5 минут (расхождение часовых поясов).
+    """
+    event_datetime = datetime.fromtimestamp(start_timestamp, tz=timezone.utc)
+    time_diff_minutes = abs((match_datetime - event_datetime).total_seconds()) / 60
+    hours_diff = round(time_diff_minutes / 60)
+    minutes_remainder = abs(time_diff_minutes - hours_diff * 60)
+    return minutes_remainder <= 5 or time_diff_minutes <= 5
+
+
+class SofascoreEventIndex:
+    """Индекс одного списка событий SofaScore (обычно — событий одной даты)."""
+
+    def __init__(self, events: List[Dict]):
+        self.events = events
+        self.variants: Dict[str, Set[Tuple[int, str]]] = {}
+        self.trigram_index: Dict[str, Set[str]] = {}
+
+        for pos, event in enumerate(events):
+            if not event.get('id'):
+                continue
+            home_team_obj = event.get('homeTeam') or {}
+            away_team_obj = event.get('awayTeam') or {}
+            if not home_team_obj or not away_team_obj:
+                continue
+            for side, team_obj in ((HOME, home_team_obj), (AWAY, away_team_obj)):
+                for variant in team_name_variants(team_obj):
+                    norm = normalize_team_name(variant)
+                    postings = self.variants.get(norm)
+                    if postings is None:
+                        postings = self.variants[norm] = set()
+                        for trigram in _trigrams(norm):
+                            self.trigram_index.setdefault(trigram, set()).add(norm)
+                    postings.add((pos, side))
+
+    def __len__(self):
+        return len(self.events)
+
+    def exact(self, name_norm: str) -> Set[Tuple[int, str]]:
+        """(позиция, сторона) событий с вариантом названия, равным name_norm."""
+        return self.variants.get(name_norm, set())
+
+    def similar(self, name_norm: str) -> Set[Tuple[int, str]]:
+        """
+        (позиция, сторона) событий с вариантом, равным name_norm или частично совпадающим:
+        один содержит другой и оба не короче MIN_PARTIAL_LENGTH.
+        """
+        found = set(self.exact(name_norm))
+        if len(name_norm) < MIN_PARTIAL_LENGTH:
+            return found
+
+        # Вариант — подстрока запроса: проверяем все подстроки запроса нужной длины
+        n = len(name_norm)
+        for start in range(n - MIN_PARTIAL_LENGTH + 1):
+            for end in range(start + MIN_PARTIAL_LENGTH, n + 1):
+                postings = self.variants.get(name_norm[start:end])
+                if postings:
+                    found |= postings
+
+        # Запрос — подстрока варианта: пересечение списков триграмм, начиная с самого короткого
+        candidate_lists = []
+        for trigram in _trigrams(name_norm):
+            variants = self.trigram_index.get(trigram)
+            if not variants:
+                return found
+            candidate_lists.append(variants)
+        candidate_lists.sort(key=len)
+        candidates = set(candidate_lists[0])
+        for variants in candidate_lists[1:]:
+            candidates &= variants
+            if not candidates:
+                return found
+        for variant in candidates:
+            if name_norm in variant:
+                found |= self.variants[variant]
+        return found
+
+    def find_by_teams(self, home_team: str, away_team: str) -> Optional[Dict]:
+        """
+        Событие, где хозяева совпадают с home_team, а гости — с away_team (только прямой порядок:
+        реверс ловил ответные матчи). Оба точно или оба частично.
+        """
+        home_norm = normalize_team_name(home_team)
+        away_norm = normalize_team_name(away_team)
+
+        def positions(matches, side):
+            return {pos for pos, s in matches if s == side}
+
+        candidates = positions(self.exact(home_norm), HOME) & positions(self.exact(away_norm), AWAY)
+        # Частичное совпадение засчитывается, только если обе команды не короче MIN_PARTIAL_LENGTH
+        if len(home_norm) >= MIN_PARTIAL_LENGTH and len(away_norm) >= MIN_PARTIAL_LENGTH:
+            candidates |= positions(self.similar(home_norm), HOME) & positions(self.similar(away_norm), AWAY)
+        return self.events[min(candidates)] if candidates else None
+
+    def find_by_team_and_time(self, home_team: str, away_team: str, match_datetime: datetime) -> Optional[Dict]:
+        """
+        Первое событие, где хотя бы одна из команд совпадает (точно или частично, на любой стороне)
+        и время начала совпадает (см. sofascore_time_matches).
+        """
+        candidates = {pos for pos, _ in self.similar(normalize_team_name(home_team))}
+        candidates |= {pos for pos, _ in self.similar(normalize_team_name(away_team))}
+        for pos in sorted(candidates):
+            start_timestamp = self.events[pos].get('startTimestamp')
+            if not start_timestamp:
+                continue
+            try:
+                if sofascore_time_matches(match_datetime, start_timestamp):
+                    return self.events[pos]
+            except (ValueError, OverflowError, OSError, TypeError):
+                continue
+        return None
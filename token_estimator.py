@@ -0,0 +1,217 @@
+# --- START OF FILE token_estimator.py ---
+
+"""
+Оценка числа токенов текста по семействам моделей с калибровкой по фактическому usage провайдеров.
+
+Раньше токены считались как len(text) // 3 для любого текста и любой модели. Для кириллицы и CJK
+это сильно ошибается (в разные стороны у разных токенизаторов): чанки то не помещались в контекст
+или лимит ответа (CONTEXT_LIMIT_ERROR, обрезанный ответ), то получались слишком мелкими.
+
+Оценщик по умолчанию считает символы по классам (латиница, кириллица, CJK, пробелы, прочее) и
+умножает на "токенов на символ" каждого класса. Веса подстраиваются по каждому ответу с usage
+(prompt_tokens — по тексту промпта, completion_tokens — по тексту ответа) нормализованным LMS,
+отдельно для каждого семейства моделей, и сохраняются в workflow DB.
+
+Для семейства можно зарегистрировать свой оценщик (register_estimator), например на настоящем
+токенизаторе: объект с методами estimate(text), observe(text, tokens) и to_dict().
+"""
+
+import os
+import re
+import threading
+from typing import Callable, Dict, Optional
+
+import workflow_db_manager
+
+TOKEN_CLASSES = ('latin', 'cyrillic', 'cjk', 'space', 'other')
+# Начальные веса (токенов на символ); для смешанного английского текста дают примерно len // 3.5
+DEFAULT_TOKENS_PER_CHAR = {'latin': 0.26, 'cyrillic': 0.4, 'cjk': 0.9, 'space': 0.05, 'other': 0.6}
+WEIGHT_BOUNDS = (0.01, 3.0)
+# Ожидаемое отношение токенов ответа к токенам исходного текста по операциям
+DEFAULT_OUTPUT_RATIOS = {'translate': 1.3, 'translate_toc': 1.3, 'summarize': 0.35, 'reduce': 0.5, 'analyze': 0.6}
+OUTPUT_RATIO_BOUNDS = (0.05, 4.0)
+OUTPUT_RATIO_ALPHA = 0.2
+# Сохранять калибровку семейства в БД каждые N наблюдений
+TOKEN_CALIBRATION_SAVE_EVERY = max(1, int(os.getenv("TOKEN_CALIBRATION_SAVE_EVERY", "10")))
+# Ответы короче этого порога не калибруют веса (в них велика доля служебных токенов)
+MIN_CALIBRATION_CHARS = 200
+
+_CLASS_PATTERNS = {
+    'latin': re.compile(r'[A-Za-zÀ-ɏ]'),
+    'cyrillic': re.compile(r'[Ѐ-ӿ]'),
+    'cjk': re.compile(r'[぀-ヿ㐀-鿿가-힯豈-﫿]'),
+    'space': re.compile(r'\s'),
+}
+
+# Имя модели (без провайдера) -> семейство (порядок важен: первое совпадение)
+_FAMILY_PATTERNS = [
+    (re.compile(r'gemini'), 'gemini'), (re.compile(r'gemma'), 'gemma'), (re.compile(r'claude'), 'claude'),
+    (re.compile(r'gpt|^o[134](?:-|$)'), 'gpt'), (re.compile(r'llama'), 'llama'), (re.compile(r'qwen'), 'qwen'),
+    (re.compile(r'deepseek'), 'deepseek'), (re.compile(r'mistral|mixtral'), 'mistral'), (re.compile(r'grok'), 'grok'),
+    (re.compile(r'glm'), 'glm'), (re.compile(r'kimi'), 'kimi'),
+]
+
+
+def count_char_classes(text: str) -> Dict[str, int]:
+    """Количество символов текста по классам TOKEN_CLASSES."""
+    counts = {name: pattern.subn('', text)[1] for name, pattern in _CLASS_PATTERNS.items()}
+    counts['other'] = len(text) - sum(counts.values())
+    return counts
+
+
+def model_family(model_name: Optional[str]) -> str:
+    """Семейство модели по имени (без префикса провайдера); 'default', если не распознано."""
+    name = (model_name or '').lower()
+    for prefix in ('openrouter/', 'literouter/', 'vertex/', 'models/'):
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    name = name.rsplit('/', 1)[-1]
+    for pattern, family in _FAMILY_PATTERNS:
+        if pattern.search(name):
+            return family
+    return 'default'
+
+
+class CharClassEstimator:
+    """Линейная оценка токенов по классам символов; веса калибруются нормализованным LMS."""
+
+    def __init__(self, state: Optional[dict] = None):
+        state = state or {}
+        self.weights = dict(DEFAULT_TOKENS_PER_CHAR)
+        self.weights.update({k: float(v) for k, v in (state.get('weights') or {}).items() if k in self.weights})
+        self.samples = int(state.get('samples', 0))
+
+    def estimate_counts(self, counts: Dict[str, int]) -> float:
+        return sum(self.weights[name] * counts.get(name, 0) for name in TOKEN_CLASSES)
+
+    def estimate(self, text: str) -> int:
+        if not text:
+            return 0
+        return max(1, round(self.estimate_counts(count_char_classes(text))))
+
+    def observe(self, text: str, tokens: int):
+        counts = count_char_classes(text)
+        norm = sum(c * c for c in counts.values())
+        if not norm:
+            return
+        # Шаг больше, пока наблюдений мало, затем — медленная подстройка
+        mu = 0.5 if self.samples < 20 else 0.1
+        error = tokens - self.estimate_counts(counts)
+        for name in TOKEN_CLASSES:
+            updated = self.weights[name] + mu * error * counts[name] / norm
+            self.weights[name] = min(WEIGHT_BOUNDS[1], max(WEIGHT_BOUNDS[0], updated))
+        self.samples += 1
+
+    def to_dict(self) -> dict:
+        return {'weights': {k: round(v, 5) for k, v in self.weights.items()}, 'samples': self.samples}
+
+
+_estimator_factories: Dict[str, Callable[[Optional[dict]], object]] = {}
+
+
+def register_estimator(family: str, factory: Callable[[Optional[dict]], object]):
+    """Регистрирует фабрику оценщика для семейства (factory(сохраненное состояние или None))."""
+    _estimator_factories[family] = factory
+
+
+class TokenEstimatorRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.estimators: Dict[str, object] = {}
+        self.output_ratios: Dict[str, Dict[str, float]] = {}
+        self.unsaved: Dict[str, int] = {}
+        self.saved_states: Optional[Dict[str, dict]] = None
+        self.stats = {'observations': 0, 'abs_error_pct_sum': 0.0}
+
+    def _load_saved_states(self):
+        """Калибровки из БД (один раз на процесс)."""
+        if self.saved_states is None:
+            self.saved_states = workflow_db_manager.get_token_estimator_states()
+
+    def _get(self, family: str):
+        """Оценщик семейства (вызывать под self.lock)."""
+        estimator = self.estimators.get(family)
+        if estimator is None:
+            self._load_saved_states()
+            state = self.saved_states.get(family) or {}
+            factory = _estimator_factories.get(family, CharClassEstimator)
+            estimator = self.estimators[family] = factory(state.get('estimator'))
+            self.output_ratios[family] = dict(state.get('output_ratios') or {})
+        return estimator
+
+    def estimate_tokens(self, model_name: Optional[str], text: str) -> int:
+        with self.lock:
+            estimator = self._get(model_family(model_name))
+            return estimator.estimate(text)
+
+    def chars_per_token(self, model_name: Optional[str], text: str) -> float:
+        """Сколько символов этого текста приходится на токен модели (по выборке до 20000 символов)."""
+        sample = (text or '')[:20000]
+        tokens = self.estimate_tokens(model_name, sample)
+        return len(sample) / tokens if tokens else 3.0
+
+    def output_ratio(self, model_name: Optional[str], operation_type: str) -> float:
+        """Отношение токенов ответа к токенам исходного текста для операции (калиброванное)."""
+        family = model_family(model_name)
+        with self.lock:
+            self._get(family)
+            return self.output_ratios[family].get(operation_type, DEFAULT_OUTPUT_RATIOS.get(operation_type, 1.0))
+
+    def observe_usage(self, model_name: Optional[str], prompt_text: str, prompt_tokens: Optional[int],
+                      output_text: Optional[str] = None, completion_tokens: Optional[int] = None,
+                      operation_type: Optional[str] = None, source_text: Optional[str] = None):
+        """
+        Калибрует оценщик семейства по фактическому usage ответа.
+        completion_tokens не должен включать reasoning-токены (их нет в тексте ответа).
+        """
+        family = model_family(model_name)
+        save_state = None
+        with self.lock:
+            estimator = self._get(family)
+            if prompt_text and prompt_tokens and len(prompt_text) >= MIN_CALIBRATION_CHARS:
+                estimated = estimator.estimate(prompt_text)
+                self.stats['observations'] += 1
+                self.stats['abs_error_pct_sum'] += abs(estimated - prompt_tokens) / prompt_tokens * 100
+                estimator.observe(prompt_text, prompt_tokens)
+                self.unsaved[family] = self.unsaved.get(family, 0) + 1
+            if output_text and completion_tokens and len(output_text) >= MIN_CALIBRATION_CHARS:
+                estimator.observe(output_text, completion_tokens)
+                if operation_type and source_text:
+                    source_tokens = estimator.estimate(source_text)
+                    if source_tokens:
+                        ratios = self.output_ratios[family]
+                        current = ratios.get(operation_type, DEFAULT_OUTPUT_RATIOS.get(operation_type, 1.0))
+                        observed = completion_tokens / source_tokens
+                        updated = (1 - OUTPUT_RATIO_ALPHA) * current + OUTPUT_RATIO_ALPHA * observed
+                        ratios[operation_type] = round(min(OUTPUT_RATIO_BOUNDS[1], max(OUTPUT_RATIO_BOUNDS[0], updated)), 4)
+            if self.unsaved.get(family, 0) >= TOKEN_CALIBRATION_SAVE_EVERY:
+                self.unsaved[family] = 0
+                save_state = {'estimator': estimator.to_dict(), 'output_ratios': dict(self.output_ratios[family])}
+        if save_state:
+            workflow_db_manager.save_token_estimator_state(family, save_state)
+
+    def flush(self):
+        """Сохраняет все несохраненные калибровки."""
+        with self.lock:
+            pending = {
+                family: {'estimator': self.estimators[family].to_dict(), 'output_ratios': dict(self.output_ratios[family])}
+                for family, count in self.unsaved.items() if count
+            }
+            self.unsaved = {}
+        for family, state in pending.items():
+            workflow_db_manager.save_token_estimator_state(family, state)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            observations = self.stats['observations']
+            return {
+                'observations': observations,
+                'mean_abs_error_pct': round(self.stats['abs_error_pct_sum'] / observations, 1) if observations else None,
+                'families': {
+                    family: dict(estimator.to_dict(), output_ratios=dict(self.output_ratios[family]))
+                    for family, estimator in self.estimators.items()
+                },
+            }
+
+
+token_estimator = TokenEstimatorRegistry()
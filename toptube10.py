@@ -1,4 +1,4 @@
-import requests
+import http_client
 from datetime import timedelta, datetime
 import isodate
 import os
@@ -102,7 +102,7 @@ class TopTubeManager:
                 "temperature": 0.1
             }
             
-            response = requests.post(
+            response = http_client.post(
                 f"{api_url}/chat/completions",
                 headers=headers,
                 json=payload,
@@ -151,7 +151,7 @@ class TopTubeManager:
                     params["pageToken"] = page_token
                 
                 try:
-                    resp = requests.get(videos_url, params=params, timeout=30)
+                    resp = http_client.get(videos_url, params=params, timeout=30)
                     resp.raise_for_status()
                     data = resp.json()
                     items = data.get("items", [])
@@ -191,7 +191,7 @@ class TopTubeManager:
                 if search_page_token:
                     search_params["pageToken"] = search_page_token
                 
-                search_resp = requests.get(search_url, params=search_params, timeout=30)
+                search_resp = http_client.get(search_url, params=search_params, timeout=30)
                 search_resp.raise_for_status()
                 search_data = search_resp.json()
                 search_items = search_data.get("items", [])
@@ -206,7 +206,7 @@ class TopTubeManager:
                         "id": ",".join(search_video_ids),
                         "key": self.api_key
                     }
-                    details_resp = requests.get(videos_url, params=details_params, timeout=30)
+                    details_resp = http_client.get(videos_url, params=details_params, timeout=30)
                     details_resp.raise_for_status()
                     details_data = details_resp.json()
                     details_items = details_data.get("items", [])
@@ -370,7 +370,7 @@ class TopTubeManager:
                     "id": ",".join(batch),
                     "key": self.api_key
                 }
-                channels_response = requests.get(channels_url, params=channels_params, timeout=30)
+                channels_response = http_client.get(channels_url, params=channels_params, timeout=30)
                 channels_response.raise_for_status()
                 channels_data = channels_response.json()
                 
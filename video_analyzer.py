@@ -1,5 +1,6 @@
 import os
 import requests
+import http_client
 import json
 import re
 from bs4 import BeautifulSoup
@@ -98,7 +99,7 @@ class VideoAnalyzer:
             print(f"[VideoAnalyzer] Попытка официального API для URL: {video_url}")
             
             # Прямой запрос к API
-            response = requests.post(
+            response = http_client.post(
                 api_url,
                 json=payload,
                 headers=headers,
@@ -180,7 +181,7 @@ class VideoAnalyzer:
             print(f"[VideoAnalyzer] Fallback payload: {payload}")
             
             # Первый запрос - инициализация
-            response = requests.post(
+            response = http_client.post(
                 api_url,
                 json=payload,
                 headers=headers,
@@ -246,7 +247,7 @@ class VideoAnalyzer:
                 else:
                     print(f"[VideoAnalyzer] Поллинг попытка {attempt}/{max_attempts} (без паузы)")
                 
-                second_response = requests.post(
+                second_response = http_client.post(
                     api_url,
                     json=second_payload,
                     headers=headers,
@@ -406,7 +407,7 @@ class VideoAnalyzer:
         """
         try:
             print(f"[VideoAnalyzer] Загрузка HTML с URL: {sharing_url}")
-            response = requests.get(sharing_url, timeout=30)
+            response = http_client.get(sharing_url, timeout=30)
             if response.status_code != 200:
                 print(f"[VideoAnalyzer] HTTP ошибка при загрузке HTML: {response.status_code}")
                 return None
@@ -571,7 +572,7 @@ class VideoAnalyzer:
                         
                         print(f"[VideoAnalyzer] Отправка запроса к {provider_name} API (модель: {model}, max_tokens: {max_tokens})")
                         
-                        response = requests.post(
+                        response = http_client.post(
                             f"{api_url}/chat/completions",
                             headers=headers,
                             json=payload,
@@ -685,7 +686,7 @@ class VideoAnalyzer:
                     
                     print(f"[VideoAnalyzer] Переводим заголовок: '{title[:50]}...' с моделью {model}")
                     
-                    response = requests.post(
+                    response = http_client.post(
                         f"{api_url}/chat/completions",
                         headers=headers,
                         json=payload,
@@ -804,7 +805,7 @@ class VideoAnalyzer:
                 print(f"[VideoAnalyzer] Отправляем запрос к {provider_name} для краткой версии (модель: {model})...")
                 
                 try:
-                    response = requests.post(
+                    response = http_client.post(
                         f"{api_url}/chat/completions",
                         headers=headers,
                         json=payload,
@@ -1,5 +1,5 @@
 import os
-import requests
+import http_client
 import json
 from typing import List, Dict, Any, Optional
 from workflow_model_config import get_model_for_operation
@@ -181,7 +181,7 @@ URL: {url}
             print(f"[VideoChatHandler] Отправка запроса к {provider_name} (модель: {model_name})")
             print(f"[VideoChatHandler] Количество сообщений: {len(messages)}")
             
-            response = requests.post(
+            response = http_client.post(
                 f"{api_url}/chat/completions",
                 json=payload,
                 headers=headers,
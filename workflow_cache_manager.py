@@ -2,6 +2,8 @@ import os
 import json
 import traceback
 import shutil
+import threading
+from collections import OrderedDict
 from pathlib import Path
 
 from config import CACHE_DIR
@@ -78,6 +80,7 @@ def delete_section_stage_result(book_id, section_id, stage_name):
 def delete_book_workflow_cache(book_id):
     """Удаляет всю директорию кэша для данной книги."""
     book_cache_dir = os.path.join(WORKFLOW_CACHE_BASE_DIR, book_id)
+    _evict_source_text_for_book(book_id)
 
     if not os.path.exists(book_cache_dir):
         return False # Директория не найденa, считаем успешным удалением
@@ -156,3 +159,213 @@ def delete_book_stage_result(book_id, stage_name):
         print(f"[WorkflowCache] ОШИБКА при удалении директории кэша этапа {stage_dir}: {e}")
         traceback.print_exc()
         return False
+
+# --- Индекс исходного текста секций (извлекается из EPUB один раз при загрузке) ---
+SOURCE_TEXT_STAGE_NAME = 'source_text'
+# Ограничение LRU-кэша исходных текстов в памяти (в символах), чтобы уложиться в 512MB RAM.
+SOURCE_TEXT_LRU_MAX_CHARS = int(os.getenv("WORKFLOW_SOURCE_TEXT_LRU_MAX_CHARS", str(8 * 1024 * 1024)))
+
+_source_text_lru = OrderedDict() # (book_id, section_id) -> text
+_source_text_lru_chars = 0
+_source_text_lru_lock = threading.Lock()
+
+def _remember_source_text(book_id, section_id, text):
+    """Кладет текст в LRU и вытесняет самые старые записи при превышении лимита."""
+    global _source_text_lru_chars
+    key = (book_id, section_id)
+    with _source_text_lru_lock:
+        old = _source_text_lru.pop(key, None)
+        if old is not None:
+            _source_text_lru_chars -= len(old)
+        if len(text) > SOURCE_TEXT_LRU_MAX_CHARS:
+            return
+        _source_text_lru[key] = text
+        _source_text_lru_chars += len(text)
+        while _source_text_lru_chars > SOURCE_TEXT_LRU_MAX_CHARS and _source_text_lru:
+            _, evicted = _source_text_lru.popitem(last=False)
+            _source_text_lru_chars -= len(evicted)
+
+def _evict_source_text_for_book(book_id):
+    """Удаляет из LRU все тексты книги."""
+    global _source_text_lru_chars
+    with _source_text_lru_lock:
+        for key in [k for k in _source_text_lru if k[0] == book_id]:
+            _source_text_lru_chars -= len(_source_text_lru.pop(key))
+
+def save_section_source_text(book_id, section_id, text):
+    """
+    Сохраняет извлеченный исходный текст секции в индекс на диске ("" для пустых секций).
+    None (секция не найдена или не разобралась) не сохраняется: иначе ошибка стала бы постоянной пустой секцией.
+    """
+    if text is None:
+        return False
+    if save_section_stage_result(book_id, section_id, SOURCE_TEXT_STAGE_NAME, text):
+        _remember_source_text(book_id, section_id, text)
+        return True
+    return False
+
+def load_section_source_text(book_id, section_id):
+    """Возвращает исходный текст секции из LRU или индекса на диске. None — секция не проиндексирована."""
+    key = (book_id, section_id)
+    with _source_text_lru_lock:
+        text = _source_text_lru.get(key)
+        if text is not None:
+            _source_text_lru.move_to_end(key)
+            return text
+
+    text = load_section_stage_result(book_id, section_id, SOURCE_TEXT_STAGE_NAME)
+    if text is not None:
+        _remember_source_text(book_id, section_id, text)
+    return text
+
+# --- Чекпоинты чанков (переведенные чанки секции, чтобы ретраи/фоллбэки продолжали с первого недостающего) ---
+CHUNK_CHECKPOINT_STAGE_NAME = 'chunks'
+
+def _get_chunk_checkpoint_dir(book_id, section_key):
+    return os.path.join(_get_cache_dir_for_stage(book_id, CHUNK_CHECKPOINT_STAGE_NAME), str(section_key))
+
+def save_chunk_checkpoint(book_id, section_key, context_key, chunk_hash, model_name, content):
+    """Сохраняет результат обработки чанка (ключ: книга/секция/контекст запроса/хэш чанка, модель — в метаданных)."""
+    checkpoint_dir = _get_chunk_checkpoint_dir(book_id, section_key)
+    file_path = os.path.join(checkpoint_dir, f"{context_key}_{chunk_hash}.json")
+    try:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': model_name, 'content': content}, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при сохранении чекпоинта чанка {file_path}: {e}")
+        traceback.print_exc()
+        return False
+
+def load_chunk_checkpoint(book_id, section_key, context_key, chunk_hash):
+    """Возвращает (content, model_name) сохраненного чанка или None."""
+    file_path = os.path.join(_get_chunk_checkpoint_dir(book_id, section_key), f"{context_key}_{chunk_hash}.json")
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get('content'), data.get('model')
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при загрузке чекпоинта чанка {file_path}: {e}")
+        traceback.print_exc()
+        return None
+
+def delete_chunk_checkpoints(book_id, section_key, context_key=None):
+    """Удаляет чекпоинты чанков секции (все или только для указанного контекста запроса)."""
+    checkpoint_dir = _get_chunk_checkpoint_dir(book_id, section_key)
+    if not os.path.exists(checkpoint_dir):
+        return False
+    try:
+        if context_key is None:
+            shutil.rmtree(checkpoint_dir)
+            return True
+        for filename in os.listdir(checkpoint_dir):
+            if filename.startswith(f"{context_key}_"):
+                os.remove(os.path.join(checkpoint_dir, filename))
+        return True
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при удалении чекпоинтов чанков {checkpoint_dir}: {e}")
+        traceback.print_exc()
+        return False
+
+def delete_book_chunk_checkpoints(book_id):
+    """Удаляет чекпоинты чанков всех секций книги."""
+    chunks_dir = _get_cache_dir_for_stage(book_id, CHUNK_CHECKPOINT_STAGE_NAME)
+    if not os.path.exists(chunks_dir):
+        return False
+    try:
+        shutil.rmtree(chunks_dir)
+        return True
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при удалении чекпоинтов чанков книги {chunks_dir}: {e}")
+        traceback.print_exc()
+        return False
+
+def remove_stale_chunk_checkpoints(keep_keys):
+    """
+    Удаляет чекпоинты чанков всех секций, кроме keep_keys — множества (book_id, str(section_key))
+    секций, обработка которых еще продолжится. Возвращает число удаленных директорий.
+    """
+    removed = 0
+    if not os.path.isdir(WORKFLOW_CACHE_BASE_DIR):
+        return removed
+    for book_id in os.listdir(WORKFLOW_CACHE_BASE_DIR):
+        chunks_dir = _get_cache_dir_for_stage(book_id, CHUNK_CHECKPOINT_STAGE_NAME)
+        if not os.path.isdir(chunks_dir):
+            continue
+        for section_key in os.listdir(chunks_dir):
+            if (book_id, section_key) in keep_keys:
+                continue
+            if delete_chunk_checkpoints(book_id, section_key):
+                removed += 1
+    return removed
+
+# --- Обход памяти переводов для секций, перевод которых пользователь запросил заново ---
+TM_BYPASS_STAGE_NAME = 'tm_bypass'
+
+def set_translation_memory_bypass(book_id, section_id):
+    """Помечает секцию: при следующем переводе не брать чанки из памяти переводов."""
+    return save_section_stage_result(book_id, section_id, TM_BYPASS_STAGE_NAME, "1")
+
+def is_translation_memory_bypassed(book_id, section_id):
+    """Проверяет пометку обхода памяти переводов для секции."""
+    if not book_id or section_id is None:
+        return False
+    return os.path.exists(_get_cache_file_path(book_id, section_id, TM_BYPASS_STAGE_NAME))
+
+def clear_translation_memory_bypass(book_id, section_id):
+    """Снимает пометку обхода памяти переводов."""
+    return delete_section_stage_result(book_id, section_id, TM_BYPASS_STAGE_NAME)
+
+# --- Кэш отрендеренного XHTML глав (ключ — хэш переведенного текста и параметров рендера) ---
+RENDER_CACHE_STAGE_NAME = 'render'
+
+def save_section_render(book_id, section_id, render_key, rendered_html):
+    """Сохраняет отрендеренное тело главы вместе с ключом, по которому оно получено."""
+    file_path = _get_cache_file_path(book_id, section_id, RENDER_CACHE_STAGE_NAME, '.json')
+    try:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'key': render_key, 'html': rendered_html}, f, ensure_ascii=False)
+        os.replace(tmp_path, file_path)
+        return True
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при сохранении рендера секции {section_id}: {e}")
+        traceback.print_exc()
+        return False
+
+def load_section_render(book_id, section_id, render_key):
+    """Возвращает отрендеренное тело главы, если оно получено с тем же ключом, иначе None."""
+    file_path = _get_cache_file_path(book_id, section_id, RENDER_CACHE_STAGE_NAME, '.json')
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get('html') if data.get('key') == render_key else None
+    except Exception as e:
+        print(f"[WorkflowCache] ОШИБКА при загрузке рендера секции {section_id}: {e}")
+        return None
+
+# --- Манифест сборки EPUB (для инкрементальной пересборки) ---
+EPUB_MANIFEST_STAGE_NAME = 'epub_manifest'
+
+def load_epub_build_manifest(book_id):
+    """Возвращает манифест последней сборки EPUB (dict) или пустой dict."""
+    content = load_book_stage_result(book_id, EPUB_MANIFEST_STAGE_NAME, '.json')
+    if not content:
+        return {}
+    try:
+        return json.loads(content)
+    except (json.JSONDecodeError, TypeError) as e:
+        print(f"[WorkflowCache] Поврежденный манифест EPUB для книги {book_id}: {e}")
+        return {}
+
+def save_epub_build_manifest(book_id, manifest):
+    """Сохраняет манифест сборки EPUB."""
+    return save_book_stage_result(book_id, EPUB_MANIFEST_STAGE_NAME, json.dumps(manifest, ensure_ascii=False), '.json')
@@ -7,9 +7,12 @@ import time
 import traceback
 import threading
 from flask import g # Используем Flask's g для управления соединением
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from collections import OrderedDict
 
+import comic_image_store
+import workflow_cache_manager
+
 _thread_local = threading.local()
 
 # --- Настройки новой базы данных ---
@@ -17,6 +20,30 @@ from config import WORKFLOW_DB_FILE
 
 DATABASE_FILE = str(WORKFLOW_DB_FILE)
 
+# WAL: читатели (UI-поллинг /workflow_book_status) не блокируют писателя (воркер) и наоборот.
+# synchronous=NORMAL в WAL безопасен для целостности, теряются лишь последние транзакции при падении ОС.
+DB_BUSY_TIMEOUT_MS = int(os.getenv("WORKFLOW_DB_BUSY_TIMEOUT_MS", "30000"))
+DB_CACHE_SIZE_KB = int(os.getenv("WORKFLOW_DB_CACHE_SIZE_KB", "8192"))
+DB_MMAP_SIZE = int(os.getenv("WORKFLOW_DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# Пакетная запись статусов секций: обновления копятся в памяти и пишутся одной транзакцией
+# раз в WORKFLOW_DB_BATCH_INTERVAL секунд (повторные обновления одной секции/этапа схлопываются).
+DB_BATCH_WRITES = os.getenv("WORKFLOW_DB_BATCH_WRITES", "0") == "1"
+DB_BATCH_INTERVAL = float(os.getenv("WORKFLOW_DB_BATCH_INTERVAL", "0.5"))
+
+def _connect_workflow_db():
+    """Открывает соединение с базой и применяет pragma (WAL, таймауты, кэш)."""
+    db = sqlite3.connect(DATABASE_FILE, isolation_level=None, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode = WAL;") # сохраняется в файле базы, повторный вызов дешевый
+    db.execute("PRAGMA synchronous = NORMAL;")
+    db.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS};")
+    db.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB};")
+    db.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE};")
+    db.execute("PRAGMA temp_store = MEMORY;")
+    db.execute("PRAGMA foreign_keys = ON;")
+    return db
+
 def get_workflow_db():
     """Универсальный доступ к базе: Flask/g если есть, иначе thread-local."""
     try:
@@ -26,17 +53,13 @@ def get_workflow_db():
         except Exception:
             db = None
         if db is None:
-            db = g._workflow_database = sqlite3.connect(DATABASE_FILE, isolation_level=None)
-            db.row_factory = sqlite3.Row
-            db.execute("PRAGMA foreign_keys = ON;")
+            db = g._workflow_database = _connect_workflow_db()
         return db
     except (ImportError, RuntimeError):
         # Не Flask-контекст — используем thread-local storage (переиспользуем соединение на поток)
         db = getattr(_thread_local, 'workflow_db', None)
         if db is None:
-            db = sqlite3.connect(DATABASE_FILE, isolation_level=None)
-            db.row_factory = sqlite3.Row
-            db.execute("PRAGMA foreign_keys = ON;")
+            db = _connect_workflow_db()
             _thread_local.workflow_db = db
         return db
 
@@ -271,31 +294,174 @@ def init_workflow_db():
             except Exception as e:
                 print(f"[WorkflowDB] ОШИБКА создания уникального индекса для access_token: {e}")
             
-            # Таблица comic_images для хранения сгенерированных кадров
+            # Таблица comic_images: метаданные сгенерированных кадров, сами байты — в comic_image_store
+            # Старая таблица с BLOB-ами переименовывается в comic_images_legacy и переносится построчно.
+            # Признак незавершенного переноса — существование comic_images_legacy (перенос продолжится при следующем старте).
+            cursor = db.execute("PRAGMA table_info(comic_images);")
+            if 'image_data' in [row[1] for row in cursor.fetchall()]:
+                db.execute("ALTER TABLE comic_images RENAME TO comic_images_legacy;")
+            legacy_comic_blobs = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'comic_images_legacy';"
+            ).fetchone() is not None
             db.execute('''
                 CREATE TABLE IF NOT EXISTS comic_images (
                     section_id INTEGER PRIMARY KEY,
                     book_id TEXT NOT NULL,
-                    image_data BLOB NOT NULL,
+                    content_hash TEXT NOT NULL, -- SHA-256 байтов, имя файла в хранилище
+                    size_bytes INTEGER NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (section_id) REFERENCES sections(section_id) ON DELETE CASCADE,
                     FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
                 );
             ''')
+            db.execute("CREATE INDEX IF NOT EXISTS idx_comic_images_book ON comic_images(book_id);")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_comic_images_hash ON comic_images(content_hash);")
+            if legacy_comic_blobs:
+                _migrate_comic_image_blobs(db)
+
+            # Материализованные счетчики статусов секций по (книга, этап, статус).
+            # Поддерживаются триггерами на section_stage_statuses — в той же транзакции, что и сам статус.
+            counts_table_exists = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_stage_section_counts';"
+            ).fetchone()
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS book_stage_section_counts (
+                    book_id TEXT NOT NULL,
+                    stage_name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (book_id, stage_name, status),
+                    FOREIGN KEY (book_id) REFERENCES books(book_id) ON DELETE CASCADE
+                );
+            ''')
+            rebuild_counts = not counts_table_exists
+            triggers_exist = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_sss_counts_update';"
+            ).fetchone()
+            if not triggers_exist:
+                # Счетчики раньше велись из Python — после установки триггеров пересобираем их
+                rebuild_counts = True
+            db.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_sss_counts_insert
+                AFTER INSERT ON section_stage_statuses
+                BEGIN
+                    INSERT INTO book_stage_section_counts (book_id, stage_name, status, count)
+                    SELECT book_id, NEW.stage_name, NEW.status, 1 FROM sections WHERE section_id = NEW.section_id
+                    ON CONFLICT(book_id, stage_name, status) DO UPDATE SET count = count + 1;
+                END;
+            ''')
+            db.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_sss_counts_update
+                AFTER UPDATE OF status ON section_stage_statuses
+                WHEN OLD.status IS NOT NEW.status
+                BEGIN
+                    UPDATE book_stage_section_counts SET count = count - 1
+                    WHERE book_id = (SELECT book_id FROM sections WHERE section_id = OLD.section_id)
+                      AND stage_name = OLD.stage_name AND status = OLD.status;
+                    INSERT INTO book_stage_section_counts (book_id, stage_name, status, count)
+                    SELECT book_id, NEW.stage_name, NEW.status, 1 FROM sections WHERE section_id = NEW.section_id
+                    ON CONFLICT(book_id, stage_name, status) DO UPDATE SET count = count + 1;
+                END;
+            ''')
+            db.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_sss_counts_delete
+                AFTER DELETE ON section_stage_statuses
+                BEGIN
+                    UPDATE book_stage_section_counts SET count = count - 1
+                    WHERE book_id = (SELECT book_id FROM sections WHERE section_id = OLD.section_id)
+                      AND stage_name = OLD.stage_name AND status = OLD.status;
+                END;
+            ''')
+
+            # Память переводов: результат чанка по хэшу нормализованного текста и параметрам запроса
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS translation_memory (
+                    memory_key TEXT PRIMARY KEY,
+                    operation_type TEXT NOT NULL,
+                    target_language TEXT,
+                    content TEXT NOT NULL,
+                    model_name TEXT,
+                    size_bytes INTEGER NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    last_used_at REAL NOT NULL
+                );
+            ''')
+            db.execute("CREATE INDEX IF NOT EXISTS idx_translation_memory_last_used ON translation_memory(last_used_at);")
+
+            # Кэш переводов заголовков оглавления: общий для всех книг, ключ — нормализованный заголовок и язык
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS toc_title_translations (
+                    title_key TEXT NOT NULL,
+                    target_language TEXT NOT NULL,
+                    translated_title TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (title_key, target_language)
+                );
+            ''')
+
+            # Калибровка оценки токенов по семействам моделей (см. token_estimator.py)
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS token_estimator_calibration (
+                    family TEXT PRIMARY KEY,
+                    state TEXT NOT NULL, -- JSON: веса оценщика и отношения ответ/исходник по операциям
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                );
+            ''')
 
             # --- КОНЕЦ ИЗМЕНЕНИЯ: Новая структура таблиц ---
 
+        if rebuild_counts:
+            print("[WorkflowDB] Таблица счетчиков статусов секций создана, заполняем по текущим данным...")
+            rebuild_stage_section_counts()
         print("[WorkflowDB] База данных инициализирована.")
     except Exception as e:
         print(f"[WorkflowDB] ОШИБКА инициализации базы данных: {e}")
         traceback.print_exc()
 
 
+def _migrate_comic_image_blobs(db):
+    """
+    Переносит BLOB-ы из comic_images_legacy в файловое хранилище.
+    Перенос идемпотентный: уже перенесенные (или заново сгенерированные) кадры не перезаписываются,
+    а comic_images_legacy удаляется только после успешного переноса всех строк. При ошибке перенос
+    продолжится при следующем init_workflow_db, остальная инициализация не прерывается.
+    """
+    print("[WorkflowDB] Перенос изображений комикса из БД в файловое хранилище...")
+    migrated = 0
+    try:
+        # Читаем по одной строке: все блобы сразу в память не поместятся
+        cursor = db.execute('SELECT section_id, book_id, image_data, created_at FROM comic_images_legacy')
+        while True:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            meta = comic_image_store.put_image(bytes(row['image_data']))
+            db.execute('''
+                INSERT OR IGNORE INTO comic_images (section_id, book_id, content_hash, size_bytes, mime_type, width, height, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (row['section_id'], row['book_id'], meta['content_hash'], meta['size_bytes'],
+                  meta['mime_type'], meta['width'], meta['height'], row['created_at']))
+            migrated += 1
+        cursor.close()
+        db.execute("DROP TABLE comic_images_legacy;")
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА переноса изображений комикса (перенесено {migrated}, продолжим при следующем старте): {e}")
+        traceback.print_exc()
+        return
+    print(f"[WorkflowDB] Перенесено изображений: {migrated}. Для освобождения места в файле БД запустите vacuum_db.py.")
+
+
 def reset_stuck_workflow_tasks():
     """Сбрасывает зависшие статусы при рестарте сервера.
     processing/queued -> pending (задачи были прерваны)
     error -> pending (кроме терминальных: error_context_limit, safety_filter)
-    Терминальные ошибки НЕ сбрасываем — они не исправятся при повторной попытке."""
+    Терминальные ошибки НЕ сбрасываем — они не исправятся при повторной попытке.
+    Чекпоинты чанков остаются только у секций, которые будут обработаны снова."""
     db = get_workflow_db()
     try:
         with db:
@@ -314,12 +480,42 @@ def reset_stuck_workflow_tasks():
             
             # Сброс статуса комикса (фоновые потоки не выживают после перезагрузки)
             db.execute("UPDATE books SET comic_status = 'error' WHERE comic_status = 'processing';")
+        # Счетчики ведутся триггерами; сверяем их после массового сброса на всякий случай
+        check_stage_section_counts()
         print("[WorkflowDB] Зависшие статусы (processing/queued/error) сброшены в pending.")
+        _remove_stale_chunk_checkpoints(db)
         return True
     except Exception as e:
         print(f"[WorkflowDB] ОШИБКА при сбросе зависших задач: {e}")
         return False
 
+def _remove_stale_chunk_checkpoints(db):
+    """
+    Удаляет чекпоинты чанков секций, которые больше не будут переводиться: все посекционные этапы
+    завершены, пропущены или упали с терминальной ошибкой, либо секции/книги уже нет.
+    Чекпоинты уровня книги (ключ 'book') остаются, пока у книги есть этап в pending.
+    """
+    try:
+        rows = db.execute('''
+            SELECT s.book_id, s.section_id FROM sections s
+            WHERE EXISTS (
+                SELECT 1 FROM workflow_stages ws
+                WHERE ws.is_per_section = 1 AND NOT EXISTS (
+                    SELECT 1 FROM section_stage_statuses sss
+                    WHERE sss.section_id = s.section_id AND sss.stage_name = ws.stage_name AND sss.status != 'pending'
+                )
+            )
+        ''').fetchall()
+        keep_keys = {(row['book_id'], str(row['section_id'])) for row in rows}
+        rows = db.execute("SELECT DISTINCT book_id FROM book_stage_statuses WHERE status = 'pending'").fetchall()
+        keep_keys.update((row['book_id'], 'book') for row in rows)
+        removed = workflow_cache_manager.remove_stale_chunk_checkpoints(keep_keys)
+        if removed:
+            print(f"[WorkflowDB] Удалены чекпоинты чанков завершенных секций: {removed}.")
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА очистки чекпоинтов чанков: {e}")
+        traceback.print_exc()
+
 # --- Функции работы с книгами (общая информация) ---
 
 def create_book_workflow(book_id, filename, filepath, toc_data, target_language, access_token, admin_mode=0):
@@ -501,10 +697,15 @@ def delete_book_workflow(book_id):
         except Exception as ce:
             print(f"[WorkflowDB] Warning: could not delete comic folder: {ce}")
 
+        # Отложенные статусы секций этой книги пишем до удаления: после него UPSERT упал бы на FOREIGN KEY
+        flush_pending_status_writes()
         with db:
             # ON DELETE CASCADE в FOREIGN KEY позаботится об удалении из sections, section_stage_statuses, book_stage_statuses
             db.execute('DELETE FROM books WHERE book_id = ?', (book_id,))
         print(f"[WorkflowDB] Книга '{book_id}' и связанные записи удалены из БД.")
+        workflow_cache_manager.delete_book_chunk_checkpoints(book_id)
+        # Строки comic_images удалены каскадом — удаляем файлы кадров, на которые больше нет ссылок
+        remove_unreferenced_comic_images_workflow()
         
         return True
     except Exception as e:
@@ -560,6 +761,7 @@ def get_sections_for_book_workflow(book_id):
     """
     Получает все секции для данной книги из таблицы sections с их статусами по этапам.
     ОПТИМИЗИРОВАНО: используется JOIN для получения всех статусов одним запросом.
+    Отложенные записи статусов не сбрасывает (см. flush_pending_status_writes).
     """
     db = get_workflow_db()
     try:
@@ -727,85 +929,219 @@ def get_section_stage_statuses_workflow(section_id):
         traceback.print_exc()
         return {}
 
+# Один запрос вместо SELECT + UPDATE/INSERT: время начала/окончания сохраняется, если новый статус его не задает.
+# Счетчики book_stage_section_counts обновляют триггеры.
+_UPSERT_SECTION_STAGE_STATUS_SQL = '''
+    INSERT INTO section_stage_statuses (section_id, stage_name, status, model_name, error_message, start_time, end_time)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(section_id, stage_name) DO UPDATE SET
+        status = excluded.status,
+        model_name = excluded.model_name,
+        error_message = excluded.error_message,
+        start_time = COALESCE(excluded.start_time, section_stage_statuses.start_time),
+        end_time = COALESCE(excluded.end_time, section_stage_statuses.end_time)
+'''
+
+def _section_stage_status_params(section_id, stage_name, status, model_name, error_message):
+    current_time = time.time() # Получаем текущее время в виде timestamp
+    start_time_val = current_time if status in ('processing', 'queued') else None
+    end_time_val = current_time if status in ('completed', 'cached', 'completed_empty', 'error') else None
+    return (section_id, stage_name, status, model_name, error_message, start_time_val, end_time_val)
+
 def update_section_stage_status_workflow(
     book_id, section_id, stage_name, status, model_name=None, error_message=None
 ):
-    """Обновляет статус определенного этапа для конкретной секции в section_stage_statuses."""
+    """Обновляет статус определенного этапа для конкретной секции в section_stage_statuses (один UPSERT).
+    При WORKFLOW_DB_BATCH_WRITES=1 запись откладывается в пакетный писатель."""
+    params = _section_stage_status_params(section_id, stage_name, status, model_name, error_message)
+    if DB_BATCH_WRITES:
+        _status_write_batcher.submit(params)
+        return True
     db = get_workflow_db()
     try:
-        with db:
-            cursor = db.execute('''
-                SELECT 1 FROM section_stage_statuses
-                WHERE section_id = ? AND stage_name = ?
-            ''', (section_id, stage_name))
-            exists = cursor.fetchone()
+        db.execute(_UPSERT_SECTION_STAGE_STATUS_SQL, params)
+        return True
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА обновления статуса этапа '{stage_name}' для секции '{section_id}': {e}")
+        traceback.print_exc()
+        return False
 
-            # Определяем значения для start_time и end_time в зависимости от нового статуса
-            current_time = time.time() # Получаем текущее время в виде timestamp
-            start_time_val = current_time if status in ('processing', 'queued') else None
-            end_time_val = current_time if status in ('completed', 'cached', 'completed_empty', 'error') else None
 
-            if exists:
-                # Запись существует, обновляем
-                # print(f"[WorkflowDB] Обновление статуса для секции {section_id} этапа {stage_name} на '{status}'.")
-                pass
+class _StatusWriteBatcher:
+    """
+    Копит обновления статусов секций и пишет их одной транзакцией.
+    Повторные обновления одной (секция, этап) схлопываются: берется последний статус,
+    а время начала/окончания — последнее заданное.
+    """
 
-                # Получаем текущие значения времени, чтобы не перезаписывать их
-                cursor = db.execute('''
-                    SELECT start_time, end_time FROM section_stage_statuses
-                    WHERE section_id = ? AND stage_name = ?
-                ''', (section_id, stage_name))
-                current_times = cursor.fetchone()
-                
-                # Сохраняем существующие значения времени, если они есть
-                if current_times:
-                    existing_start_time = current_times['start_time']
-                    existing_end_time = current_times['end_time']
-                    
-                    # Обновляем start_time только если его нет или если новый статус требует его установки
-                    if start_time_val is not None:
-                        final_start_time = start_time_val
-                    elif existing_start_time is not None:
-                        final_start_time = existing_start_time
-                    else:
-                        final_start_time = None
-                    
-                    # Обновляем end_time только если новый статус требует его установки
-                    if end_time_val is not None:
-                        final_end_time = end_time_val
-                    elif existing_end_time is not None:
-                        final_end_time = existing_end_time
-                    else:
-                        final_end_time = None
-                else:
-                    final_start_time = start_time_val
-                    final_end_time = end_time_val
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock() # порядок пакетов: один пакет пишется за раз
+        self.pending = OrderedDict()
+        self.thread = None
+
+    def submit(self, params):
+        key = (params[0], params[1])
+        with self.lock:
+            previous = self.pending.pop(key, None)
+            if previous is not None:
+                params = params[:5] + (
+                    params[5] if params[5] is not None else previous[5],
+                    params[6] if params[6] is not None else previous[6],
+                )
+            self.pending[key] = params
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True, name="WorkflowDBBatchWriter")
+                self.thread.start()
+
+    def flush(self):
+        """Записывает накопленные обновления. Вызывается фоновым потоком и через flush_pending_status_writes."""
+        with self.write_lock:
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch = list(self.pending.values())
+                self.pending.clear()
+            db = get_workflow_db()
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    db.executemany(_UPSERT_SECTION_STAGE_STATUS_SQL, batch)
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+                return len(batch)
+            except Exception as e:
+                print(f"[WorkflowDB] ОШИБКА пакетной записи {len(batch)} статусов секций: {e}. Пишем по одной.")
+                return self._write_rows(db, batch)
+
+    def _write_rows(self, db, batch):
+        """
+        Пишет пакет построчно. Строку, нарушающую ограничения (например, секция уже удалена), логируем
+        и отбрасываем — иначе она валила бы каждый следующий пакет. При прочих ошибках (база занята)
+        оставшиеся строки возвращаются в очередь, не затирая более свежие обновления.
+        """
+        written = 0
+        for index, params in enumerate(batch):
+            try:
+                db.execute(_UPSERT_SECTION_STAGE_STATUS_SQL, params)
+                written += 1
+            except sqlite3.IntegrityError as e:
+                print(f"[WorkflowDB] Статус '{params[1]}' секции {params[0]} ({params[2]}) отброшен: {e}")
+            except Exception as e:
+                print(f"[WorkflowDB] ОШИБКА записи статусов секций: {e}. {len(batch) - index} записей вернутся в очередь.")
+                traceback.print_exc()
+                with self.lock:
+                    for rest in batch[index:]:
+                        self.pending.setdefault((rest[0], rest[1]), rest)
+                break
+        return written
 
-                # Строим SQL запрос для обновления с сохранением времени
-                db.execute('''
-                    UPDATE section_stage_statuses
-                    SET status = ?, model_name = ?, error_message = ?, start_time = ?, end_time = ?
-                    WHERE section_id = ? AND stage_name = ?
-                ''', (status, model_name, error_message, final_start_time, final_end_time,
-                      section_id, stage_name))
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
 
-            else:
-                # Записи не существует, вставляем новую
-                print(f"[WorkflowDB] Вставка новой записи статуса для секции {section_id} этапа {stage_name} со статусом '{status}'.")
-                db.execute('''
-                    INSERT INTO section_stage_statuses (section_id, stage_name, status, model_name, error_message, start_time, end_time)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (section_id, stage_name, status, model_name, error_message,
-                     start_time_val, end_time_val))
 
-            # Явный коммит после обновления/вставки статуса секции
-            db.commit()
-            return True # Возвращаем True только при успешном коммите
+_status_write_batcher = _StatusWriteBatcher(DB_BATCH_INTERVAL)
+
+def flush_pending_status_writes():
+    """
+    Сбрасывает в базу отложенные обновления статусов секций (no-op без пакетной записи).
+    Геттеры сами его не вызывают: опрос статусов из UI остается чтением и видит изменения
+    с задержкой до DB_BATCH_INTERVAL. Вызывайте перед чтением, по которому процессор принимает
+    решение (какие секции обрабатывать, завершен ли этап).
+    """
+    if DB_BATCH_WRITES:
+        _status_write_batcher.flush()
+
+
+# --- Материализованные счетчики статусов секций ---
+
+def get_stage_section_counts_workflow(book_id, stage_name):
+    """Возвращает {status: count} секций книги на этапе (O(число статусов), без чтения секций)."""
+    db = get_workflow_db()
+    try:
+        rows = db.execute('''
+            SELECT status, count FROM book_stage_section_counts
+            WHERE book_id = ? AND stage_name = ? AND count > 0
+        ''', (book_id, stage_name)).fetchall()
+        return {row['status']: row['count'] for row in rows}
     except Exception as e:
-        print(f"[WorkflowDB] ОШИБКА обновления статуса этапа '{stage_name}' для секции '{section_id}': {e}")
+        print(f"[WorkflowDB] ОШИБКА чтения счетчиков статусов для книги '{book_id}' этапа '{stage_name}': {e}")
+        traceback.print_exc()
+        return {}
+
+def _actual_stage_section_counts(db, book_id=None):
+    """Фактические счетчики по section_stage_statuses: {(book_id, stage_name, status): count}."""
+    query = '''
+        SELECT s.book_id, sss.stage_name, sss.status, COUNT(*) AS cnt
+        FROM section_stage_statuses sss
+        JOIN sections s ON sss.section_id = s.section_id
+    '''
+    params = ()
+    if book_id is not None:
+        query += " WHERE s.book_id = ?"
+        params = (book_id,)
+    query += " GROUP BY s.book_id, sss.stage_name, sss.status"
+    return {(r['book_id'], r['stage_name'], r['status']): r['cnt'] for r in db.execute(query, params).fetchall()}
+
+def rebuild_stage_section_counts(book_id=None):
+    """Пересобирает счетчики статусов секций (для одной книги или для всех) по фактическим статусам."""
+    flush_pending_status_writes()
+    db = get_workflow_db()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if book_id is None:
+                db.execute("DELETE FROM book_stage_section_counts")
+            else:
+                db.execute("DELETE FROM book_stage_section_counts WHERE book_id = ?", (book_id,))
+            actual = _actual_stage_section_counts(db, book_id)
+            db.executemany(
+                "INSERT INTO book_stage_section_counts (book_id, stage_name, status, count) VALUES (?, ?, ?, ?)",
+                [(b, st, status, cnt) for (b, st, status), cnt in actual.items()]
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return True
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА пересборки счетчиков статусов (книга: {book_id or 'все'}): {e}")
         traceback.print_exc()
         return False
 
+def check_stage_section_counts(book_id=None, rebuild=True):
+    """
+    Сверяет счетчики с фактическими статусами секций. Возвращает список книг с расхождениями;
+    при rebuild=True пересобирает счетчики для этих книг.
+    """
+    flush_pending_status_writes()
+    db = get_workflow_db()
+    try:
+        actual = _actual_stage_section_counts(db, book_id)
+        query = "SELECT book_id, stage_name, status, count FROM book_stage_section_counts WHERE count != 0"
+        params = ()
+        if book_id is not None:
+            query += " AND book_id = ?"
+            params = (book_id,)
+        stored = {(r['book_id'], r['stage_name'], r['status']): r['count'] for r in db.execute(query, params).fetchall()}
+
+        mismatched_books = sorted({key[0] for key in set(actual) | set(stored) if actual.get(key, 0) != stored.get(key, 0)})
+        if mismatched_books:
+            print(f"[WorkflowDB] Расхождение счетчиков статусов у книг: {mismatched_books}")
+            if rebuild:
+                for mismatched_book_id in mismatched_books:
+                    rebuild_stage_section_counts(mismatched_book_id)
+        return mismatched_books
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА проверки счетчиков статусов: {e}")
+        traceback.print_exc()
+        return []
+
 
 def get_book_stage_statuses_workflow(book_id):
     """Получает статусы всех этапов на уровне книги для данной книги из book_stage_statuses."""
@@ -830,65 +1166,25 @@ def get_book_stage_statuses_workflow(book_id):
 
 
 def update_book_stage_status_workflow(book_id, stage_name, status, model_name=None, error_message=None, completed_count=None, total_count=None):
-    """Обновляет статус определенного этапа на уровне книги в book_stage_statuses."""
+    """Обновляет статус определенного этапа на уровне книги в book_stage_statuses (один UPSERT)."""
     db = get_workflow_db()
     try:
-        with db:
-            # Пытаемся обновить существующую запись
-            # print(f"[WorkflowDB] Обновление статуса этапа '{stage_name}' для книги '{book_id}' на '{status}'.")
-
-            # Определяем значения для start_time и end_time в зависимости от нового статуса
-            current_time = time.time() # Получаем текущее время в виде timestamp
-            start_time_val = current_time if status in ('processing', 'queued') else None
-            end_time_val = current_time if status in ('completed', 'error') else None # Book-level statuses don't have cached/completed_empty
-
-            # Получаем текущие значения времени, чтобы не перезаписывать их
-            cursor = db.execute('''
-                SELECT start_time, end_time FROM book_stage_statuses
-                WHERE book_id = ? AND stage_name = ?
-            ''', (book_id, stage_name))
-            current_times = cursor.fetchone()
-            
-            # Сохраняем существующие значения времени, если они есть
-            if current_times:
-                existing_start_time = current_times['start_time']
-                existing_end_time = current_times['end_time']
-                
-                # Обновляем start_time только если его нет или если новый статус требует его установки
-                if start_time_val is not None:
-                    final_start_time = start_time_val
-                elif existing_start_time is not None:
-                    final_start_time = existing_start_time
-                else:
-                    final_start_time = None
-                
-                # Обновляем end_time только если новый статус требует его установки
-                if end_time_val is not None:
-                    final_end_time = end_time_val
-                elif existing_end_time is not None:
-                    final_end_time = existing_end_time
-                else:
-                    final_end_time = None
-            else:
-                final_start_time = start_time_val
-                final_end_time = end_time_val
-
-            # Строим SQL запрос для обновления с сохранением времени
-            cursor = db.execute('''
-                UPDATE book_stage_statuses
-                SET status = ?, model_name = ?, error_message = ?, start_time = ?, end_time = ?
-                WHERE book_id = ? AND stage_name = ?
-            ''', (status, model_name, error_message, final_start_time, final_end_time,
-                  book_id, stage_name))
+        # Определяем значения для start_time и end_time в зависимости от нового статуса;
+        # существующие значения времени сохраняются через COALESCE
+        current_time = time.time() # Получаем текущее время в виде timestamp
+        start_time_val = current_time if status in ('processing', 'queued') else None
+        end_time_val = current_time if status in ('completed', 'error') else None # Book-level statuses don't have cached/completed_empty
 
-            # Если обновление не затронуло ни одной строки, значит записи не было, вставляем
-            if cursor.rowcount == 0:
-                print(f"[WorkflowDB] WARNING: Статус для книги {book_id} этапа {stage_name} не найден при попытке UPDATE. Вставляем новую запись.")
-                db.execute('''
-                    INSERT INTO book_stage_statuses (book_id, stage_name, status, model_name, error_message, start_time, end_time)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (book_id, stage_name, status, model_name, error_message,
-                      start_time_val, end_time_val))
+        db.execute('''
+            INSERT INTO book_stage_statuses (book_id, stage_name, status, model_name, error_message, start_time, end_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(book_id, stage_name) DO UPDATE SET
+                status = excluded.status,
+                model_name = excluded.model_name,
+                error_message = excluded.error_message,
+                start_time = COALESCE(excluded.start_time, book_stage_statuses.start_time),
+                end_time = COALESCE(excluded.end_time, book_stage_statuses.end_time)
+        ''', (book_id, stage_name, status, model_name, error_message, start_time_val, end_time_val))
         # print(f"[WorkflowDB] Статус этапа '{stage_name}' для книги '{book_id}' обновлен на '{status}'.")
         return True
     except Exception as e:
@@ -1185,30 +1481,78 @@ def get_book_by_access_token(access_token: str):
         return None
 
 def save_comic_image_workflow(book_id, section_id, image_data):
-    """Сохраняет бинарные данные изображения в БД."""
+    """Сохраняет изображение в файловое хранилище, а его метаданные — в БД."""
     db = get_workflow_db()
     try:
-        with db:
-            db.execute('''
-                INSERT OR REPLACE INTO comic_images (section_id, book_id, image_data)
-                VALUES (?, ?, ?)
-            ''', (section_id, book_id, sqlite3.Binary(image_data)))
+        with comic_image_store.store_lock:
+            meta = comic_image_store.put_image(image_data)
+            previous = db.execute(
+                'SELECT content_hash, mime_type FROM comic_images WHERE section_id = ?', (section_id,)
+            ).fetchone()
+            with db:
+                db.execute('''
+                    INSERT OR REPLACE INTO comic_images (section_id, book_id, content_hash, size_bytes, mime_type, width, height)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (section_id, book_id, meta['content_hash'], meta['size_bytes'], meta['mime_type'], meta['width'], meta['height']))
+            if previous and previous['content_hash'] != meta['content_hash']:
+                remove_unreferenced_comic_images_workflow([(previous['content_hash'], previous['mime_type'])])
         return True
     except Exception as e:
         print(f"[WorkflowDB] ОШИБКА сохранения изображения для секции {section_id}: {e}")
         return False
 
+def get_comic_image_file_workflow(section_id):
+    """
+    Метаданные изображения секции с путем к файлу:
+    {'path', 'content_hash', 'mime_type', 'size_bytes', 'width', 'height', 'created_at'} или None.
+    """
+    db = get_workflow_db()
+    try:
+        row = db.execute(
+            'SELECT content_hash, mime_type, size_bytes, width, height, created_at FROM comic_images WHERE section_id = ?',
+            (section_id,)
+        ).fetchone()
+        if not row:
+            return None
+        info = dict(row)
+        info['path'] = comic_image_store.image_path(row['content_hash'], row['mime_type'])
+        return info
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА получения метаданных изображения для секции {section_id}: {e}")
+        return None
+
 def get_comic_image_workflow(section_id):
-    """Получает бинарные данные изображения из БД."""
+    """Получает бинарные данные изображения из файлового хранилища."""
     db = get_workflow_db()
     try:
-        cursor = db.execute('SELECT image_data FROM comic_images WHERE section_id = ?', (section_id,))
+        cursor = db.execute('SELECT content_hash, mime_type FROM comic_images WHERE section_id = ?', (section_id,))
         row = cursor.fetchone()
-        return row['image_data'] if row else None
+        return comic_image_store.read_image(row['content_hash'], row['mime_type']) if row else None
     except Exception as e:
         print(f"[WorkflowDB] ОШИБКА получения изображения для секции {section_id}: {e}")
         return None
 
+def remove_unreferenced_comic_images_workflow(files=None):
+    """
+    Удаляет файлы кадров, на которые не ссылается ни одна строка comic_images.
+    files — список (content_hash, mime_type) для проверки; None — проверить все файлы хранилища.
+    """
+    db = get_workflow_db()
+    try:
+        with comic_image_store.store_lock:
+            candidates = list(files) if files is not None else list(comic_image_store.iter_stored_files())
+            unreferenced = [
+                (content_hash, mime_type) for content_hash, mime_type in set(candidates)
+                if db.execute('SELECT 1 FROM comic_images WHERE content_hash = ? LIMIT 1', (content_hash,)).fetchone() is None
+            ]
+            removed = comic_image_store.delete_images(unreferenced)
+        if removed:
+            print(f"[WorkflowDB] Удалено файлов изображений без ссылок: {removed}")
+        return removed
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА очистки файлов изображений: {e}")
+        return 0
+
 def has_comic_images_workflow(book_id):
     """Проверяет наличие хотя бы одного изображения для книги."""
     db = get_workflow_db()
@@ -1230,6 +1574,25 @@ def check_comic_image_exists(section_id):
         print(f"[WorkflowDB] ОШИБКА check_comic_image_exists для секции {section_id}: {e}")
         return None
 
+def get_comic_images_meta_workflow(book_id):
+    """
+    Метаданные всех изображений книги одним запросом:
+    {section_id: {'created_at': ..., 'size_bytes': ..., 'content_hash': ...}}.
+    """
+    db = get_workflow_db()
+    try:
+        cursor = db.execute(
+            'SELECT section_id, created_at, size_bytes, content_hash FROM comic_images WHERE book_id = ?',
+            (book_id,)
+        )
+        return {
+            row['section_id']: {'created_at': row['created_at'], 'size_bytes': row['size_bytes'], 'content_hash': row['content_hash']}
+            for row in cursor.fetchall()
+        }
+    except Exception as e:
+        print(f"[WorkflowDB] ОШИБКА получения метаданных изображений для книги {book_id}: {e}")
+        return {}
+
 def get_comic_images_count_workflow(book_id):
     """Возвращает количество уже сгенерированных изображений для книги."""
     db = get_workflow_db()
@@ -1269,9 +1632,14 @@ def reset_book_comic_workflow(book_id):
     try:
         with db:
             # 1. Удаляем все изображения из comic_images
+            image_files = db.execute(
+                'SELECT content_hash, mime_type FROM comic_images WHERE book_id = ?', (book_id,)
+            ).fetchall()
             db.execute('DELETE FROM comic_images WHERE book_id = ?', (book_id,))
             # 2. Сбрасываем статус комикса и очищаем visual_bible
             db.execute('UPDATE books SET comic_status = "not_started", visual_bible = NULL WHERE book_id = ?', (book_id,))
+        # 3. Файлы кадров, которые не используются другими книгами (одинаковые кадры хранятся одним файлом)
+        remove_unreferenced_comic_images_workflow([(row['content_hash'], row['mime_type']) for row in image_files])
         print(f"[WorkflowDB] Комикс для книги {book_id} полностью сброшен (включая Cast-лист).")
         return True
     except Exception as e:
@@ -1544,4 +1912,151 @@ def delete_user_session(session_id: str) -> bool:
         print(f"[WorkflowDB] Ошибка удаления сессии {session_id}: {e}")
         return False
 
-# --- КОНЕЦ ФУНКЦИЙ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЬСКИМИ СЕССИЯМИ ---
\ No newline at end of file
+# --- КОНЕЦ ФУНКЦИЙ ДЛЯ РАБОТЫ С ПОЛЬЗОВАТЕЛЬСКИМИ СЕССИЯМИ ---
+
+# --- Память переводов (translation memory) ---
+
+def get_translation_memory(memory_key: str):
+    """Возвращает (content, model_name) из памяти переводов и отмечает использование, или None."""
+    try:
+        db = get_workflow_db()
+        row = db.execute(
+            "SELECT content, model_name FROM translation_memory WHERE memory_key = ?", (memory_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            "UPDATE translation_memory SET hits = hits + 1, last_used_at = ? WHERE memory_key = ?",
+            (time.time(), memory_key)
+        )
+        return row['content'], row['model_name']
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка чтения памяти переводов: {e}")
+        return None
+
+def save_translation_memory(memory_key: str, operation_type: str, target_language: str, content: str, model_name: str) -> bool:
+    """Сохраняет результат чанка в память переводов."""
+    try:
+        db = get_workflow_db()
+        db.execute("""
+            INSERT OR REPLACE INTO translation_memory
+                (memory_key, operation_type, target_language, content, model_name, size_bytes, hits, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, 0, ?)
+        """, (memory_key, operation_type, target_language, content, model_name, len(content.encode('utf-8')), time.time()))
+        return True
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка записи в память переводов: {e}")
+        return False
+
+def evict_translation_memory(max_bytes: int) -> int:
+    """Удаляет давно не использованные записи, пока суммарный размер не станет меньше max_bytes."""
+    removed = 0
+    try:
+        db = get_workflow_db()
+        total = db.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM translation_memory").fetchone()[0]
+        while total > max_bytes:
+            rows = db.execute(
+                "SELECT memory_key, size_bytes FROM translation_memory ORDER BY last_used_at ASC LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            keys = []
+            for row in rows:
+                keys.append(row['memory_key'])
+                total -= row['size_bytes']
+                if total <= max_bytes:
+                    break
+            db.executemany("DELETE FROM translation_memory WHERE memory_key = ?", [(k,) for k in keys])
+            removed += len(keys)
+        if removed:
+            print(f"[WorkflowDB] Память переводов: вытеснено {removed} записей.")
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка вытеснения памяти переводов: {e}")
+    return removed
+
+def get_toc_title_translations(title_keys: List[str], target_language: str) -> Dict[str, str]:
+    """Переводы заголовков оглавления из кэша: {title_key: translated_title} для найденных ключей."""
+    found = {}
+    unique_keys = list(dict.fromkeys(title_keys))
+    if not unique_keys:
+        return found
+    try:
+        db = get_workflow_db()
+        # Пачками, чтобы не упереться в лимит параметров SQLite
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = db.execute(
+                f"SELECT title_key, translated_title FROM toc_title_translations "
+                f"WHERE target_language = ? AND title_key IN ({placeholders})",
+                (target_language, *batch)
+            ).fetchall()
+            found.update({row['title_key']: row['translated_title'] for row in rows})
+        if found:
+            db.executemany(
+                "UPDATE toc_title_translations SET hits = hits + 1 WHERE title_key = ? AND target_language = ?",
+                [(key, target_language) for key in found]
+            )
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка чтения кэша заголовков TOC: {e}")
+    return found
+
+def save_toc_title_translations(translations: Dict[str, str], target_language: str) -> bool:
+    """Сохраняет переводы заголовков оглавления {title_key: translated_title} одной транзакцией."""
+    if not translations:
+        return True
+    try:
+        db = get_workflow_db()
+        # Соединение в autocommit (isolation_level=None): транзакцию открываем явно
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany("""
+                INSERT INTO toc_title_translations (title_key, target_language, translated_title)
+                VALUES (?, ?, ?)
+                ON CONFLICT(title_key, target_language) DO UPDATE SET translated_title = excluded.translated_title
+            """, [(key, target_language, value) for key, value in translations.items()])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return True
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка записи кэша заголовков TOC: {e}")
+        return False
+
+def get_translation_memory_db_stats() -> dict:
+    """Количество записей, размер и суммарные попадания памяти переводов."""
+    try:
+        db = get_workflow_db()
+        row = db.execute(
+            "SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes, COALESCE(SUM(hits), 0) AS hits FROM translation_memory"
+        ).fetchone()
+        return {'entries': row['entries'], 'size_mb': round(row['size_bytes'] / (1024 ** 2), 2), 'total_hits': row['hits']}
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка статистики памяти переводов: {e}")
+        return {}
+
+def get_token_estimator_states() -> Dict[str, dict]:
+    """Сохраненные калибровки оценки токенов: {семейство: состояние}."""
+    try:
+        db = get_workflow_db()
+        rows = db.execute("SELECT family, state FROM token_estimator_calibration").fetchall()
+        return {row['family']: json.loads(row['state']) for row in rows}
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка чтения калибровки токенов: {e}")
+        return {}
+
+def save_token_estimator_state(family: str, state: dict) -> bool:
+    """Сохраняет калибровку оценки токенов семейства моделей."""
+    try:
+        db = get_workflow_db()
+        with db:
+            db.execute("""
+                INSERT INTO token_estimator_calibration (family, state, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(family) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+            """, (family, json.dumps(state)))
+        return True
+    except Exception as e:
+        print(f"[WorkflowDB] Ошибка сохранения калибровки токенов ({family}): {e}")
+        return False
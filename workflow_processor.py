@@ -10,18 +10,29 @@ import workflow_cache_manager # TODO: Implement workflow_cache_manager DONE
 import time
 from flask import current_app, Flask
 import re
+import unicodedata
 from typing import Optional
 from config import UPLOADS_DIR
 import sys
 import json
+import hashlib
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import workflow_model_config
+from workflow_stage_graph import StageGraph
 from telegram_notifier import make_download_link
 
 # --- Менеджер очереди (Singleton) ---
+# Количество книг, обрабатываемых одновременно (каждая книга внутри еще параллелит секции).
+WORKFLOW_QUEUE_WORKERS = max(1, int(os.getenv("WORKFLOW_QUEUE_WORKERS", "2")))
+# Приоритеты очереди: меньше = раньше.
+QUEUE_PRIORITY_ADMIN = 0
+QUEUE_PRIORITY_USER = 1
+# За сколько секунд ожидания "размер" книги перестает влиять на порядок (защита больших книг от голодания).
+QUEUE_AGING_SECONDS = int(os.getenv("WORKFLOW_QUEUE_AGING_SECONDS", "1800"))
+
 class WorkflowQueueManager:
     _instance = None
     _lock = threading.Lock()
@@ -30,24 +41,93 @@ class WorkflowQueueManager:
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super(WorkflowQueueManager, cls).__new__(cls)
-                cls._instance.executor = ThreadPoolExecutor(max_workers=1)
-                cls._instance.processing_books = set()
+                cls._instance.max_workers = WORKFLOW_QUEUE_WORKERS
+                cls._instance.processing_books = set() # книги в очереди + в работе (дедупликация)
                 cls._instance.lock = threading.Lock()
+                cls._instance.condition = threading.Condition(cls._instance.lock)
+                cls._instance.pending = [] # ожидающие задачи (dict)
+                cls._instance.running = {} # book_id -> задача
+                cls._instance.workers = []
+                cls._instance.seq = 0
                 cls._instance.active_threads = {} # book_id -> thread_obj
         return cls._instance
 
-    def add_book_to_queue(self, book_id, app, admin=None):
-        """Добавляет задачу в экзекутор, если книга еще не в обработке."""
-        with self.lock:
+    def add_book_to_queue(self, book_id, app, admin=None, priority=None):
+        """Добавляет книгу в очередь, если она еще не в очереди и не в обработке.
+
+        priority: QUEUE_PRIORITY_ADMIN / QUEUE_PRIORITY_USER. По умолчанию определяется
+        по admin (или по admin_mode книги, если admin не передан)."""
+        size, book_admin = self._get_book_queue_info(book_id)
+        if priority is None:
+            is_admin = book_admin if admin is None else admin
+            priority = QUEUE_PRIORITY_ADMIN if is_admin else QUEUE_PRIORITY_USER
+
+        with self.condition:
             if book_id in self.processing_books:
                 print(f"[QueueManager] Книга {book_id} уже в очереди или обрабатывается.")
                 return False
             self.processing_books.add(book_id)
-        
-        print(f"[QueueManager] Добавление книги {book_id} в очередь (admin={admin}).")
-        self.executor.submit(self._run_task, book_id, app, admin)
+            self.seq += 1
+            self.pending.append({
+                'book_id': book_id,
+                'app': app,
+                'admin': admin,
+                'priority': priority,
+                'size': size,
+                'seq': self.seq,
+                'enqueued_at': time.time(),
+            })
+            self._ensure_workers()
+            self.condition.notify()
+
+        print(f"[QueueManager] Добавление книги {book_id} в очередь (admin={admin}, priority={priority}, sections={size}).")
         return True
 
+    def _get_book_queue_info(self, book_id):
+        """Размер (кол-во секций) и admin_mode книги для планирования."""
+        try:
+            book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+            if not book_info:
+                return 0, False
+            size = book_info.get('total_sections_count') or 0
+            return size, bool(book_info.get('admin_mode', 0))
+        except Exception as e:
+            print(f"[QueueManager] Не удалось получить данные книги {book_id} для очереди: {e}")
+            return 0, False
+
+    def _ensure_workers(self):
+        """Запускает недостающие рабочие потоки (вызывать под self.lock)."""
+        self.workers = [w for w in self.workers if w.is_alive()]
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, daemon=True, name=f"workflow-queue-{len(self.workers)}")
+            self.workers.append(worker)
+            worker.start()
+
+    def _sort_key(self, task, now):
+        """
+        Ключ выбора: приоритет -> "стоимость" с учетом ожидания -> FIFO.
+        Справедливости по пользователю нет: у книг нет общего идентификатора пользователя
+        (access_token и сессия создаются заново на каждую загрузку).
+        """
+        waited = now - task['enqueued_at']
+        aging = max(0.0, 1.0 - waited / QUEUE_AGING_SECONDS) if QUEUE_AGING_SECONDS > 0 else 0.0
+        return (task['priority'], task['size'] * aging, task['seq'])
+
+    def _ordered_pending(self):
+        """Ожидающие задачи в порядке, в котором их возьмут воркеры (вызывать под self.lock)."""
+        now = time.time()
+        return sorted(self.pending, key=lambda t: self._sort_key(t, now))
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                task = self._ordered_pending()[0]
+                self.pending.remove(task)
+                self.running[task['book_id']] = task
+            self._run_task(task['book_id'], task['app'], task['admin'])
+
     def _run_task(self, book_id, app, admin):
         """Обертка для запуска задачи с последующей очисткой."""
         try:
@@ -58,10 +138,30 @@ class WorkflowQueueManager:
             traceback.print_exc()
         finally:
             with self.lock:
+                self.running.pop(book_id, None)
                 if book_id in self.processing_books:
                     self.processing_books.remove(book_id)
             print(f"[QueueManager] Книга {book_id} удалена из списка обработки.")
 
+    def get_queue_position(self, book_id):
+        """0 — книга обрабатывается, N>=1 — позиция в очереди, None — книги нет в очереди."""
+        with self.lock:
+            if book_id in self.running:
+                return 0
+            for index, task in enumerate(self._ordered_pending(), start=1):
+                if task['book_id'] == book_id:
+                    return index
+        return None
+
+    def get_queue_snapshot(self):
+        """Снимок очереди для мониторинга."""
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'running': list(self.running.keys()),
+                'queued': [t['book_id'] for t in self._ordered_pending()],
+            }
+
     def is_comic_running(self, book_id):
         """Проверяет, запущен ли реально поток генерации комикса."""
         with self.lock:
@@ -132,6 +232,20 @@ def resume_all_workflows(app):
 
 # --- Constants for Workflow Processor ---
 MIN_SECTION_LENGTH = 3000 # Minimum length of clean text for summarization/analysis
+# Версия формата манифеста сборки EPUB (увеличить при несовместимых изменениях сборки)
+EPUB_MANIFEST_VERSION = 3
+
+def _epub_archive_fingerprint(book_id: str, path: str) -> Optional[str]:
+    """
+    Отпечаток собранного EPUB: книга, размер и mtime файла. Путь итогового файла зависит только от имени
+    загруженного файла и языка, поэтому архив могла перезаписать другая книга — переиспользовать
+    главы и картинки можно, только если отпечаток совпадает с сохраненным в манифесте.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{book_id}:{stat.st_size}:{stat.st_mtime_ns}"
 
 # --- НАСТРОЙКИ АДАПТИВНОГО СЖАТИЯ EPUB (Для защиты от OOM на 512MB RAM) ---
 # Целевой максимальный размер всех изображений в одном EPUB (в Мегабайтах).
@@ -173,6 +287,34 @@ REDUCTION_STAGE_NAME = 'reduce_text'
 DEBUG_ALLOW_EMPTY = False # Set to True to treat empty model responses (after retries) as completed_empty instead of error
 MAX_RETRIES = 2 # Number of additional retries for model calls
 
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА СЕКЦИЙ ---
+# Сколько секций одного этапа одной книги обрабатываются одновременно (1 = последовательно, как раньше).
+SECTION_PARALLELISM = max(1, int(os.getenv("WORKFLOW_SECTION_PARALLELISM", "3")))
+# Лимиты одновременных запросов к провайдерам (общие для всех книг процесса).
+PROVIDER_CONCURRENCY_LIMITS = {
+    'literouter': max(1, int(os.getenv("WORKFLOW_LITEROUTER_CONCURRENCY", "2"))),
+    'openrouter': max(1, int(os.getenv("WORKFLOW_OPENROUTER_CONCURRENCY", "3"))),
+    'vertex': max(1, int(os.getenv("WORKFLOW_VERTEX_CONCURRENCY", "4"))),
+    'google': max(1, int(os.getenv("WORKFLOW_GOOGLE_CONCURRENCY", "2"))),
+}
+
+_provider_semaphores = {}
+_provider_semaphores_lock = threading.Lock()
+
+def get_provider_semaphore(provider: str) -> threading.BoundedSemaphore:
+    """Возвращает (создавая при необходимости) семафор провайдера."""
+    with _provider_semaphores_lock:
+        semaphore = _provider_semaphores.get(provider)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(PROVIDER_CONCURRENCY_LIMITS.get(provider, 1))
+            _provider_semaphores[provider] = semaphore
+        return semaphore
+
+def get_stage_provider(stage_name: str) -> str:
+    """Провайдер основной модели этапа (по нему ограничивается параллелизм секций)."""
+    model_name = workflow_model_config.get_model_for_operation(stage_name, 'primary')
+    return workflow_translation_module.determine_api_type(model_name)
+
 # --- Модели теперь берутся из workflow_model_config.py ---
 
 def clean_toc_title(title):
@@ -215,7 +357,38 @@ def translate_toc_titles_workflow(titles: List[str], target_language: str, admin
     
     # Очищаем заголовки
     cleaned_titles = [clean_toc_title(title) for title in titles]
-    
+
+    # Заголовки, уже переводившиеся на этот язык (в любой книге), берем из кэша
+    title_keys = [toc_title_cache_key(title) for title in cleaned_titles]
+    cached = workflow_db_manager.get_toc_title_translations(title_keys, target_language)
+    # Уникальные некэшированные заголовки в порядке первого появления
+    missing = {}
+    for key, title in zip(title_keys, cleaned_titles):
+        if key not in cached:
+            missing.setdefault(key, title)
+    missing_keys = list(missing)
+    hits_count = sum(1 for key in title_keys if key in cached)
+    print(f"[WorkflowProcessor] Кэш TOC: найдено {hits_count}/{len(title_keys)}, к переводу уникальных: {len(missing_keys)}")
+    if not missing_keys:
+        return [cached[key] for key in title_keys]
+
+    # Модели отправляем только уникальные некэшированные заголовки
+    translated_missing = _translate_toc_titles_batch(list(missing.values()), target_language, admin)
+    if not translated_missing:
+        print("[WorkflowProcessor] Не удалось перевести TOC")
+        return []
+
+    new_translations = dict(zip(missing_keys, translated_missing))
+    workflow_db_manager.save_toc_title_translations(new_translations, target_language)
+    cached.update(new_translations)
+    return [cached[key] for key in title_keys]
+
+def toc_title_cache_key(title: str) -> str:
+    """Ключ кэша заголовка: очищенный заголовок в NFC. Регистр сохраняется — он влияет на перевод."""
+    return unicodedata.normalize('NFC', clean_toc_title(title) or '')
+
+def _translate_toc_titles_batch(cleaned_titles: List[str], target_language: str, admin: bool = False) -> List[str]:
+    """Переводит список очищенных заголовков одним запросом. Возвращает [] при ошибке или несовпадении количества."""
     # Объединяем в одну строку с разделителем
     titles_text = "|||".join(cleaned_titles)
     
@@ -239,20 +412,60 @@ def translate_toc_titles_workflow(titles: List[str], target_language: str, admin
             translated_titles = [t.strip() for t in result.split("|||") if t.strip()]
             
             # Проверяем количество строк
-            if len(translated_titles) == len(titles):
+            if len(translated_titles) == len(cleaned_titles):
                 print(f"[WorkflowProcessor] TOC переведен успешно: {len(translated_titles)} заголовков")
                 return translated_titles
             else:
-                print(f"[WorkflowProcessor] ОШИБКА TOC: ожидалось {len(titles)}, получено {len(translated_titles)} строк")
+                print(f"[WorkflowProcessor] ОШИБКА TOC: ожидалось {len(cleaned_titles)}, получено {len(translated_titles)} строк")
         else:
             print(f"[WorkflowProcessor] ОШИБКА TOC: пустой ответ или CONTEXT_LIMIT_ERROR")
             
     except Exception as e:
         print(f"[WorkflowProcessor] ОШИБКА TOC: {e}")
     
-    print("[WorkflowProcessor] Не удалось перевести TOC")
     return []
 
+def build_section_source_index(book_id: str) -> bool:
+    """
+    Один раз разбирает EPUB книги и сохраняет очищенный текст всех секций в индекс
+    (workflow_cache_manager, этап 'source_text'). Последующие этапы читают секцию по id,
+    не открывая ZIP и не запуская BeautifulSoup повторно.
+    """
+    try:
+        book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+        if not book_info:
+            print(f"[WorkflowProcessor] Индекс секций: книга {book_id} не найдена.")
+            return False
+        sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
+        epub_to_section_id = {s['section_epub_id']: s['section_id'] for s in sections}
+
+        indexed_count = 0
+        for section_epub_id, text in epub_parser.extract_all_sections_text(
+            book_info['filepath'], list(epub_to_section_id.keys()), book_info.get('toc', [])
+        ):
+            # Неизвлеченные секции (None) в индекс не попадают: этап попробует извлечь их заново
+            if workflow_cache_manager.save_section_source_text(book_id, epub_to_section_id[section_epub_id], text):
+                indexed_count += 1
+        print(f"[WorkflowProcessor] Индекс секций книги {book_id}: сохранено {indexed_count}/{len(sections)}.")
+        return indexed_count == len(sections)
+    except Exception as e:
+        print(f"[WorkflowProcessor] ОШИБКА построения индекса секций книги {book_id}: {e}")
+        traceback.print_exc()
+        return False
+
+def get_section_source_text(book_id: str, section_id: int, epub_filepath: str, section_epub_id: str, toc_data=None):
+    """
+    Исходный текст секции из индекса; если книга не проиндексирована — извлекает из EPUB и сохраняет.
+    None — текст извлечь не удалось (в индекс не сохраняется).
+    """
+    text = workflow_cache_manager.load_section_source_text(book_id, section_id)
+    if text is not None:
+        return text
+    text = epub_parser.extract_section_text(epub_filepath, section_epub_id, toc_data)
+    if text is not None:
+        workflow_cache_manager.save_section_source_text(book_id, section_id, text)
+    return text
+
 def process_section_summarization(book_id: str, section_id: int, admin: bool = False):
     """
     Процессит суммаризацию одной секции.
@@ -290,9 +503,14 @@ def process_section_summarization(book_id: str, section_id: int, admin: bool = F
         # TODO: Реализовать получение контента секции по epub_filepath и section_epub_id в epub_parser DONE
         # Возможно, потребуется создать новый метод, который открывает EPUB по пути и извлекает контент конкретного файла по его ID DONE
         toc_data = book_info.get('toc', [])
-        section_content = epub_parser.extract_section_text(epub_filepath, section_epub_id, toc_data)
+        section_content = get_section_source_text(book_id, section_id, epub_filepath, section_epub_id, toc_data)
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
+        if section_content is None:
+            print(f"[WorkflowProcessor] ОШИБКА: Не удалось извлечь контент секции {section_epub_id} (ID: {section_id}).")
+            workflow_db_manager.update_section_stage_status_workflow(book_id, section_id, SUMMARIZATION_STAGE_NAME, 'error', error_message='Failed to extract section text')
+            return False
+
         if not section_content:
             print(f"[WorkflowProcessor] Предупреждение: Контент секции {section_epub_id} (ID: {section_id}) пуст или не может быть извлечен. Помечаем как completed_empty.")
             # Если контент пуст, считаем этап завершенным с пустым результатом
@@ -491,6 +709,7 @@ def transition_section_to_next_stage(book_id: str, section_id: int, current_stag
 
     try:
         with current_app.app_context():
+            workflow_db_manager.flush_pending_status_writes()
             section_info = workflow_db_manager.get_section_by_id_workflow(book_id, section_id)
             if not section_info:
                 print(f"[WorkflowProcessor] Ошибка перехода: Секция с ID {section_id} не найдена в БД.")
@@ -540,7 +759,7 @@ def update_overall_workflow_book_status(book_id):
     """
     Пересчитывает и обновляет общий статус книги в workflow на основе статусов этапов и секций.
     """
-    book_info = workflow_db_manager.get_book_workflow(book_id)
+    book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
     if not book_info:
         return False
     book_stage_statuses = book_info.get('book_stage_statuses', {})
@@ -582,10 +801,286 @@ def update_overall_workflow_book_status(book_id):
     return True
 
 # TODO: Добавить функцию start_book_workflow для запуска процесса для всей книги DONE
+def _process_section_for_stage(book_id: str, section_id: int, stage_name: str, app_instance: Flask, admin: bool, provider: str):
+    """Обрабатывает одну секцию этапа в рабочем потоке (со своим app context и соединением БД)."""
+    semaphore = get_provider_semaphore(provider)
+    with semaphore:
+        with app_instance.app_context():
+            try:
+                if stage_name == 'summarize':
+                    return process_section_summarization(book_id, section_id, admin=admin)
+                elif stage_name == 'translate':
+                    return process_section_translate(book_id, section_id, admin=admin)
+                return True  # Для других этапов по умолчанию не останавливаем
+            except Exception as e:
+                print(f"[WorkflowProcessor] ОШИБКА в потоке секции {section_id} (этап '{stage_name}'): {e}")
+                traceback.print_exc()
+                return False
+
+def _stage_needs_run(book_id: str, stage_name: str, is_per_section_stage: bool) -> bool:
+    """Нужно ли выполнять этап книги (для посекционных этапов статус пересчитывается по секциям)."""
+    book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+    book_stage_statuses = book_info.get('book_stage_statuses', {})
+    current_stage_status = book_stage_statuses.get(stage_name, {}).get('status', 'pending')
+
+    print(f"[WorkflowProcessor] Текущий статус этапа '{stage_name}' для книги {book_id}: '{current_stage_status}'.")
+
+    if current_stage_status in ['completed', 'completed_empty', 'skipped', 'passed']:
+        if is_per_section_stage:
+            # Статус этапа книги мог устареть (секции сброшены через «Повторить»).
+            # Пересчитываем статус этапа по реальному состоянию секций.
+            recalculate_book_stage_status(book_id, stage_name)
+            book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+            book_stage_statuses = book_info.get('book_stage_statuses', {})
+            current_stage_status = book_stage_statuses.get(stage_name, {}).get('status', 'pending')
+            print(f"[WorkflowProcessor] Пересчитанный статус этапа '{stage_name}': '{current_stage_status}'.")
+            if current_stage_status in ['completed', 'completed_empty', 'skipped', 'passed']:
+                print(f"[WorkflowProcessor] Этап '{stage_name}' для книги {book_id} уже завершен. Пропускаем.")
+                return False
+        else:
+            print(f"[WorkflowProcessor] Этап '{stage_name}' для книги {book_id} уже завершен. Пропускаем.")
+            return False
+    return True
+
+def _mark_section_stage_started(book_id: str, stage_name: str):
+    """Перед обработкой секций выставляет статус этапа книги в 'processing', если есть незавершенные секции."""
+    workflow_db_manager.flush_pending_status_writes()
+    sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
+    statuses = [s.get('stage_statuses', {}).get(stage_name, {}).get('status', 'pending') for s in sections]
+    if any(s in ['pending', 'queued', 'processing'] for s in statuses):
+        workflow_db_manager.update_book_stage_status_workflow(book_id, stage_name, 'processing')
+        update_overall_workflow_book_status(book_id)
+    return True
+
+def _finish_section_stage(book_id: str, stage_name: str):
+    """Все секции этапа обработаны: пересчет статуса этапа и книги."""
+    recalculate_book_stage_status(book_id, stage_name)
+    update_overall_workflow_book_status(book_id)
+    return True
+
+def _run_book_level_stage(book_id: str, stage_name: str, book_admin_mode: bool, ui_admin_mode: bool, graph: StageGraph) -> bool:
+    """Книжный этап (анализ, создание epub, сокращение и т.д.). False — критическая ошибка."""
+    result = True
+    if stage_name == 'analyze':
+        result = process_book_analysis(book_id, admin=book_admin_mode)
+        # Проверяем флаг ui_admin_mode после завершения анализа
+        if result and ui_admin_mode:
+            print(f"[WorkflowProcessor] Анализ завершен. Останавливаем workflow для редактирования (UI Admin mode).")
+            workflow_db_manager.update_book_stage_status_workflow(book_id, 'analyze', 'awaiting_edit')
+            update_overall_workflow_book_status(book_id)
+            graph.halt()
+            return True
+    elif stage_name == 'epub_creation':
+        result = process_book_epub_creation(book_id, admin=book_admin_mode)
+    elif stage_name == 'reduce_text':
+        workflow_db_manager.update_book_stage_status_workflow(book_id, 'reduce_text', 'passed', error_message='Этап упразднен')
+        result = True
+
+    if result is False:
+        print(f"[WorkflowProcessor] Критическая ошибка на книжном этапе '{stage_name}'. Останавливаем workflow.")
+        return False
+
+    # После завершения этапа обновляем общий статус книги
+    update_overall_workflow_book_status(book_id)
+    return True
+
+def toc_source_hash(toc_data, target_language: str) -> str:
+    """Хэш заголовков TOC и языка (ключ перевода TOC в манифесте сборки EPUB)."""
+    return hashlib.sha256(
+        json.dumps([target_language, [[item.get('id'), item['title']] for item in toc_data if item.get('title')]], ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+def prefetch_toc_translations(book_id: str, admin: bool = False):
+    """
+    Переводит заголовки TOC заранее (параллельно с секционными этапами): перевод попадает в кэш
+    toc_title_translations, и этап создания EPUB берет его оттуда без вызова модели.
+    Ошибка не критична — этап EPUB повторит перевод сам.
+    """
+    book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+    if not book_info:
+        return True
+    toc_data = book_info.get('toc', [])
+    target_language = book_info.get('target_language', 'russian')
+    titles = [item['title'] for item in toc_data if item.get('title')]
+    if not titles:
+        return True
+    previous_manifest = workflow_cache_manager.load_epub_build_manifest(book_id)
+    if (previous_manifest.get('version') == EPUB_MANIFEST_VERSION and previous_manifest.get('toc_translations')
+            and previous_manifest.get('toc_source_hash') == toc_source_hash(toc_data, target_language)):
+        return True
+    print(f"[WorkflowProcessor] Предварительный перевод {len(titles)} заголовков TOC для книги {book_id}")
+    translate_toc_titles_workflow(titles, target_language, admin=admin)
+    return True
+
+def compute_chapter_layout(book_id: str) -> Dict[int, Tuple[int, str]]:
+    """
+    Номера и заголовки глав EPUB по секциям {section_id: (chapter_index, chapter_title)} — так же,
+    как их вычисляет create_workflow_epub, если в книгу войдут все секции. Переводы заголовков TOC
+    берутся только из кэша (модель не вызывается). При расхождении с фактической сборкой
+    предварительный рендер просто не попадет в кэш.
+    """
+    book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
+    if not book_info:
+        return {}
+    target_language = book_info.get('target_language', 'russian')
+    toc_data = book_info.get('toc', []) or []
+    titles = [item['title'] for item in toc_data if item.get('title')]
+    if target_language == 'none':
+        translated_titles = titles
+    else:
+        title_keys = [toc_title_cache_key(title) for title in titles]
+        cached = workflow_db_manager.get_toc_title_translations(title_keys, target_language) if title_keys else {}
+        translated_titles = [cached.get(key) for key in title_keys]
+    translated_by_id = {}
+    for i, item in enumerate(toc_data):
+        if item.get('title') and item.get('id') and i < len(translated_titles) and translated_titles[i]:
+            translated_by_id[item['id']] = translated_titles[i].strip()
+
+    lang_code = target_language[:2] if target_language else "ru"
+    default_title_prefix = "Раздел" if lang_code == 'ru' else "Section"
+    layout = {}
+    for chapter_index, section in enumerate(workflow_db_manager.get_sections_for_book_workflow(book_id), start=1):
+        chapter_title = None
+        for t in toc_data:
+            if str(t.get('id')) == str(section['section_epub_id']):
+                chapter_title = translated_by_id.get(t.get('id')) or t.get('title')
+                break
+        layout[section['section_id']] = (chapter_index, chapter_title or f"{default_title_prefix} {chapter_index}")
+    return layout
+
+def prerender_section_chapter(book_id: str, section_id: int, get_layout) -> bool:
+    """
+    Рендерит тело главы переведенной секции в кэш рендера сразу после перевода секции,
+    чтобы сборка EPUB нашла главу готовой. Ошибка не критична — сборка отрендерит главу сама.
+    """
+    try:
+        import epub_section_renderer
+        chapter = get_layout().get(section_id)
+        raw_text = workflow_cache_manager.load_section_stage_result(book_id, section_id, 'translate')
+        if chapter and raw_text and raw_text.strip():
+            chapter_index, chapter_title = chapter
+            epub_section_renderer.render_section_body_cached(book_id, section_id, raw_text, chapter_title, chapter_index)
+    except Exception as e:
+        print(f"[WorkflowProcessor] Предварительный рендер секции {section_id} не удался: {e}")
+    return True
+
+def build_book_stage_graph(book_id: str, app_instance: Flask, book_admin_mode: bool, ui_admin_mode: bool) -> Tuple[StageGraph, Dict[str, Tuple[str, Optional[int]]]]:
+    """
+    Строит граф задач книги по этапам из workflow_stages (в порядке stage_order).
+
+    Зависимости:
+      - книжный этап ждет завершения предыдущего выполняемого этапа целиком;
+      - секция посекционного этапа после книжного этапа ждет этот этап;
+      - секция посекционного этапа после посекционного ждет только ту же секцию предыдущего этапа
+        (конвейер: секция k идет дальше, пока секция k+1 еще на предыдущем этапе);
+      - перевод TOC не зависит ни от чего и идет параллельно, создание EPUB ждет его;
+      - после перевода каждой секции ее глава рендерится в кэш (render:<id>), создание EPUB ждет эти задачи.
+    Уже завершенные этапы в граф не попадают.
+
+    Returns:
+        (граф, task_id -> (этап, section_id или None)).
+    """
+    graph = StageGraph(f"книга {book_id}")
+    task_stages: Dict[str, Tuple[str, Optional[int]]] = {}
+
+    def in_context(func, *args, **kwargs):
+        # Каждая задача выполняется в своем потоке — со своим app context и соединением БД
+        def task():
+            with app_instance.app_context():
+                return func(*args, **kwargs)
+        return task
+
+    stages = workflow_db_manager.get_all_stages_ordered_workflow()
+    print(f"[WorkflowProcessor] Определены этапы рабочего процесса: {[stage['stage_name'] for stage in stages]} (UI Admin: {ui_admin_mode}, Book Admin: {book_admin_mode})")
+
+    prev_barrier = None # задача, означающая завершение предыдущего выполняемого этапа
+    prev_start = None # стартовая задача предыдущего этапа, если он посекционный
+    prev_section_tasks: Dict[int, str] = {} # section_id -> задача предыдущего посекционного этапа
+
+    stages_to_run = [stage for stage in stages if _stage_needs_run(book_id, stage['stage_name'], stage.get('is_per_section', False))]
+
+    toc_task = None
+    if any(stage['stage_name'] == 'epub_creation' for stage in stages_to_run):
+        toc_task = graph.add_task('toc_titles', in_context(prefetch_toc_translations, book_id, admin=book_admin_mode))
+
+    # Секций книги одновременно не больше SECTION_PARALLELISM, даже если готовы секции разных этапов
+    section_slots = threading.BoundedSemaphore(SECTION_PARALLELISM)
+
+    # Раскладка глав вычисляется один раз, когда переведены заголовки TOC (см. compute_chapter_layout)
+    layout_cache = {}
+    layout_lock = threading.Lock()
+
+    def get_layout():
+        with layout_lock:
+            if 'layout' not in layout_cache:
+                layout_cache['layout'] = compute_chapter_layout(book_id)
+            return layout_cache['layout']
+
+    render_tasks = []
+
+    def section_task(section_id, stage_name, provider):
+        def task():
+            with section_slots:
+                return _process_section_for_stage(book_id, section_id, stage_name, app_instance, book_admin_mode, provider)
+        return task
+
+    for stage in stages_to_run:
+        stage_name = stage['stage_name']
+        is_per_section_stage = stage.get('is_per_section', False)
+
+        if is_per_section_stage:
+            start_deps = [prev_start] if prev_start else [prev_barrier]
+            start_task = graph.add_task(f"{stage_name}:start", in_context(_mark_section_stage_started, book_id, stage_name), start_deps)
+
+            workflow_db_manager.flush_pending_status_writes()
+            sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
+            pending_section_ids = [
+                s['section_id'] for s in sections
+                if s.get('stage_statuses', {}).get(stage_name, {}).get('status', 'pending')
+                not in ['completed', 'completed_empty', 'skipped', 'passed', 'censored']
+            ]
+            provider = get_stage_provider(stage_name)
+            section_tasks = {}
+            for section_id in pending_section_ids:
+                task_id = graph.add_task(
+                    f"{stage_name}:{section_id}",
+                    section_task(section_id, stage_name, provider),
+                    [start_task, prev_section_tasks.get(section_id)]
+                )
+                task_stages[task_id] = (stage_name, section_id)
+                section_tasks[section_id] = task_id
+                if stage_name == 'translate' and toc_task:
+                    render_tasks.append(graph.add_task(
+                        f"render:{section_id}", in_context(prerender_section_chapter, book_id, section_id, get_layout),
+                        [task_id, toc_task]
+                    ))
+            print(f"[WorkflowProcessor] Этап '{stage_name}' книги {book_id}: {len(section_tasks)} секций (провайдер {provider}).")
+
+            prev_barrier = graph.add_task(
+                f"{stage_name}:done", in_context(_finish_section_stage, book_id, stage_name),
+                [start_task] + list(section_tasks.values())
+            )
+            prev_start = start_task
+            prev_section_tasks = section_tasks
+        else:
+            deps = [prev_barrier]
+            if stage_name == 'epub_creation':
+                deps.append(toc_task)
+                deps.extend(render_tasks)
+            prev_barrier = graph.add_task(
+                stage_name, in_context(_run_book_level_stage, book_id, stage_name, book_admin_mode, ui_admin_mode, graph), deps
+            )
+            task_stages[prev_barrier] = (stage_name, None)
+            prev_start = None
+            prev_section_tasks = {}
+
+    return graph, task_stages
+
 def start_book_workflow(book_id: str, app_instance: Flask, admin: bool = None):
     """
     Запускает полный рабочий процесс для книги, начиная с первого незавершенного этапа.
-    После завершения каждого этапа автоматически переходит к следующему.
+    Этапы и секции выполняются по графу зависимостей (см. build_book_stage_graph):
+    каждая задача стартует, как только готовы ее входные данные.
     
     Args:
         book_id: ID книги
@@ -608,93 +1103,26 @@ def start_book_workflow(book_id: str, app_instance: Flask, admin: bool = None):
         admin = book_admin_mode
     ui_admin_mode = admin
 
-    # 3. Получаем список этапов
-    stages = workflow_db_manager.get_all_stages_ordered_workflow()
-    print(f"[WorkflowProcessor] Определены этапы рабочего процесса: {[stage['stage_name'] for stage in stages]} (UI Admin: {ui_admin_mode}, Book Admin: {book_admin_mode})")
-    
-    # Последовательно обрабатываем этапы
-    for stage in stages:
-        stage_name = stage['stage_name']
-        is_per_section_stage = stage.get('is_per_section', False)
-        
-        # Проверяем статус этапа на уровне КНИГИ (обновляем инфо каждый раз)
-        book_info = workflow_db_manager.get_book_workflow(book_id)
-        book_stage_statuses = book_info.get('book_stage_statuses', {})
-        current_stage_status = book_stage_statuses.get(stage_name, {}).get('status', 'pending')
-        
-        print(f"[WorkflowProcessor] Текущий статус этапа '{stage_name}' для книги {book_id}: '{current_stage_status}'.")
-        
-        if current_stage_status in ['completed', 'completed_empty', 'skipped', 'passed']:
-            if is_per_section_stage:
-                # Статус этапа книги мог устареть (секции сброшены через «Повторить»).
-                # Пересчитываем статус этапа по реальному состоянию секций.
-                recalculate_book_stage_status(book_id, stage_name)
-                book_info = workflow_db_manager.get_book_workflow(book_id)
-                book_stage_statuses = book_info.get('book_stage_statuses', {})
-                current_stage_status = book_stage_statuses.get(stage_name, {}).get('status', 'pending')
-                print(f"[WorkflowProcessor] Пересчитанный статус этапа '{stage_name}': '{current_stage_status}'.")
-                if current_stage_status in ['completed', 'completed_empty', 'skipped', 'passed']:
-                    print(f"[WorkflowProcessor] Этап '{stage_name}' для книги {book_id} уже завершен. Пропускаем.")
-                    continue
-            else:
-                print(f"[WorkflowProcessor] Этап '{stage_name}' для книги {book_id} уже завершен. Пропускаем.")
-                continue
-
-        # Запускаем обработку этапа
-        if is_per_section_stage:
-            # Перед началом обработки секций явно выставляем статус этапа книги в 'processing', если есть незавершённые секции
-            sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
-            statuses = [s.get('stage_statuses', {}).get(stage_name, {}).get('status', 'pending') for s in sections]
-            if any(s in ['pending', 'queued', 'processing'] for s in statuses):
-                workflow_db_manager.update_book_stage_status_workflow(book_id, stage_name, 'processing')
-                update_overall_workflow_book_status(book_id)
-
-            # Обработка всех секций для этапа
-            for section in sections:
-                section_id = section['section_id']
-                section_stage_status = section.get('stage_statuses', {}).get(stage_name, {}).get('status', 'pending')
-                if section_stage_status in ['completed', 'completed_empty', 'skipped', 'passed', 'censored']:
-                    continue
-                if stage_name == 'summarize':
-                    result = process_section_summarization(book_id, section_id, admin=book_admin_mode)
-                elif stage_name == 'translate':
-                    result = process_section_translate(book_id, section_id, admin=book_admin_mode)
-                else:
-                    result = True  # Для других этапов по умолчанию не останавливаем
-                
-                # ОСТАНОВКА ПРИ КРИТИЧЕСКОЙ ОШИБКЕ
-                if result is False:
-                    print(f"[WorkflowProcessor] Критическая ошибка при обработке секции {section_id} на этапе '{stage_name}'. Останавливаем.")
-                    workflow_db_manager.update_book_stage_status_workflow(book_id, stage_name, 'error', error_message=f"Critical error in section {section_id}")
-                    recalculate_book_stage_status(book_id, stage_name)
-                    update_overall_workflow_book_status(book_id)
-                    return False
-                time.sleep(0.1)
-            
+    # 3. Строим и выполняем граф задач
+    graph, task_stages = build_book_stage_graph(book_id, app_instance, book_admin_mode, ui_admin_mode)
+    # Один поток сверх параллелизма секций — для книжных и вспомогательных задач (TOC)
+    failed_task_id = graph.run(SECTION_PARALLELISM + 1)
+
+    if failed_task_id is not None:
+        stage_name, failed_section_id = task_stages.get(failed_task_id, (failed_task_id, None))
+        if failed_section_id is not None:
+            # ОСТАНОВКА ПРИ КРИТИЧЕСКОЙ ОШИБКЕ
+            print(f"[WorkflowProcessor] Критическая ошибка при обработке секции {failed_section_id} на этапе '{stage_name}'. Останавливаем.")
+            workflow_db_manager.update_book_stage_status_workflow(book_id, stage_name, 'error', error_message=f"Critical error in section {failed_section_id}")
             recalculate_book_stage_status(book_id, stage_name)
+            update_overall_workflow_book_status(book_id)
         else:
-            # Книжный этап (анализ, создание epub, сокращение и т.д.)
-            result = True
-            if stage_name == 'analyze':
-                result = process_book_analysis(book_id, admin=book_admin_mode)
-                # Проверяем флаг ui_admin_mode после завершения анализа
-                if result and ui_admin_mode:
-                    print(f"[WorkflowProcessor] Анализ завершен. Останавливаем workflow для редактирования (UI Admin mode).")
-                    workflow_db_manager.update_book_stage_status_workflow(book_id, 'analyze', 'awaiting_edit')
-                    update_overall_workflow_book_status(book_id)
-                    return True
-            elif stage_name == 'epub_creation':
-                result = process_book_epub_creation(book_id, admin=book_admin_mode)
-            elif stage_name == 'reduce_text':
-                workflow_db_manager.update_book_stage_status_workflow(book_id, 'reduce_text', 'passed', error_message='Этап упразднен')
-                result = True
-            
-            if result is False:
-                print(f"[WorkflowProcessor] Критическая ошибка на книжном этапе '{stage_name}'. Останавливаем workflow.")
-                return False
-        
-        # После завершения этапа обновляем общий статус книги
-        update_overall_workflow_book_status(book_id)
+            print(f"[WorkflowProcessor] Критическая ошибка в задаче '{failed_task_id}'. Workflow остановлен.")
+        return False
+
+    if graph.halted.is_set():
+        # Остановка для редактирования анализа
+        return True
     
     # ФИНАЛЬНОЕ ОБНОВЛЕНИЕ СТАТУСА КНИГИ
     # После завершения всех этапов проверяем, что все этапы завершены успешно
@@ -954,8 +1382,6 @@ def process_section_translate(book_id: str, section_id: int, admin: bool = False
     Процессит перевод одной секции.
     Если target_language == 'none', просто сохраняет оригинальный текст в кеш перевода.
     """
-    from epub_parser import extract_section_text
-
     TRANSLATION_PROMPT_EXT = ""  # Константа, можно будет подтянуть из конфига
 
     print(f"[WorkflowProcessor] Начат процесс перевода для секции {section_id} книги {book_id}")
@@ -992,8 +1418,14 @@ def process_section_translate(book_id: str, section_id: int, admin: bool = False
         toc_data = book_info.get('toc', [])
         
         # Извлекаем оригинальный текст (он очищенный)
-        section_text = extract_section_text(epub_path, section_epub_id, toc_data)
+        section_text = get_section_source_text(book_id, section_id, epub_path, section_epub_id, toc_data)
         
+        if section_text is None:
+            error_message = "Failed to extract section text."
+            print(f"[WorkflowProcessor] {error_message}")
+            workflow_db_manager.update_section_stage_status_workflow(book_id, section_id, 'translate', 'error', error_message=error_message)
+            return False
+
         if not section_text or not section_text.strip():
             error_message = "Section text is empty."
             print(f"[WorkflowProcessor] {error_message}")
@@ -1112,6 +1544,8 @@ def process_section_translate(book_id: str, section_id: int, admin: bool = False
                 workflow_cache_manager.save_section_stage_result(book_id, section_id, 'translate', "")
 
         workflow_db_manager.update_section_stage_status_workflow(book_id, section_id, 'translate', status, model_name=used_model, error_message=error_message)
+        if status == 'completed':
+            workflow_cache_manager.clear_translation_memory_bypass(book_id, section_id)
 
         # --- ВМЕСТО копирования статуса из одной секции ---
         recalculate_book_stage_status(book_id, 'translate')
@@ -1167,8 +1601,8 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
             error_message=None
         )
 
-        # 1. Получаем информацию о книге
-        book_info = workflow_db_manager.get_book_workflow(book_id)
+        # 1. Получаем информацию о книге (секции читаются ниже отдельным запросом)
+        book_info = workflow_db_manager.get_book_workflow(book_id, include_sections=False)
         if not book_info:
             raise Exception(f"Book {book_id} not found in workflow DB")
 
@@ -1182,24 +1616,42 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
         translated_sections = []
         translated_toc_titles = {}
         
+        # Манифест прошлой сборки: переведенный TOC, картинки и хэши глав (инкрементальная пересборка)
+        previous_manifest = workflow_cache_manager.load_epub_build_manifest(book_id)
+        if previous_manifest.get('version') != EPUB_MANIFEST_VERSION:
+            previous_manifest = {}
+        new_manifest = {'version': EPUB_MANIFEST_VERSION}
+
         # Получаем переведенные заголовки TOC
         toc_data = book_info.get('toc', [])
         if toc_data:
             toc_titles_for_translation = [item['title'] for item in toc_data if item.get('title')]
             if toc_titles_for_translation:
-                print(f"[WorkflowProcessor] Перевод {len(toc_titles_for_translation)} заголовков TOC...")
-                
-                # Используем новую функцию с правильными моделями и retry логикой
-                translated_titles = translate_toc_titles_workflow(toc_titles_for_translation, target_language, admin=admin)
-                
-                if translated_titles and len(translated_titles) == len(toc_titles_for_translation):
-                    for i, item in enumerate(toc_data):
-                        if item.get('title') and item.get('id'):
-                            translated_toc_titles[item['id']] = translated_titles[i].strip() if translated_titles[i] else None
-                    print(f"[WorkflowProcessor] TOC переведен: {len(translated_toc_titles)} заголовков")
+                toc_hash = toc_source_hash(toc_data, target_language)
+                if previous_manifest.get('toc_source_hash') == toc_hash and previous_manifest.get('toc_translations'):
+                    # Заголовки не менялись — берем перевод из прошлой сборки без вызова модели
+                    translated_toc_titles = previous_manifest['toc_translations']
+                    print(f"[WorkflowProcessor] TOC взят из манифеста прошлой сборки: {len(translated_toc_titles)} заголовков")
                 else:
-                    print(f"[WorkflowProcessor] ОШИБКА: Не удалось перевести оглавление или не совпало количество заголовков")
+                    print(f"[WorkflowProcessor] Перевод {len(toc_titles_for_translation)} заголовков TOC...")
+                    
+                    # Используем новую функцию с правильными моделями и retry логикой
+                    translated_titles = translate_toc_titles_workflow(toc_titles_for_translation, target_language, admin=admin)
+                    
+                    if translated_titles and len(translated_titles) == len(toc_titles_for_translation):
+                        for i, item in enumerate(toc_data):
+                            if item.get('title') and item.get('id'):
+                                translated_toc_titles[item['id']] = translated_titles[i].strip() if translated_titles[i] else None
+                        print(f"[WorkflowProcessor] TOC переведен: {len(translated_toc_titles)} заголовков")
+                    else:
+                        print(f"[WorkflowProcessor] ОШИБКА: Не удалось перевести оглавление или не совпало количество заголовков")
+                if translated_toc_titles:
+                    new_manifest['toc_source_hash'] = toc_hash
+                    new_manifest['toc_translations'] = translated_toc_titles
         
+        # Метаданные всех картинок книги одним запросом (без загрузки BLOB — иначе рост RSS и риск OOM)
+        comic_images_meta = workflow_db_manager.get_comic_images_meta_workflow(book_id)
+
         # Получаем переведенные секции
         for section in sections:
             section_id = section['section_id']
@@ -1209,19 +1661,19 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
             )
             
             # Проверяем наличие картинки, чтобы не пропускать секцию, если есть комикс
-            # ВАЖНО: не загружаем BLOB (иначе рост RSS и риск OOM)
-            has_image = workflow_db_manager.check_comic_image_exists(section_id)
+            has_image = section_id in comic_images_meta
             
             if (translated_text is None or not translated_text.strip()) and not has_image:
                 print(f"[WorkflowProcessor] Пропуск секции {section_id} ({epub_id}): нет перевода и нет комикса.")
                 continue
                 
+            # Текст не держим в памяти: глава перечитывает его из кэша в момент записи в архив
             translated_sections.append({
                 'section_id': section_id,
                 'section_epub_id': epub_id,
-                'translated_text': translated_text or "",
                 'has_image': has_image
             })
+            del translated_text
 
         if not translated_sections:
             raise Exception(f"No translated sections found for book {book_id}")
@@ -1236,12 +1688,8 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
         
         for section in translated_sections:
             epub_id = section['section_epub_id']
-            # Очищаем текст от маркера $$$$$ строго в конце
-            clean_text = re.sub(r'(?:\$\s*){3,}\s*$', '', section['translated_text']).strip()
-            
             sections_dict[epub_id] = {
                 'status': 'translated',
-                'translated_text': clean_text,
                 'internal_section_id': section['section_id']
             }
         
@@ -1253,7 +1701,10 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
             'section_ids_list': section_ids_list,  # Список ID секций в порядке spine
             'sections': sections_dict,  # Словарь с данными секций
             'toc': [],
-            'all_sections_raw': sections # Передаем список всех секций из БД для сопоставления
+            'all_sections_raw': sections, # Передаем список всех секций из БД для сопоставления
+            'comic_images_meta': comic_images_meta,
+            'previous_manifest': previous_manifest,
+            'new_manifest': new_manifest
         }
         
         # Отладочная информация
@@ -1278,53 +1729,21 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
             Создает EPUB в унифицированном формате (Unified Standard Rebuild).
             Максимальная совместимость с FBReader и другими читалками.
             Все главы в корне, расширение .xhtml, картинки в images/.
+            Главы и картинки пишутся в ZIP по одной (epub_stream_writer), книга целиком в памяти не собирается.
+            Возвращает путь к готовому файлу или None.
             """
-            from ebooklib import epub
-            import ebooklib
+            from epub_stream_writer import EpubStreamWriter, find_cover_in_epub
+            import epub_section_renderer
             import os
+            import zipfile
             import workflow_db_manager
-            import traceback
             import html
-            import re
-            import unicodedata
-            import tempfile
-            import io
             import uuid
-            from collections import defaultdict
             import gc
-            
-            # --- START OF UTILITIES ---
-            INVALID_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
-            BOLD_MD_RE = re.compile(r'\*\*(.*?)\*\*')
-            ITALIC_MD_RE = re.compile(r'\*(.*?)\*')
-            SUPERSCRIPT_MARKER_RE = re.compile(r"([\¹\²\³\⁰\⁴\⁵\⁶\⁷\⁸\⁹]+)")
-            NOTE_LINE_START_RE = re.compile(r"^\s*([\¹\²\³\⁰\⁴\⁵\⁶\⁷\⁸\⁹]+)\s*(.*)", re.UNICODE)
-            W_SUP_MAP = {'¹': '1', '²': '2', '³': '3', '⁰': '0', '⁴': '4', '⁵': '5', '⁶': '6', '⁷': '7', '⁸': '8', '⁹': '9'}
-
-            def get_int_from_superscript(marker_str):
-                if not marker_str: return -1
-                num_str = "".join(W_SUP_MAP.get(c, '') for c in marker_str)
-                try: return int(num_str) if num_str else -1
-                except ValueError: return -1
-
-            def remove_duplicate_title_from_text(text: str, expected_title: str) -> str:
-                if not text or not expected_title: return text
-                normalized_title = expected_title.strip().lower()
-                paragraphs = text.split('\n\n')
-                if not paragraphs: return text
-                first_para = paragraphs[0].strip()
-                if not first_para: return text
-                clean_for_comparison = re.sub(r'\*\*(.*?)\*\*', r'\1', first_para)
-                clean_for_comparison = re.sub(r'\*(.*?)\*', r'\1', clean_for_comparison)
-                clean_for_comparison = re.sub(r'^#+\s*', '', clean_for_comparison)
-                clean_for_comparison = clean_for_comparison.strip().lower()
-                if clean_for_comparison == normalized_title:
-                    return '\n\n'.join(paragraphs[1:]).strip()
-                return text
 
             # --- START OF ADAPTIVE LOGIC ---
-            all_sections_raw = book_info.get('all_sections_raw', [])
-            total_images = sum(1 for s in all_sections_raw if workflow_db_manager.check_comic_image_exists(s['section_id']))
+            comic_images_meta = book_info.get('comic_images_meta', {})
+            total_images = len(comic_images_meta)
             
             if total_images > 0:
                 # Квота байт на одну картинку на основе общего лимита (50МБ)
@@ -1348,45 +1767,12 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
                 target_quality = WORKFLOW_EPUB_QUALITY_RANGE[1]
                 quota_per_image = 1000 * 1024
 
-            def _compress_image_to_jpeg_bytes(raw_bytes: bytes) -> bytes:
-                """
-                Адаптивно сжимает картинку под заданную квоту и лимиты.
-                """
-                if not raw_bytes:
-                    return raw_bytes
-
-                # Если оригинал уже меньше квоты — не тратим ресурсы на сжатие
-                if len(raw_bytes) <= quota_per_image:
-                    return raw_bytes
-
-                try:
-                    from PIL import Image
-                    # Защита от огромных файлов (Decompression Bomb)
-                    Image.MAX_IMAGE_PIXELS = 100000000 # 100MP
-                    
-                    with Image.open(io.BytesIO(raw_bytes)) as im:
-                        # Если есть прозрачность — накладываем на белый фон, иначе она станет черной
-                        if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
-                            background = Image.new("RGB", im.size, (255, 255, 255))
-                            im = im.convert("RGBA")
-                            background.paste(im, mask=im.split()[3])
-                            im = background
-                        elif im.mode != "RGB":
-                            im = im.convert("RGB")
-                        
-                        w, h = im.size
-                        # Ресайз только если ширина больше целевой
-                        if w > target_width:
-                            new_h = int(h * (target_width / float(w)))
-                            im = im.resize((target_width, new_h), Image.Resampling.LANCZOS)
-                        
-                        # Однопроходное сохранение с вычисленным качеством
-                        buf = io.BytesIO()
-                        im.save(buf, format=WORKFLOW_EPUB_TARGET_FORMAT, quality=target_quality, optimize=True, dpi=(72, 72))
-                        return buf.getvalue()
-                except Exception as e:
-                    print(f"[EPUB_REBUILD] Ошибка адаптивного сжатия: {e}. Используем оригинал.")
-                    return raw_bytes
+            # Секции с картинками: сжимаются в пуле процессов (см. epub_image_pipeline) перед записью глав
+            image_section_ids = [
+                section_data.get('internal_section_id')
+                for section_data in book_info.get('sections', {}).values()
+                if section_data.get('internal_section_id') in comic_images_meta
+            ]
             # --- END OF ADAPTIVE LOGIC ---
 
             print(f"[EPUB_REBUILD] Начат процесс для книги: {book_info.get('filename')}")
@@ -1400,40 +1786,105 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
             epub_id_str = book_info.get('book_id', 'unknown-book-id')
             lang_code = target_language[:2] if target_language else "ru"
             
-            # 1. Инициализация книги
-            book = epub.EpubBook()
-            book.set_identifier(f"urn:uuid:{epub_id_str}-{target_language}")
-            book.set_title(f"{book_title_orig} ({target_language.capitalize()})")
-            book.set_language(lang_code)
-            book.add_author("EPUB Translator Tool")
+            # 1. Инициализация книги: архив пишется во временный файл рядом с итоговым
+            # (при ошибке вызывающий код удаляет недописанный .tmp)
+            output_path = book_info['output_path']
+            tmp_path = f"{output_path}.tmp"
+            writer = EpubStreamWriter(
+                tmp_path,
+                identifier=f"urn:uuid:{epub_id_str}-{target_language}",
+                title=f"{book_title_orig} ({target_language.capitalize()})",
+                language=lang_code,
+                author="EPUB Translator Tool"
+            )
+            # Вызывающий код закрывает writer в finally, если сборка упадет
+            book_info['writer'] = writer
             
-            # 2. Перенос обложки
+            # 2. Перенос обложки (читаем только OPF и саму картинку, без загрузки всей книги)
             if original_filepath and os.path.exists(original_filepath):
                 try:
-                    orig_book = epub.read_epub(original_filepath)
-                    cover_item = None
-                    for item_id in ['cover', 'cover-image', 'img-cover']:
-                        it = orig_book.get_item_with_id(item_id)
-                        if it and it.get_type() == ebooklib.ITEM_IMAGE:
-                            cover_item = it
-                            break
-                    if not cover_item:
-                        for it in orig_book.get_items_of_type(ebooklib.ITEM_IMAGE):
-                            if 'cover' in it.get_name().lower() or 'cover' in it.get_id().lower():
-                                cover_item = it
-                                break
-                    if cover_item:
-                        ext = os.path.splitext(cover_item.get_name())[1] or '.jpg'
+                    cover = find_cover_in_epub(original_filepath)
+                    if cover:
+                        cover_member, cover_media_type = cover
+                        ext = os.path.splitext(cover_member)[1] or '.jpg'
                         cover_name = f"cover{ext}"
-                        book.set_cover(cover_name, cover_item.get_content())
+                        with zipfile.ZipFile(original_filepath) as orig_zip, orig_zip.open(cover_member) as cover_stream:
+                            writer.add_cover(cover_name, cover_stream, cover_media_type)
                         print(f"[EPUB_REBUILD] Обложка сохранена как {cover_name}")
-                    del orig_book
                 except Exception as e:
                     print(f"[EPUB_REBUILD] Ошибка при извлечении обложки: {e}")
 
-            # 3. Обработка глав
-            chapters = []
+            # Картинки пишутся в архив сразу по готовности, сжатые кадры не накапливаются в памяти
+            previous_manifest = book_info.get('previous_manifest', {})
+            previous_archive = _epub_archive_fingerprint(book_id, output_path)
+            if previous_manifest.get('archive') is None or previous_manifest.get('archive') != previous_archive:
+                # Прошлый EPUB собран не этой сборкой (другая книга с тем же именем файла, ручная замена) — ничего не берем
+                previous_manifest = {}
+            new_manifest = book_info['new_manifest']
+            image_params = f"{quota_per_image}:{target_width}:{target_quality}:{WORKFLOW_EPUB_TARGET_FORMAT}"
+            new_manifest['images'] = {}
+            written_images = set()
+            def _write_comic_image(internal_id, image_bytes):
+                if image_bytes:
+                    writer.add_image(f"img_{internal_id}", f"images/comic_{internal_id}.jpg", image_bytes, "image/jpeg")
+                    written_images.add(internal_id)
+                    new_manifest['images'][str(internal_id)] = {
+                        'content_hash': comic_images_meta[internal_id]['content_hash'],
+                        'params': image_params
+                    }
+
+            # Кадры, не изменившиеся с прошлой сборки (тот же хэш содержимого и параметры сжатия),
+            # копируются из предыдущего EPUB без повторного декодирования/сжатия
+            previous_images = previous_manifest.get('images', {})
+            if previous_images and os.path.exists(output_path):
+                try:
+                    with zipfile.ZipFile(output_path) as previous_zip:
+                        previous_names = set(previous_zip.namelist())
+                        for internal_id in list(image_section_ids):
+                            entry = previous_images.get(str(internal_id))
+                            member = f"EPUB/images/comic_{internal_id}.jpg"
+                            if (entry and entry.get('params') == image_params and member in previous_names
+                                    and entry.get('content_hash') == comic_images_meta[internal_id]['content_hash']):
+                                with previous_zip.open(member) as image_stream:
+                                    writer.add_image(f"img_{internal_id}", f"images/comic_{internal_id}.jpg", image_stream, "image/jpeg")
+                                written_images.add(internal_id)
+                                new_manifest['images'][str(internal_id)] = entry
+                except (zipfile.BadZipFile, OSError, KeyError) as e:
+                    print(f"[EPUB_REBUILD] Не удалось использовать прошлый EPUB для картинок: {e}")
+                image_section_ids = [sid for sid in image_section_ids if sid not in written_images]
+                print(f"[EPUB_REBUILD] Из прошлой сборки перенесено картинок: {len(written_images)}, к сжатию: {len(image_section_ids)}")
+
+            if image_section_ids:
+                import epub_image_pipeline
+                epub_image_pipeline.compress_images(
+                    image_section_ids,
+                    workflow_db_manager.get_comic_image_workflow,
+                    len(image_section_ids),
+                    quota_per_image,
+                    target_width,
+                    target_quality,
+                    WORKFLOW_EPUB_TARGET_FORMAT,
+                    on_result=_write_comic_image
+                )
+                gc.collect()
+
+            # 3. Обработка глав (каждая глава сразу пишется в архив)
+            # Ключ главы — хэш всех ее входных данных (текст, заголовок, номер, картинка, шаблон).
+            # Глава с тем же ключом, что в прошлой сборке, копируется из прошлого EPUB без рендера.
+            chapter_keys = new_manifest['chapters'] = {}
+            previous_chapters = previous_manifest.get('chapters', {})
+            previous_zip = None
+            previous_names = set()
+            if previous_chapters and os.path.exists(output_path):
+                try:
+                    previous_zip = zipfile.ZipFile(output_path)
+                    previous_names = set(previous_zip.namelist())
+                except (zipfile.BadZipFile, OSError) as e:
+                    print(f"[EPUB_REBUILD] Не удалось открыть прошлый EPUB для глав: {e}")
+            reused_chapters = 0
             default_title_prefix = "Раздел" if lang_code == 'ru' else "Section"
+            # Компактный CSS для лучшей совместимости
+            css = "<style>body{font-family: serif; margin: 0.5em; line-height: 1.5;} h1{text-align: center; margin-bottom: 1.2em; border-bottom: 1px solid #eee; padding-bottom: 0.5em;} p{margin: 0.5em 0; text-indent: 1.2em;} img{width: 100% !important; height: auto !important; display: block; margin: 1em auto; border-radius: 4px;}</style>"
             
             for i, epub_id in enumerate(section_ids):
                 chapter_index = i + 1
@@ -1454,195 +1905,90 @@ def process_book_epub_creation(book_id: str, admin: bool = False):
                 is_service = any(st in chapter_title.lower() for st in service_titles) or \
                              any(st in str(epub_id).lower() for st in service_titles)
 
-                # Текст и очистка
-                raw_text = section_data.get('translated_text', '')
-                clean_text = re.sub(r'(?:\$\s*){3,}\s*$', '', raw_text).strip()
-                clean_text = remove_duplicate_title_from_text(clean_text, chapter_title)
+                # Текст (читаем из кэша только на время записи главы)
+                raw_text = (workflow_cache_manager.load_section_stage_result(book_id, internal_id, 'translate') or '') if internal_id else ''
+
+                # Имя файла главы
+                file_name = f"section_{chapter_index:03d}.xhtml"
+                image_entry = new_manifest['images'].get(str(internal_id)) if internal_id in written_images else None
+                chapter_key = hashlib.sha256(json.dumps(
+                    [epub_section_renderer.RENDERER_VERSION, lang_code, css, chapter_title, chapter_index, is_service, image_entry, raw_text],
+                    ensure_ascii=False
+                ).encode('utf-8')).hexdigest()
+                previous_member = f"EPUB/{file_name}"
+                if previous_zip and previous_chapters.get(file_name) == chapter_key and previous_member in previous_names:
+                    writer.add_chapter(f"chapter_{chapter_index:03d}", file_name, chapter_title, previous_zip.read(previous_member))
+                    chapter_keys[file_name] = chapter_key
+                    reused_chapters += 1
+                    del raw_text
+                    continue
                 
                 # Сборка HTML
                 final_html_body = ""
                 if not is_service:
                     final_html_body += f"<h1>{html.escape(chapter_title)}</h1>\n"
                 
-                # Изображение комикса
-                if internal_id:
-                    image_data = workflow_db_manager.get_comic_image_workflow(internal_id)
-                    if image_data:
-                        # Адаптивное сжатие в памяти
-                        compressed = _compress_image_to_jpeg_bytes(image_data)
-
-                        img_name = f"comic_{internal_id}.jpg"
-                        img_path = f"images/{img_name}"
-                        img_item = epub.EpubItem(
-                            uid=f"img_{internal_id}",
-                            file_name=img_path,
-                            content=compressed,
-                            media_type="image/jpeg"
-                        )
-                        book.add_item(img_item)
-                        final_html_body += f'<div style="text-align: center; margin: 1.2em 0;"><img src="{img_path}" alt="Illustration" style="width: 100% !important; height: auto !important; border-radius: 4px;"/></div>\n'
-                        
-                        # Освобождаем память немедленно
-                        del compressed
-                        del image_data
-                        gc.collect()
-
-                # --- FOOTNOTE LOGIC ---
-                if clean_text:
-                    original_paragraphs = clean_text.split('\n\n')
-                    note_targets_found = set()
-                    
-                    # 1. Сбор определений (проходим по всем строкам всех параграфов)
-                    for p_raw in original_paragraphs:
-                        for line in p_raw.strip().split('\n'):
-                            m = NOTE_LINE_START_RE.match(line.strip())
-                            if m:
-                                num = get_int_from_superscript(m.group(1))
-                                if num > 0:
-                                    note_targets_found.add(num)
-
-                    # 2. Рендеринг параграфов
-                    ref_counters = defaultdict(int)
-                    def_counters = defaultdict(int)
-                    
-                    for p_raw in original_paragraphs:
-                        p_strip = p_raw.strip()
-                        if not p_strip: continue
-                        
-                        # Проверяем, является ли этот параграф (или любая его строка) определением сноски
-                        is_def_para = any(NOTE_LINE_START_RE.match(l.strip()) for l in p_strip.split('\n'))
-                        
-                        if is_def_para:
-                            f_lines = []
-                            for line in p_strip.split('\n'):
-                                line_s = line.strip()
-                                if not line_s: continue
-                                m = NOTE_LINE_START_RE.match(line_s)
-                                if m:
-                                    marker, note_text = m.groups()
-                                    num = get_int_from_superscript(marker)
-                                    if num > 0:
-                                        def_counters[num] += 1
-                                        occ = def_counters[num]
-                                        note_id = f"note_{chapter_index}_{num}_{occ}"
-                                        ref_id = f"ref_{chapter_index}_{num}_{occ}"
-                                        
-                                        n_cleaned = INVALID_XML_CHARS_RE.sub('', note_text)
-                                        n_html = html.escape(n_cleaned)
-                                        n_html = BOLD_MD_RE.sub(r'<strong>\1</strong>', n_html)
-                                        n_html = ITALIC_MD_RE.sub(r'<em>\1</em>', n_html)
-                                        
-                                        backlink = f' <a href="#{ref_id}" class="footnote-backlink" title="Back">↩</a>'
-                                        f_lines.append(f'<p class="footnote-definition" id="{note_id}"><small>{marker}</small> {n_html}{backlink}</p>')
-                                    else:
-                                        f_lines.append(f'<p>{html.escape(line_s)}</p>')
-                                else:
-                                    f_lines.append(f'<p>{html.escape(line_s)}</p>')
-                            
-                            if f_lines:
-                                final_html_body += f'<div class="footnote-block" style="font-size: 0.9em; border-top: 1px solid #eee; margin-top: 2em; padding-top: 1em;">\n{"".join(f_lines)}\n</div>'
-                        else:
-                            # Обычный параграф
-                            text_norm = unicodedata.normalize('NFC', p_strip)
-                            text_clean = INVALID_XML_CHARS_RE.sub('', text_norm)
-                            p_html = html.escape(text_clean).replace('\n', '<br/>')
-                            p_html = BOLD_MD_RE.sub(r'<strong>\1</strong>', p_html)
-                            p_html = ITALIC_MD_RE.sub(r'<em>\1</em>', p_html)
-                            
-                            # Замена маркеров на ссылки
-                            # Важно: ищем маркеры в ESCAPED строке, т.к. сами маркеры (¹²) не меняются при escape
-                            markers = sorted(list(SUPERSCRIPT_MARKER_RE.finditer(p_html)), key=lambda x: x.start(), reverse=True)
-                            for m in markers:
-                                marker = m.group(1)
-                                num = get_int_from_superscript(marker)
-                                if num > 0 and num in note_targets_found:
-                                    ref_counters[num] += 1
-                                    occ = ref_counters[num]
-                                    note_id = f"note_{chapter_index}_{num}_{occ}"
-                                    ref_id = f"ref_{chapter_index}_{num}_{occ}"
-                                    link = f'<sup class="footnote-ref"><a id="{ref_id}" href="#{note_id}">{marker}</a></sup>'
-                                    p_html = p_html[:m.start()] + link + p_html[m.end():]
-                            
-                            final_html_body += f"<p>{p_html}</p>\n"
+                # Изображение комикса (уже записано в архив пайплайном сжатия)
+                if internal_id in written_images:
+                    img_path = f"images/comic_{internal_id}.jpg"
+                    final_html_body += f'<div style="text-align: center; margin: 1.2em 0;"><img src="{img_path}" alt="Illustration" style="width: 100% !important; height: auto !important; border-radius: 4px;"/></div>\n'
+
+                # Абзацы и сноски: рендер из кэша, если текст, заголовок и номер главы не изменились
+                final_html_body += epub_section_renderer.render_section_body_cached(
+                    book_id, internal_id, raw_text, chapter_title, chapter_index
+                )
+                del raw_text
                 
                 if not final_html_body:
                     final_html_body = "<p> </p>"
-
-                # Создание EpubHtml айтема
-                file_name = f"section_{chapter_index:03d}.xhtml"
-                chapter = epub.EpubHtml(
-                    title=chapter_title,
-                    file_name=file_name,
-                    lang=lang_code,
-                    uid=str(epub_id)
-                )
-                
-                # Компактный CSS для лучшей совместимости
-                css = "<style>body{font-family: serif; margin: 0.5em; line-height: 1.5;} h1{text-align: center; margin-bottom: 1.2em; border-bottom: 1px solid #eee; padding-bottom: 0.5em;} p{margin: 0.5em 0; text-indent: 1.2em;} img{width: 100% !important; height: auto !important; display: block; margin: 1em auto; border-radius: 4px;}</style>"
                 
                 # Чистый XHTML
                 xhtml_content = f'<?xml version="1.0" encoding="utf-8"?><!DOCTYPE html><html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{lang_code}"><head><title>{html.escape(chapter_title)}</title>{css}</head><body>{final_html_body}</body></html>'
-                chapter.content = xhtml_content.encode('utf-8', 'xmlcharrefreplace')
-                
-                book.add_item(chapter)
-                chapters.append(chapter)
-
-            # 4. Финализация (NCX, NAV, Spine)
-            book.toc = tuple(chapters)
-            book.spine = ['nav'] + chapters
-            book.add_item(epub.EpubNcx())
-            book.add_item(epub.EpubNav())
-
-            # 5. Сборка в байты
-            t_path = None
-            try:
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".epub") as tf:
-                    t_path = tf.name
-                epub.write_epub(t_path, book, {})
-                with open(t_path, 'rb') as f:
-                    data = f.read()
-                print(f"[EPUB_REBUILD] Файл успешно собран: {len(data)} байт.")
-                return data
-            except Exception as e:
-                print(f"[EPUB_REBUILD] Ошибка при финальной записи: {e}")
-                traceback.print_exc()
-                return None
-            finally:
-                if t_path and os.path.exists(t_path):
-                    try: os.remove(t_path)
-                    except: pass
-                import gc
-                gc.collect()
-        
-        epub_bytes = create_workflow_epub(epub_book_info, target_language)
+                chapter_bytes = xhtml_content.encode('utf-8', 'xmlcharrefreplace')
+                writer.add_chapter(f"chapter_{chapter_index:03d}", file_name, chapter_title, chapter_bytes)
+                chapter_keys[file_name] = chapter_key
+
+            if previous_zip:
+                previous_zip.close()
+            if previous_chapters:
+                print(f"[EPUB_REBUILD] Глав перенесено из прошлой сборки: {reused_chapters}, собрано заново: {len(chapter_keys) - reused_chapters}")
+
+            # 4. Финализация (OPF, NCX, NAV) и атомарная подмена файла
+            writer.close()
+            os.replace(tmp_path, output_path)
+            print(f"[EPUB_REBUILD] Файл успешно собран: {os.path.getsize(output_path)} байт.")
+            new_manifest['archive'] = _epub_archive_fingerprint(book_id, output_path)
+            workflow_cache_manager.save_epub_build_manifest(book_id, new_manifest)
+            return output_path
         
-        if not epub_bytes:
-            raise Exception("Failed to create EPUB file")
-
-        # Сохраняем EPUB файл
+        # Итоговый путь EPUB: архив пишется сразу туда (через .tmp), без промежуточных байтов в памяти
         output_dir = UPLOADS_DIR / "translated"
         os.makedirs(output_dir, exist_ok=True)
         base_name = os.path.splitext(book_info.get('filename', 'translated_book'))[0]
         output_filename = f"{base_name}_{target_language}.epub"
         epub_file_path = output_dir / output_filename
-        with open(epub_file_path, 'wb') as f:
-            f.write(epub_bytes)
-        if not epub_file_path:
+        epub_book_info['output_path'] = str(epub_file_path)
+
+        try:
+            epub_result_path = create_workflow_epub(epub_book_info, target_language)
+        finally:
+            # После успешной сборки архив уже закрыт, а .tmp переименован — abort ничего не делает
+            writer = epub_book_info.pop('writer', None)
+            if writer:
+                writer.abort()
+            tmp_epub_path = f"{epub_file_path}.tmp"
+            if os.path.exists(tmp_epub_path):
+                try: os.remove(tmp_epub_path)
+                except OSError: pass
+
+        if not epub_result_path:
             raise Exception("Failed to create EPUB file")
         print(f"[WorkflowProcessor] EPUB успешно создан: {epub_file_path}")
         
         # Освобождаем память после сохранения
-        print("[WorkflowProcessor] Освобождение памяти после создания EPUB...")
-        try:
-            if 'epub_bytes' in locals():
-                del epub_bytes
-            if 'epub_book_info' in locals():
-                del epub_book_info
-            import gc
-            gc.collect()
-            print("[WorkflowProcessor] Память освобождена")
-        except Exception as mem_err:
-            print(f"[WorkflowProcessor] ОШИБКА при освобождении памяти: {mem_err}")
+        del epub_book_info
+        import gc
+        gc.collect()
         
         status_to_set = 'completed'
         error_message_to_set = None
@@ -1689,17 +2035,23 @@ def recalculate_book_stage_status(book_id, stage_name):
         print(f"[WorkflowProcessor] recalculate_book_stage_status: этап '{stage_name}' не per-section, статус не пересчитывается.")
         return
     # --- Дальше обычная логика для per-section этапов ---
-    sections = workflow_db_manager.get_sections_for_book_workflow(book_id)
-    statuses = [s.get('stage_statuses', {}).get(stage_name, {}).get('status', 'pending') for s in sections]
-    if not statuses:
+    # Считаем по материализованным счетчикам {status: count}, не загружая секции.
+    # Секции без записи статуса считаются 'pending'.
+    workflow_db_manager.flush_pending_status_writes()
+    counts = workflow_db_manager.get_stage_section_counts_workflow(book_id, stage_name)
+    total_sections = workflow_db_manager.get_section_count_for_book_workflow(book_id)
+    missing = total_sections - sum(counts.values())
+    if missing > 0:
+        counts['pending'] = counts.get('pending', 0) + missing
+    if not total_sections:
         status = 'pending'
-    elif all(s == 'pending' for s in statuses):
+    elif counts.get('pending', 0) == total_sections:
         status = 'pending'
-    elif any(s in ['processing', 'queued'] for s in statuses):
+    elif any(counts.get(s) for s in ['processing', 'queued']):
         status = 'processing'
-    elif any(isinstance(s, str) and s.startswith('error') for s in statuses):
+    elif any(s.startswith('error') for s in counts):
         status = 'completed_with_errors'
-    elif all(s in ['completed', 'completed_empty', 'skipped', 'passed'] for s in statuses):
+    elif all(s in ['completed', 'completed_empty', 'skipped', 'passed'] for s in counts):
         status = 'completed'
     else:
         status = 'processing'
@@ -1824,8 +2176,10 @@ def retrigger_section_translation(book_id: str, section_id: int):
     try:
         from flask import current_app
         
-        # 1. Удаляем кэш
+        # 1. Удаляем кэш (и чекпоинты чанков, чтобы перевод действительно выполнился заново)
         workflow_cache_manager.delete_section_stage_result(book_id, section_id, 'translate')
+        workflow_cache_manager.delete_chunk_checkpoints(book_id, section_id)
+        workflow_cache_manager.set_translation_memory_bypass(book_id, section_id)
         
         # 2. Сбрасываем статус секции в БД
         workflow_db_manager.update_section_stage_status_workflow(
@@ -0,0 +1,103 @@
+# --- START OF FILE workflow_stage_graph.py ---
+
+"""
+Планировщик задач workflow книги по графу зависимостей.
+
+Раньше этапы выполнялись строго по очереди: этап целиком (все секции) -> следующий этап.
+Здесь каждая задача (секция этапа, книжный этап, вспомогательная задача) запускается,
+как только завершены ее зависимости, поэтому независимые цепочки идут параллельно,
+а время книги стремится к длине самой длинной цепочки, а не к сумме этапов.
+
+Семантика ошибок та же, что у process_stage_sections_concurrently: задача, вернувшая False
+(или упавшая с исключением), — критическая ошибка; новые задачи больше не запускаются,
+уже запущенные дорабатывают до конца. halt() — такая же остановка, но без ошибки
+(например, ожидание редактирования анализа).
+"""
+
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+class StageGraph:
+    def __init__(self, name: str):
+        self.name = name
+        self.tasks: Dict[str, Callable[[], Optional[bool]]] = {}
+        self.deps: Dict[str, List[str]] = {}
+        self.completed: List[str] = []
+        self.halted = threading.Event()
+
+    def add_task(self, task_id: str, func: Callable[[], Optional[bool]], deps: Iterable[str] = ()) -> str:
+        """
+        Добавляет задачу. Зависимости должны быть добавлены раньше — так граф всегда ацикличен.
+        Задачи без взаимных зависимостей запускаются в порядке добавления.
+        """
+        if task_id in self.tasks:
+            raise ValueError(f"Задача '{task_id}' уже добавлена")
+        deps = [dep for dep in dict.fromkeys(deps) if dep is not None]
+        unknown = [dep for dep in deps if dep not in self.tasks]
+        if unknown:
+            raise ValueError(f"Задача '{task_id}' зависит от неизвестных задач: {unknown}")
+        self.tasks[task_id] = func
+        self.deps[task_id] = deps
+        return task_id
+
+    def halt(self):
+        """Не запускать новые задачи (без ошибки); запущенные дорабатывают."""
+        self.halted.set()
+
+    def _execute(self, task_id: str):
+        try:
+            return self.tasks[task_id]()
+        except Exception as e:
+            print(f"[StageGraph] ОШИБКА в задаче '{task_id}' ({self.name}): {e}")
+            traceback.print_exc()
+            return False
+
+    def run(self, max_workers: int) -> Optional[str]:
+        """
+        Выполняет граф не более чем в max_workers потоках.
+
+        Returns:
+            id первой задачи с критической ошибкой или None, если ошибок не было.
+        """
+        if not self.tasks:
+            return None
+
+        waiting = {task_id: len(deps) for task_id, deps in self.deps.items()}
+        dependents: Dict[str, List[str]] = {task_id: [] for task_id in self.tasks}
+        for task_id, deps in self.deps.items():
+            for dep in deps:
+                dependents[dep].append(task_id)
+        ready = deque(task_id for task_id, count in waiting.items() if count == 0)
+
+        failed_task_id = None
+        in_flight = {}
+        workers = max(1, min(max_workers, len(self.tasks)))
+        print(f"[StageGraph] {self.name}: {len(self.tasks)} задач, потоков {workers}.")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage-graph") as executor:
+            def fill():
+                while ready and len(in_flight) < workers and failed_task_id is None and not self.halted.is_set():
+                    task_id = ready.popleft()
+                    in_flight[executor.submit(self._execute, task_id)] = task_id
+
+            fill()
+            while in_flight:
+                done, _ = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_id = in_flight.pop(future)
+                    if future.result() is False:
+                        if failed_task_id is None:
+                            failed_task_id = task_id
+                        continue
+                    self.completed.append(task_id)
+                    for dependent in dependents[task_id]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            ready.append(dependent)
+                fill()
+
+        return failed_task_id
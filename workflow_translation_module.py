@@ -4,6 +4,9 @@ import traceback
 import base64
 from typing import Optional, List, Dict, Any
 import requests # Импорт для выполнения HTTP запросов
+import http_client
+import provider_rate_limiter
+import model_circuit_breaker
 import json # Импорт для работы с JSON
 import time # Импорт для задержки при ретраях
 import google.generativeai as genai # Импорт для Google API
@@ -11,6 +14,14 @@ import google.auth
 import vertexai
 from vertexai.generative_models import GenerativeModel, Part, FinishReason, SafetySetting, HarmCategory, HarmBlockThreshold
 import workflow_model_config
+import workflow_cache_manager
+import glossary_index
+import token_estimator
+import hashlib
+import unicodedata
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Константа для обозначения ошибки лимита контекста
 # TODO: Возможно, стоит перенести в класс или конфиг
@@ -30,6 +41,16 @@ CHUNK_SIZE_LIMIT_CHARS = 30000
 # Отдельный лимит для анализа - должен быть больше, чтобы вместить всю суммаризацию книги
 ANALYSIS_CHUNK_SIZE_LIMIT_CHARS = 100000
 
+# Планирование чанков по токенам (оценка — token_estimator, калибруется по usage провайдеров)
+MAX_COMPLETION_TOKENS = 65536
+# Для перевода через OpenRouter/LiteRouter max_tokens = лимит ответа минус этот запас
+TRANSLATE_MAX_TOKENS_MARGIN = 5000
+# Запас токенов промпта сверх шаблона: глоссарий, предыдущий контекст, доп. инструкции
+PROMPT_RESERVE_TOKENS = 3000
+# Какую долю бюджета токенов заполнять (погрешность оценки)
+CHUNK_BUDGET_FILL = 0.9
+MIN_CHUNK_SIZE_CHARS = 2000
+
 # Проверка результата суммаризации: при исходном тексте длиннее этого порога результат должен быть минимум в 2 раза короче
 MIN_SOURCE_LENGTH_FOR_SUMMARY_RATIO_CHECK = 1000
 SUMMARY_MAX_RATIO_OF_SOURCE = 2  # суммаризация должна быть не длиннее len(source) / SUMMARY_MAX_RATIO_OF_SOURCE
@@ -209,14 +230,125 @@ Text to Analyze:
     },
 }
 
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ЧАНКОВ ОДНОЙ СЕКЦИИ (opt-in) ---
+PARALLEL_CHUNKS_ENABLED = os.getenv("WORKFLOW_PARALLEL_CHUNKS", "0") == "1"
+PARALLEL_CHUNKS_MAX_WORKERS = max(1, int(os.getenv("WORKFLOW_PARALLEL_CHUNKS_MAX_WORKERS", "3")))
+# Только операции, где чанки переводятся независимо друг от друга
+PARALLEL_CHUNK_OPERATIONS = ('translate', 'summarize')
+# Лимит одновременных запросов чанков к провайдеру (общий для всех секций процесса)
+CHUNK_PROVIDER_CONCURRENCY_LIMITS = {
+    'literouter': max(1, int(os.getenv("WORKFLOW_LITEROUTER_CHUNK_CONCURRENCY", "2"))),
+    'openrouter': max(1, int(os.getenv("WORKFLOW_OPENROUTER_CHUNK_CONCURRENCY", "4"))),
+    'vertex': max(1, int(os.getenv("WORKFLOW_VERTEX_CHUNK_CONCURRENCY", "4"))),
+    'google': max(1, int(os.getenv("WORKFLOW_GOOGLE_CHUNK_CONCURRENCY", "2"))),
+}
+
+_chunk_provider_semaphores = {}
+_chunk_provider_semaphores_lock = threading.Lock()
+
+def get_chunk_provider_semaphore(provider: str) -> threading.BoundedSemaphore:
+    """Возвращает (создавая при необходимости) семафор запросов чанков к провайдеру."""
+    with _chunk_provider_semaphores_lock:
+        semaphore = _chunk_provider_semaphores.get(provider)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(CHUNK_PROVIDER_CONCURRENCY_LIMITS.get(provider, 1))
+            _chunk_provider_semaphores[provider] = semaphore
+        return semaphore
+
+# --- STREAMING ОТВЕТОВ МОДЕЛЕЙ ---
+# Потоковый режим для OpenRouter/LiteRouter (SSE) и Vertex: мертвое соединение обнаруживается за секунды.
+STREAMING_ENABLED = os.getenv("WORKFLOW_STREAMING", "1") == "1"
+# Сколько секунд можно не получать новые токены, прежде чем считать ответ зависшим.
+STREAM_STALL_SECONDS = int(os.getenv("WORKFLOW_STREAM_STALL_SECONDS", "60"))
+# Ожидание ПЕРВОГО токена (модели с рассуждениями долго "думают" перед ответом).
+STREAM_FIRST_TOKEN_SECONDS = int(os.getenv("WORKFLOW_STREAM_FIRST_TOKEN_SECONDS", "300"))
+# Как часто watchdog проверяет поток (секунды).
+STREAM_WATCHDOG_INTERVAL = 1.0
+
+# --- ПАМЯТЬ ПЕРЕВОДОВ (content-addressed, общая для всех книг) ---
+TRANSLATION_MEMORY_ENABLED = os.getenv("WORKFLOW_TRANSLATION_MEMORY", "1") == "1"
+TRANSLATION_MEMORY_MAX_MB = int(os.getenv("WORKFLOW_TRANSLATION_MEMORY_MAX_MB", "200"))
+TRANSLATION_MEMORY_EVICT_EVERY = 50 # проверять размер после каждых N записей
+# Не запоминаем служебные ответы-ошибки
+_TRANSLATION_MEMORY_REJECT = (CONTEXT_LIMIT_ERROR, EMPTY_RESPONSE_ERROR, SAFETY_FILTER_ERROR, "__LITEROUTER_CONFIG_REQUIRED__")
+
+_translation_memory_stats = {'hits': 0, 'misses': 0, 'writes': 0}
+_translation_memory_lock = threading.Lock()
+
+def _normalize_for_memory(text: str) -> str:
+    """Нормализация текста для ключа памяти: NFC, единые переносы, схлопнутые пробелы."""
+    text = unicodedata.normalize('NFC', text or "").replace('\r\n', '\n')
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return text.strip()
+
+def get_translation_memory_stats() -> dict:
+    """Метрики памяти переводов (процесс + БД) для мониторинга."""
+    with _translation_memory_lock:
+        stats = dict(_translation_memory_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+    stats['enabled'] = TRANSLATION_MEMORY_ENABLED
+    try:
+        import workflow_db_manager
+        stats.update(workflow_db_manager.get_translation_memory_db_stats())
+    except Exception:
+        pass
+    return stats
+
+class StreamStallError(Exception):
+    """Потоковый ответ перестал приходить (watchdog) или оборвался."""
+    pass
+
+def determine_api_type(model_name: str) -> str:
+    """
+    Определяет тип API на основе имени модели.
+    vertex/ -> vertex
+    models/ -> google
+    literouter/ -> literouter
+    Все остальное -> openrouter
+    """
+    if not model_name:
+        return "openrouter"
+
+    if model_name.startswith('vertex/'):
+        return "vertex"
+    elif model_name.startswith('models/'):
+        return "google"
+    elif model_name.startswith('literouter/'):
+        return "literouter"
+    else:
+        # Все модели без спец-префиксов (включая deepseek/, openrouter/, nvidia/ и т.д.) 
+        # считаются идущими через OpenRouter
+        return "openrouter"
+
 # --- НОВЫЙ КЛАСС WorkflowTranslator ---
 class WorkflowTranslator:
     OPENROUTER_API_URL = "https://openrouter.ai/api/v1"
     LITEROUTER_API_URL = "https://api.literouter.com/v1"
     
     # Реестр заблокированных провайдеров (на уровне класса)
-    # Если провайдер попал сюда, он будет пропускаться во всех операциях до перезапуска
+    # Если провайдер попал сюда, он пропускается во всех операциях, пока не истечет PROVIDER_DISABLE_SECONDS
     DISABLED_PROVIDERS = set()
+    DISABLED_PROVIDERS_SINCE = {} # provider -> time.time() блокировки
+    PROVIDER_DISABLE_SECONDS = int(os.getenv("WORKFLOW_PROVIDER_DISABLE_SECONDS", "3600"))
+
+    @classmethod
+    def _disable_provider(cls, provider: str):
+        """Блокирует провайдера (лимиты/настройки) на PROVIDER_DISABLE_SECONDS."""
+        cls.DISABLED_PROVIDERS.add(provider)
+        cls.DISABLED_PROVIDERS_SINCE[provider] = time.time()
+
+    @classmethod
+    def _release_expired_providers(cls):
+        """Снимает блокировку с провайдеров, у которых истек срок (следующий вызов станет пробой)."""
+        now = time.time()
+        for provider in list(cls.DISABLED_PROVIDERS):
+            since = cls.DISABLED_PROVIDERS_SINCE.get(provider, now)
+            if now - since >= cls.PROVIDER_DISABLE_SECONDS:
+                cls.DISABLED_PROVIDERS.discard(provider)
+                cls.DISABLED_PROVIDERS_SINCE.pop(provider, None)
+                print(f"[WorkflowTranslator] Блокировка провайдера '{provider}' истекла, пробуем снова.")
     
     # Конфигурация моделей импортируется из workflow_model_config
 
@@ -423,7 +555,8 @@ class WorkflowTranslator:
             if section_id:
                 # Для секций - только обновляем модель, не меняя статус
                 print(f"[WorkflowTranslator] Сохраняем реальную модель в БД: {model_name} для секции {section_id}, этап {operation_type}")
-                # Получаем текущий статус
+                # Получаем текущий статус (с учетом отложенных записей — иначе перезапишем его устаревшим)
+                workflow_db_manager.flush_pending_status_writes()
                 section_info = workflow_db_manager.get_section_by_id_workflow(book_id, section_id)
                 if section_info and 'stage_statuses' in section_info and operation_type in section_info['stage_statuses']:
                     current_status = section_info['stage_statuses'][operation_type].get('status', 'completed')
@@ -628,6 +761,18 @@ class WorkflowTranslator:
         
         return text
 
+    def _glossary_for_chunk(self, dict_data, chunk_text: str, book_id: Optional[str]):
+        """
+        Глоссарий для промпта чанка: из таблиц анализа ('glossary_data') остаются только записи,
+        встречающиеся в чанке. Прочие dict_data передаются как есть.
+        """
+        if not dict_data:
+            return None
+        glossary_text = dict_data.get('glossary_data') if isinstance(dict_data, dict) else None
+        if not isinstance(glossary_text, str):
+            return dict_data
+        return glossary_index.prune_glossary_for_text(glossary_text, chunk_text, book_id)
+
     def _build_messages_for_operation(
         self,
         operation_type: str,
@@ -636,7 +781,8 @@ class WorkflowTranslator:
         model_name: str | None = None,
         prompt_ext: Optional[str] = None,
         dict_data: dict | None = None,
-        previous_context: Optional[str] = None
+        previous_context: Optional[str] = None,
+        book_id: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         messages = []
 
@@ -663,7 +809,8 @@ class WorkflowTranslator:
                 formatted_vars['russian_formatting_rule'] = ""
                 formatted_vars['translator_notes_heading'] = 'Translator Notes'
 
-            formatted_vars['translation_guidelines_section'] = f"You MUST use the following glossary for ALL listed terms and names:\n\n{dict_data}" if dict_data else ''
+            glossary = self._glossary_for_chunk(dict_data, cleaned_text, book_id)
+            formatted_vars['translation_guidelines_section'] = f"You MUST use the following glossary for ALL listed terms and names:\n\n{glossary}" if glossary else ''
             formatted_vars['previous_context_section'] = f"Previous context (for continuity):\n{cleaned_previous_context}" if cleaned_previous_context else ""
 
             system_content = SYSTEM_PROMPT_TEMPLATES['translate']['system'].format(**formatted_vars)
@@ -705,27 +852,183 @@ class WorkflowTranslator:
 
         return messages
 
+    def _visible_completion_tokens(self, usage: dict) -> Optional[int]:
+        """completion_tokens без reasoning-токенов (их нет в тексте ответа)."""
+        completion_tokens = usage.get('completion_tokens')
+        reasoning_tokens = (usage.get('completion_tokens_details') or {}).get('reasoning_tokens') or 0
+        if not completion_tokens or completion_tokens <= reasoning_tokens:
+            return None
+        return completion_tokens - reasoning_tokens
+
+    def _observe_token_usage(self, model_name: str, prompt_text: str, prompt_tokens: Optional[int], output_text: Optional[str],
+                             completion_tokens: Optional[int], operation_type: str, source_text: Optional[str]):
+        """Калибрует оценку токенов по usage ответа. Ошибки калибровки на результат вызова не влияют."""
+        try:
+            token_estimator.token_estimator.observe_usage(
+                model_name, prompt_text, prompt_tokens, output_text, completion_tokens, operation_type, source_text
+            )
+        except Exception as e:
+            print(f"[WorkflowTranslator] Ошибка калибровки оценки токенов: {e}")
+
+    def _observe_gemini_usage(self, model_name: str, response, prompt_text: str, output_text: str, operation_type: str, source_text: Optional[str]):
+        """Калибровка по usage_metadata ответа Google/Vertex (если есть)."""
+        usage_metadata = getattr(response, 'usage_metadata', None)
+        if usage_metadata is None:
+            return
+        self._observe_token_usage(
+            model_name, prompt_text, getattr(usage_metadata, 'prompt_token_count', None), output_text,
+            getattr(usage_metadata, 'candidates_token_count', None), operation_type, source_text
+        )
+
     def _determine_api_type(self, model_name: str) -> str:
         """
-        Определяет тип API на основе имени модели.
-        vertex/ -> vertex
-        models/ -> google
-        literouter/ -> literouter
-        Все остальное -> openrouter
+        Определяет тип API на основе имени модели (см. determine_api_type).
         """
-        if not model_name:
-            return "openrouter"
-            
-        if model_name.startswith('vertex/'):
-            return "vertex"
-        elif model_name.startswith('models/'):
-            return "google"
-        elif model_name.startswith('literouter/'):
-            return "literouter"
-        else:
-            # Все модели без спец-префиксов (включая deepseek/, openrouter/, nvidia/ и т.д.) 
-            # считаются идущими через OpenRouter
-            return "openrouter"
+        return determine_api_type(model_name)
+
+    def _read_sse_completion(self, response) -> Dict[str, Any]:
+        """
+        Читает потоковый ответ OpenAI-совместимого API (SSE) и собирает его в формат обычного ответа
+        ({'model', 'usage', 'choices': [{'message': {'content'}, 'finish_reason'}]}).
+        Watchdog: без новых токенов дольше STREAM_STALL_SECONDS (до первого — STREAM_FIRST_TOKEN_SECONDS)
+        бросает StreamStallError. Проверку делает отдельный поток, закрывающий соединение: keep-alive
+        комментарии и тишина в сокете не дают проверить это между строками.
+        Поток, закончившийся без [DONE] и без finish_reason, считается оборванным (StreamStallError).
+        """
+        content_parts = []
+        content_len = 0
+        finish_reason = None
+        done_seen = False
+        usage = None
+        model = None
+        started = time.time()
+        state = {'last_token_at': None, 'stalled': None}
+        finished = threading.Event()
+
+        def watchdog():
+            while not finished.wait(STREAM_WATCHDOG_INTERVAL):
+                last_token_at = state['last_token_at']
+                now = time.time()
+                if last_token_at is None and now - started > STREAM_FIRST_TOKEN_SECONDS:
+                    state['stalled'] = f"нет первого токена {STREAM_FIRST_TOKEN_SECONDS}с"
+                elif last_token_at is not None and now - last_token_at > STREAM_STALL_SECONDS:
+                    state['stalled'] = f"нет новых токенов {STREAM_STALL_SECONDS}с"
+                if state['stalled']:
+                    # Закрытие прерывает блокирующее чтение в iter_lines
+                    response.close()
+                    return
+
+        threading.Thread(target=watchdog, daemon=True, name="sse-watchdog").start()
+        try:
+            for raw_line in response.iter_lines():
+                if state['stalled']:
+                    break
+                if not raw_line:
+                    continue
+                line = raw_line.decode('utf-8', errors='replace')
+                if line.startswith(':') or not line.startswith('data:'):
+                    continue # комментарии keep-alive (": OPENROUTER PROCESSING") и прочие поля SSE
+                payload = line[5:].strip()
+                if payload == '[DONE]':
+                    done_seen = True
+                    break
+                event = json.loads(payload)
+                if event.get('error'):
+                    raise StreamStallError(f"ошибка в потоке: {event['error']}")
+                model = event.get('model') or model
+                if event.get('usage'):
+                    usage = event['usage']
+                for choice in event.get('choices') or []:
+                    delta_text = (choice.get('delta') or {}).get('content')
+                    if delta_text:
+                        content_parts.append(delta_text)
+                        content_len += len(delta_text)
+                        state['last_token_at'] = time.time()
+                    if choice.get('finish_reason'):
+                        finish_reason = choice['finish_reason']
+        except StreamStallError:
+            raise
+        except Exception as e:
+            # read-таймаут внутри iter_lines приходит как ConnectionError; после закрытия watchdog-ом — любая ошибка чтения
+            if state['stalled']:
+                raise StreamStallError(state['stalled'])
+            if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                raise StreamStallError(f"соединение оборвалось/замолчало: {e}")
+            raise
+        finally:
+            finished.set()
+        if state['stalled']:
+            raise StreamStallError(state['stalled'])
+        if not done_seen and finish_reason is None:
+            # Ни [DONE], ни finish_reason: соединение закрылось посреди ответа, текст может быть обрезан
+            raise StreamStallError(f"поток закончился без [DONE] и finish_reason после {content_len} символов")
+
+        print(f"[WorkflowTranslator] Поток завершен за {time.time() - started:.1f}с, получено {content_len} символов (finish_reason={finish_reason})")
+        result = {'choices': [{'message': {'content': ''.join(content_parts)}, 'finish_reason': finish_reason}]}
+        if model:
+            result['model'] = model
+        if usage:
+            result['usage'] = usage
+        return result
+
+    def _generate_vertex_streaming(self, model, prompt, safety_settings):
+        """
+        Потоковый вызов Vertex AI с watchdog. Чтение потока идет в отдельном потоке, чтобы зависший
+        gRPC-стрим не блокировал обработку дольше STREAM_STALL_SECONDS.
+        Возвращает (текст, последний_кандидат) или бросает StreamStallError.
+        """
+        events = queue.Queue()
+
+        def reader():
+            try:
+                for chunk in model.generate_content(prompt, safety_settings=safety_settings, stream=True):
+                    events.put(('chunk', chunk))
+                events.put(('done', None))
+            except Exception as e:
+                events.put(('error', e))
+
+        threading.Thread(target=reader, daemon=True, name="vertex-stream").start()
+
+        text_parts = []
+        last_candidate = None
+        got_token = False
+        while True:
+            try:
+                kind, payload = events.get(timeout=STREAM_STALL_SECONDS if got_token else STREAM_FIRST_TOKEN_SECONDS)
+            except queue.Empty:
+                raise StreamStallError("Vertex AI перестал присылать токены")
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise payload
+            if payload.candidates:
+                last_candidate = payload.candidates[0]
+                if self._vertex_candidate_blocked(last_candidate):
+                    return SAFETY_FILTER_ERROR, last_candidate
+                try:
+                    piece = payload.text
+                except Exception:
+                    piece = ""
+                if piece:
+                    text_parts.append(piece)
+                    got_token = True
+        return ''.join(text_parts), last_candidate
+
+    def _vertex_candidate_blocked(self, candidate) -> bool:
+        """Проверка кандидата Vertex AI на срабатывание фильтров безопасности."""
+        if candidate.finish_reason == FinishReason.SAFETY:
+            print(f"[WorkflowTranslator] SAFETY: Vertex AI заблокировал контент (finish_reason=SAFETY). НЕ ретраим.")
+            return True
+        if candidate.finish_reason == FinishReason.BLOCKLIST:
+            print(f"[WorkflowTranslator] SAFETY: Vertex AI заблокировал контент (finish_reason=BLOCKLIST). НЕ ретраим.")
+            return True
+        # Проверяем safety_ratings на высокий уровень блокировки
+        if candidate.safety_ratings:
+            for rating in candidate.safety_ratings:
+                if rating.probability >= HarmBlockThreshold.HARM_BLOCK_THRESHOLD_UNSPECIFIED:
+                    print(f"[WorkflowTranslator] SAFETY: Vertex AI safety rating высокий для категории {rating.category}. НЕ ретраим.")
+                    return True
+        return False
 
     def _call_model_api(
         self,
@@ -749,7 +1052,7 @@ class WorkflowTranslator:
             messages: Список сообщений в формате [{"role": "...", "content": "..."}, ...].
             temperature: Параметр temperature для API вызова.
             max_retries: Максимальное количество попыток вызова при ошибках.
-            retry_delay_seconds: Начальная задержка между попытками.
+            retry_delay_seconds: Начальная задержка между повторными попытками (удваивается); темп запросов задает provider_rate_limiter.
 
         Returns:
             Кортеж (текст ответа модели или специальные константы ошибок/None, имя реально использованной модели).
@@ -786,36 +1089,43 @@ class WorkflowTranslator:
                     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
                 }
                 
-                response = model.generate_content(prompt, safety_settings=safety_settings)
-                
-                # --- ДЕТЕКТОР SAFETY (Vertex AI) ---
-                if response.candidates and len(response.candidates) > 0:
-                    candidate = response.candidates[0]
-                    if candidate.finish_reason == FinishReason.SAFETY:
-                        print(f"[WorkflowTranslator] SAFETY: Vertex AI заблокировал контент (finish_reason=SAFETY). НЕ ретраим.")
-                        return SAFETY_FILTER_ERROR, model_name
-                    if candidate.finish_reason == FinishReason.BLOCKLIST:
-                        print(f"[WorkflowTranslator] SAFETY: Vertex AI заблокировал контент (finish_reason=BLOCKLIST). НЕ ретраим.")
+                provider_rate_limiter.rate_limiter.acquire(api_type, model_name)
+                if STREAMING_ENABLED:
+                    try:
+                        response_text, _ = self._generate_vertex_streaming(model, prompt, safety_settings)
+                    except StreamStallError as e:
+                        print(f"[WorkflowTranslator] Потоковый ответ Vertex AI прерван: {e}. Переходим к fallback.")
+                        provider_rate_limiter.rate_limiter.record(api_type, model_name, None)
+                        return None, model_name
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, 200)
+                    if response_text == SAFETY_FILTER_ERROR:
                         return SAFETY_FILTER_ERROR, model_name
-                    # Проверяем safety_ratings на высокий уровень блокировки
-                    if candidate.safety_ratings:
-                        for rating in candidate.safety_ratings:
-                            if rating.probability >= HarmBlockThreshold.HARM_BLOCK_THRESHOLD_UNSPECIFIED:
-                                print(f"[WorkflowTranslator] SAFETY: Vertex AI safety rating высокий для категории {rating.category}. НЕ ретраим.")
-                                return SAFETY_FILTER_ERROR, model_name
-                # --- КОНЕЦ ДЕТЕКТОРА SAFETY ---
+                else:
+                    response = model.generate_content(prompt, safety_settings=safety_settings)
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, 200)
+                    
+                    # --- ДЕТЕКТОР SAFETY (Vertex AI) ---
+                    if response.candidates and len(response.candidates) > 0:
+                        if self._vertex_candidate_blocked(response.candidates[0]):
+                            return SAFETY_FILTER_ERROR, model_name
+                    # --- КОНЕЦ ДЕТЕКТОРА SAFETY ---
+                    response_text = response.text
+                    if response_text:
+                        self._observe_gemini_usage(model_name, response, prompt, response_text, operation_type, chunk_text)
                 
-                if not response.text:
+                if not response_text:
                     print("[WorkflowTranslator] Vertex AI вернул пустой ответ.")
                     return None, model_name
                 
                 print(f"[WorkflowTranslator] Vertex AI ответ получен успешно.")
                 # Удаляем служебный маркер $$$$$ (допускаем от 3 до 10) строго в конце
-                return re.sub(r'\${3,10}$', '', response.text).strip(), model_name
+                return re.sub(r'\${3,10}$', '', response_text).strip(), model_name
 
             except Exception as e:
                 print(f"[WorkflowTranslator] ОШИБКА при вызове Vertex AI: {e}")
                 error_str = str(e).lower()
+                if '429' in error_str or 'resource_exhausted' in error_str or 'resource exhausted' in error_str:
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, 429)
                 if "context window" in error_str:
                     return CONTEXT_LIMIT_ERROR, model_name
                 return None, model_name
@@ -845,7 +1155,9 @@ class WorkflowTranslator:
                     'HARM_CATEGORY_DANGEROUS_CONTENT': 'block_none'
                 }
                 
+                provider_rate_limiter.rate_limiter.acquire(api_type, model_name)
                 response = model.generate_content(prompt, safety_settings=safety_settings)
+                provider_rate_limiter.rate_limiter.record(api_type, model_name, 200)
                 
                 # --- ДЕТЕКТОР SAFETY (Google API) ---
                 if response.candidates and len(response.candidates) > 0:
@@ -862,11 +1174,14 @@ class WorkflowTranslator:
                     return None, model_name
                 
                 print(f"[WorkflowTranslator] Google API ответ получен успешно.")
+                self._observe_gemini_usage(model_name, response, prompt, response.text, operation_type, chunk_text)
                 # Удаляем служебный маркер $$$$$ (допускаем от 3 до 10) строго в конце
                 return re.sub(r'\${3,10}$', '', response.text).strip(), model_name
 
             except Exception as e:
                 print(f"[WorkflowTranslator] ОШИБКА при вызове Google API: {e}")
+                if '429' in str(e) or 'resource_exhausted' in str(e).lower():
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, 429)
                 if "context window" in str(e).lower():
                     return CONTEXT_LIMIT_ERROR, model_name
                 
@@ -929,14 +1244,13 @@ class WorkflowTranslator:
             if messages and isinstance(messages, list):
                 for message in messages:
                     prompt_text += message.get('content', '')
-            input_prompt_tokens = len(prompt_text) // 3
+            input_prompt_tokens = token_estimator.token_estimator.estimate_tokens(model_name, prompt_text)
             
             if not model_declared_output_limit:
                 model_declared_output_limit = model_total_context_limit // 2
                 print(f"[WorkflowTranslator] max_completion_tokens не указан, используем половину контекста: {model_declared_output_limit}")
             
             calculated_max_output_tokens = model_total_context_limit - input_prompt_tokens - 100
-            MAX_COMPLETION_TOKENS = 65536
             final_output_token_limit = min(model_declared_output_limit, calculated_max_output_tokens, MAX_COMPLETION_TOKENS)
             print(f"[WorkflowTranslator] Рассчитанный output_token_limit для {api_type}: {final_output_token_limit} (Общий контекст: {model_total_context_limit}, Входной промпт: ~{input_prompt_tokens} токенов)")
 
@@ -948,33 +1262,51 @@ class WorkflowTranslator:
                 "model": actual_model_name,
                 "messages": messages,
                 "temperature": 0.7,
-                "stream": False
+                "stream": STREAMING_ENABLED
             }
+            if STREAMING_ENABLED:
+                # Usage приходит последним событием потока только по запросу
+                data["stream_options"] = {"include_usage": True}
 
             if operation_type == 'translate':
-                data["max_tokens"] = max(1000, final_output_token_limit - 5000)
+                data["max_tokens"] = max(1000, final_output_token_limit - TRANSLATE_MAX_TOKENS_MARGIN)
 
             current_delay = retry_delay_seconds
             for attempt in range(max_retries):
                 try:
-                    # --- Добавлена принудительная задержка для LiteRouter ПЕРЕД КАЖДОЙ ПОПЫТКОЙ ---
-                    if api_type == "literouter":
-                        print(f"[LiteRouter] Cooldown 5 секунд (попытка {attempt + 1})...")
-                        time.sleep(5)
+                    # Темп запросов задает адаптивный лимитер (учитывает 429/5xx и Retry-After)
+                    provider_rate_limiter.rate_limiter.acquire(api_type, model_name)
 
                     print(f"{log_prefix} Отправка запроса на API (попытка {attempt + 1}/{max_retries}). URL: {url}")
-                    response = requests.post(url, headers=headers, data=json.dumps(data, ensure_ascii=False), timeout=600)
+                    if STREAMING_ENABLED:
+                        # read-таймаут — страховка сокета; тишину между токенами контролирует watchdog в _read_sse_completion
+                        response = http_client.post(url, headers=headers, data=json.dumps(data, ensure_ascii=False),
+                                                    timeout=(15, max(STREAM_STALL_SECONDS, STREAM_FIRST_TOKEN_SECONDS)), stream=True)
+                    else:
+                        response = http_client.post(url, headers=headers, data=json.dumps(data, ensure_ascii=False), timeout=600)
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, response.status_code, response.headers)
                     
                     # --- ВРЕМЕННЫЙ ЛОГ ДЛЯ ДИАГНОСТИКИ (ОШИБКА 522 И 0 ТОКЕНОВ) ---
                     if api_type == "literouter":
                         print(f"[LiteRouter RAW] Статус: {response.status_code}")
-                        print(f"[LiteRouter RAW] Ответ: {response.text[:1000]}...") # Логируем первые 1000 символов
+                        if not (STREAMING_ENABLED and response.status_code == 200):
+                            print(f"[LiteRouter RAW] Ответ: {response.text[:1000]}...") # Логируем первые 1000 символов
                     # --- КОНЕЦ ВРЕМЕННОГО ЛОГА ---
 
                     if response.status_code == 200:
-                        response_json = response.json()
-                        if 'usage' in response_json:
-                            usage = response_json['usage']
+                        if STREAMING_ENABLED:
+                            try:
+                                response_json = self._read_sse_completion(response)
+                            except StreamStallError as e:
+                                print(f"{log_prefix} Потоковый ответ прерван: {e}. Переходим к fallback.")
+                                provider_rate_limiter.rate_limiter.record(api_type, model_name, None)
+                                return None, model_name
+                            finally:
+                                response.close()
+                        else:
+                            response_json = response.json()
+                        usage = response_json.get('usage') or {}
+                        if usage:
                             print(f"{log_prefix} Использование токенов: prompt={usage.get('prompt_tokens', 'N/A')}, completion={usage.get('completion_tokens', 'N/A')}, total={usage.get('total_tokens', 'N/A')}")
                         if 'model' in response_json:
                             actual_model = response_json['model']
@@ -984,6 +1316,10 @@ class WorkflowTranslator:
                             choice = response_json['choices'][0]
                             if 'message' in choice and choice['message'].get('content') is not None:
                                 output_content = choice['message']['content'].strip()
+                                self._observe_token_usage(
+                                    model_name, prompt_text, usage.get('prompt_tokens'), output_content,
+                                    self._visible_completion_tokens(usage), operation_type, chunk_text
+                                )
                                 if chunk_text and section_id:
                                     self._save_translation_debug(section_id, model_name, output_content, chunk_text, book_id)
                                 
@@ -1013,7 +1349,7 @@ class WorkflowTranslator:
                                 # --- ДЕТЕКТОР ОШИБКИ КОНФИГУРАЦИИ LiteRouter ---
                                 if "Context Multiplier Configuration Required" in output_content:
                                     print(f"[LiteRouter] КРИТИЧЕСКАЯ ОШИБКА НАСТРОЙКИ: Требуется увеличить Multipliers в дашборде LiteRouter!")
-                                    WorkflowTranslator.DISABLED_PROVIDERS.add('literouter')
+                                    WorkflowTranslator._disable_provider('literouter')
                                     return "__LITEROUTER_CONFIG_REQUIRED__", model_name
                                 # --- КОНЕЦ ДЕТЕКТОРА ---
 
@@ -1066,7 +1402,7 @@ class WorkflowTranslator:
                             # Никогда не блокируем OpenRouter, так как это база. 
                             # Другие провайдеры (LiteRouter, Vertex, Google) блокируются при исчерпании лимитов.
                             if api_type != 'openrouter':
-                                WorkflowTranslator.DISABLED_PROVIDERS.add(api_type)
+                                WorkflowTranslator._disable_provider(api_type)
                                 
                             # При лимите не имеет смысла делать ретраи внутри одного вызова
                             return None, model_name
@@ -1096,6 +1432,7 @@ class WorkflowTranslator:
                             print(f"{log_prefix} Ошибка при разборе деталей ошибки: {e}")
                         return None, model_name
                 except requests.exceptions.Timeout:
+                    provider_rate_limiter.rate_limiter.record(api_type, model_name, None)
                     if attempt < max_retries - 1:
                          time.sleep(current_delay)
                          current_delay *= 2
@@ -1144,7 +1481,7 @@ class WorkflowTranslator:
                 return None, model_name
 
         # Определяем лимит чанка для ЭТОЙ модели
-        chunk_limit = self._get_chunk_limit_for_operation(operation_type, model_name)
+        chunk_limit = self._get_chunk_limit_for_operation(operation_type, model_name, text_to_process)
         
         # Разбиваем текст на чанки по лимиту ЭТОЙ модели
         if operation_type == 'analyze':
@@ -1157,14 +1494,31 @@ class WorkflowTranslator:
         
         print(f"[WorkflowTranslator] Текст разбит на {len(chunks)} чанков для {operation_type}")
         
-        # Переводим каждый чанк
-        results = []
-        last_used_model = model_name
-        for i, chunk in enumerate(chunks):
-            print(f"[WorkflowTranslator] {operation_type.capitalize()} чанка {i+1}/{len(chunks)} (длина: {len(chunk)} символов)")
-            
+        # Чекпоинты чанков: уже готовые чанки (в т.ч. от предыдущей модели/запуска) не переводим повторно
+        checkpoint_section_key = section_id if section_id is not None else 'book'
+        checkpoint_context_key = self._request_fingerprint(operation_type, target_language, prompt_ext, dict_data)
+        use_checkpoints = bool(book_id) and len(chunks) > 1
+
+        results = [None] * len(chunks)
+        chunk_models = [model_name] * len(chunks)
+        chunk_hashes = [hashlib.sha1(chunk.encode('utf-8')).hexdigest()[:20] for chunk in chunks]
+        missing_indexes = []
+        for i in range(len(chunks)):
+            if use_checkpoints:
+                checkpoint = workflow_cache_manager.load_chunk_checkpoint(book_id, checkpoint_section_key, checkpoint_context_key, chunk_hashes[i])
+                if checkpoint and checkpoint[0]:
+                    print(f"[WorkflowTranslator] Чанк {i+1}/{len(chunks)} взят из чекпоинта (модель: {checkpoint[1]})")
+                    results[i] = checkpoint[0]
+                    chunk_models[i] = checkpoint[1] or model_name
+                    continue
+            missing_indexes.append(i)
+
+        cancel_event = threading.Event()
+
+        def process_chunk(i):
+            print(f"[WorkflowTranslator] {operation_type.capitalize()} чанка {i+1}/{len(chunks)} (длина: {len(chunks[i])} символов)")
             result, actual_model = self._translate_chunk(
-                chunk,
+                chunks[i],
                 target_language,
                 model_name,
                 operation_type,
@@ -1172,11 +1526,16 @@ class WorkflowTranslator:
                 dict_data,
                 section_id,
                 book_id,
-                admin=admin
+                admin=admin,
+                cancel_event=cancel_event if parallelism > 1 else None
             )
-            
-            last_used_model = actual_model
-            
+            if result and result != SAFETY_FILTER_ERROR and use_checkpoints:
+                workflow_cache_manager.save_chunk_checkpoint(book_id, checkpoint_section_key, checkpoint_context_key, chunk_hashes[i], actual_model, result)
+            return result, actual_model
+
+        def check_chunk_result(i, result, actual_model):
+            """None — чанк готов; иначе результат, которым надо завершить сегмент."""
+            chunk_models[i] = actual_model
             # --- ПРЕРЫВАНИЕ ПРИ SAFETY ---
             # Если контент заблокирован — не пытаться переводить другие чанки.
             # Весь текст в этой секции — порнуха, нет смысла продолжать.
@@ -1184,18 +1543,70 @@ class WorkflowTranslator:
                 print(f"[WorkflowTranslator] SAFETY: Контент заблокирован на чанке {i+1}. Прерываем обработку сегмента.")
                 return SAFETY_FILTER_ERROR, actual_model
             # --- КОНЕЦ ПРЕРЫВАНИЯ ---
-            
             if not result:
                 print(f"[WorkflowTranslator] Ошибка перевода чанка {i+1}")
                 return None, actual_model
-            
-            results.append(result)
-        
+            results[i] = result
+            return None
+
+        parallelism = self._get_chunk_parallelism(operation_type, model_name, len(missing_indexes))
+        if parallelism > 1:
+            # Параллельный режим: независимые чанки уходят одновременно (под семафором провайдера),
+            # результат собирается в исходном порядке.
+            print(f"[WorkflowTranslator] Параллельная обработка {len(missing_indexes)} чанков (до {parallelism} одновременно)")
+            executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="chunk")
+            try:
+                futures = {executor.submit(process_chunk, i): i for i in missing_indexes}
+                pending = set(futures.keys())
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        i = futures[future]
+                        try:
+                            result, actual_model = future.result()
+                        except Exception as e:
+                            print(f"[WorkflowTranslator] Исключение при обработке чанка {i+1}: {e}")
+                            traceback.print_exc()
+                            result, actual_model = None, model_name
+                        failure = check_chunk_result(i, result, actual_model)
+                        if failure is not None:
+                            # Отменяем еще не начатые и сигналим уже идущим соседним чанкам
+                            cancel_event.set()
+                            for other in pending:
+                                other.cancel()
+                            return failure
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for i in missing_indexes:
+                result, actual_model = process_chunk(i)
+                failure = check_chunk_result(i, result, actual_model)
+                if failure is not None:
+                    return failure
+
+        last_used_model = chunk_models[-1]
+
+        # Сегмент готов целиком — чекпоинты больше не нужны
+        if use_checkpoints:
+            workflow_cache_manager.delete_chunk_checkpoints(book_id, checkpoint_section_key, checkpoint_context_key)
+
         # Объединяем результаты
         full_result = "\n\n".join(results)
         print(f"[WorkflowTranslator] {operation_type.capitalize()} завершена. Общая длина: {len(full_result)} символов")
         return full_result, last_used_model
 
+    def _get_chunk_parallelism(self, operation_type: str, model_name: str, chunks_count: int) -> int:
+        """Сколько чанков сегмента обрабатывать одновременно (1 — последовательно)."""
+        if not PARALLEL_CHUNKS_ENABLED or operation_type not in PARALLEL_CHUNK_OPERATIONS or chunks_count < 2:
+            return 1
+        provider = self._determine_api_type(model_name)
+        return max(1, min(PARALLEL_CHUNKS_MAX_WORKERS, CHUNK_PROVIDER_CONCURRENCY_LIMITS.get(provider, 1), chunks_count))
+
+    def _request_fingerprint(self, operation_type: str, target_language: str, prompt_ext: Optional[str], dict_data) -> str:
+        """Хэш параметров запроса, влияющих на результат чанка (операция, язык, промпт, глоссарий)."""
+        context = json.dumps([operation_type, target_language, prompt_ext or "", dict_data], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(context.encode('utf-8')).hexdigest()[:12]
+
     def _translate_chunk(
         self,
         chunk: str,
@@ -1206,26 +1617,80 @@ class WorkflowTranslator:
         dict_data: dict | None = None,
         section_id: int = None,
         book_id: str = None,
-        admin: bool = False
+        admin: bool = False,
+        cancel_event: Optional[threading.Event] = None
     ) -> tuple[str | None, str]:
         """
-        Ф2 - Перевод чанка: просто вызывает API с ретраями.
+        Ф2 - Перевод чанка: сначала ищет результат в памяти переводов, затем вызывает API с ретраями.
+        cancel_event: если выставлен (соседний чанк упал/SAFETY), новые попытки не делаются.
         """
+        memory_key = None
+        if TRANSLATION_MEMORY_ENABLED:
+            import workflow_db_manager
+            chunk_hash = hashlib.sha256(_normalize_for_memory(chunk).encode('utf-8')).hexdigest()
+            memory_key = f"{chunk_hash}:{self._request_fingerprint(operation_type, target_language, prompt_ext, dict_data)}"
+            remembered = None
+            if not workflow_cache_manager.is_translation_memory_bypassed(book_id, section_id):
+                remembered = workflow_db_manager.get_translation_memory(memory_key)
+            with _translation_memory_lock:
+                _translation_memory_stats['hits' if remembered else 'misses'] += 1
+            if remembered:
+                print(f"[WorkflowTranslator] Чанк {operation_type} найден в памяти переводов (модель: {remembered[1]})")
+                return remembered[0], remembered[1] or model_name
+
+        result, actual_model = self._translate_chunk_with_model(
+            chunk, target_language, model_name, operation_type, prompt_ext, dict_data,
+            section_id, book_id, admin, cancel_event
+        )
+
+        if memory_key and result and result not in _TRANSLATION_MEMORY_REJECT:
+            import workflow_db_manager
+            if workflow_db_manager.save_translation_memory(memory_key, operation_type, target_language, result, actual_model):
+                with _translation_memory_lock:
+                    _translation_memory_stats['writes'] += 1
+                    need_evict = _translation_memory_stats['writes'] % TRANSLATION_MEMORY_EVICT_EVERY == 0
+                if need_evict:
+                    workflow_db_manager.evict_translation_memory(TRANSLATION_MEMORY_MAX_MB * 1024 * 1024)
+        return result, actual_model
+
+    def _translate_chunk_with_model(
+        self,
+        chunk: str,
+        target_language: str,
+        model_name: str,
+        operation_type: str,
+        prompt_ext: Optional[str],
+        dict_data,
+        section_id: int,
+        book_id: str,
+        admin: bool,
+        cancel_event: Optional[threading.Event]
+    ) -> tuple[str | None, str]:
+        """Вызов API для чанка с ретраями (без памяти переводов)."""
         messages = self._build_messages_for_operation(
             operation_type,
             chunk,
             target_language,
             model_name=model_name,
             prompt_ext=prompt_ext,
-            dict_data=dict_data
+            dict_data=dict_data,
+            book_id=book_id
         )
         
         # Пытаемся обработать чанк с ретраями
         max_retries = 2
         last_used_model = model_name
         for attempt in range(max_retries + 1):
+            if cancel_event is not None and cancel_event.is_set():
+                print(f"[WorkflowTranslator] Чанк {operation_type}: обработка сегмента отменена, пропускаем.")
+                return None, last_used_model
             print(f"[WorkflowTranslator] Чанк {operation_type}: попытка {attempt+1}/{max_retries+1}, модель {model_name}, длина {len(chunk)} символов")
-            result, actual_model = self._call_model_api(model_name, messages, operation_type=operation_type, chunk_text=chunk, section_id=section_id, book_id=book_id, admin=admin)
+            if cancel_event is not None:
+                # Параллельный режим: ограничиваем число одновременных запросов к провайдеру
+                with get_chunk_provider_semaphore(self._determine_api_type(model_name)):
+                    result, actual_model = self._call_model_api(model_name, messages, operation_type=operation_type, chunk_text=chunk, section_id=section_id, book_id=book_id, admin=admin)
+            else:
+                result, actual_model = self._call_model_api(model_name, messages, operation_type=operation_type, chunk_text=chunk, section_id=section_id, book_id=book_id, admin=admin)
             last_used_model = actual_model
             
             # --- ПРОВЕРКА НА SAFETY FILTER ---
@@ -1257,22 +1722,34 @@ class WorkflowTranslator:
         
         return None, last_used_model
 
-    def _get_chunk_limit_for_operation(self, operation_type: str, model_name: str) -> int:
+    def _get_chunk_limit_for_operation(self, operation_type: str, model_name: str, text: Optional[str] = None) -> int:
         """
-        Возвращает лимит чанка для данной операции и модели
+        Возвращает лимит чанка (в символах) для данной операции, модели и текста.
+
+        Бюджет считается в токенах: промпт (шаблон + запас) + чанк + ожидаемый ответ должны поместиться
+        в контекст модели, а ответ — в лимит вывода. Ожидаемый ответ = токены чанка * отношение ответ/исходник
+        для операции. Токены переводятся в символы по оценке token_estimator для этого текста
+        (кириллица и CJK дают больше токенов на символ, чем латиница).
         """
-        from translation_module import get_context_length
-        
+        from translation_module import get_context_length, get_model_output_token_limit
+        estimator = token_estimator.token_estimator
+
         context_token_limit = get_context_length(model_name) if model_name else 2048
-        context_chars_limit = context_token_limit * 3
-        chunk_limit = context_chars_limit - 4000  # Буфер для промпта и ответа
-        
-        if chunk_limit <= 0:
-            chunk_limit = context_chars_limit // 2
-        
-        if chunk_limit <= 0:
-            print(f"[WorkflowTranslator] Предупреждение: context_chars_limit = {context_chars_limit}, используем дефолтное значение")
-            chunk_limit = 30000
+        output_token_limit = min(get_model_output_token_limit(model_name) or context_token_limit // 2, MAX_COMPLETION_TOKENS)
+        if operation_type == 'translate' and self._determine_api_type(model_name) in ('openrouter', 'literouter'):
+            # Так же, как max_tokens в _call_model_api
+            output_token_limit = max(1000, output_token_limit - TRANSLATE_MAX_TOKENS_MARGIN)
+
+        templates = SYSTEM_PROMPT_TEMPLATES.get(operation_type, {}).get('system', '') + USER_PROMPT_TEMPLATES.get(operation_type, {}).get('user', '')
+        prompt_tokens = estimator.estimate_tokens(model_name, templates) + PROMPT_RESERVE_TOKENS
+        output_ratio = estimator.output_ratio(model_name, operation_type)
+
+        chunk_tokens = min(
+            (context_token_limit - prompt_tokens) / (1 + output_ratio),
+            output_token_limit / output_ratio
+        ) * CHUNK_BUDGET_FILL
+        chars_per_token = estimator.chars_per_token(model_name, text) if text else 3.0
+        chunk_limit = max(MIN_CHUNK_SIZE_CHARS, int(chunk_tokens * chars_per_token))
         
         # Применяем ограничения в зависимости от операции
         if operation_type in ['analyze', 'summarize']:
@@ -1280,7 +1757,8 @@ class WorkflowTranslator:
         else:
             chunk_limit = min(chunk_limit, CHUNK_SIZE_LIMIT_CHARS)
         
-        print(f"[WorkflowTranslator] Лимит чанка для {operation_type}: {chunk_limit} символов (модель: {model_name})")
+        print(f"[WorkflowTranslator] Лимит чанка для {operation_type}: {chunk_limit} символов (модель: {model_name}, "
+              f"~{int(chunk_tokens)} токенов, {chars_per_token:.2f} симв/токен, ответ x{output_ratio})")
         return chunk_limit
 
     def translate_text(
@@ -1314,12 +1792,23 @@ class WorkflowTranslator:
 
         current_model = model_name
         fallback_attempt = 1
+        WorkflowTranslator._release_expired_providers()
+        breaker = model_circuit_breaker.circuit_breaker
+        # Локальный импорт: ниже в функции модуль импортируется локально, без него имя здесь не связано
+        import workflow_model_config
+        default_model_name = getattr(workflow_model_config, 'DEFAULT_MODEL', 'openrouter/free')
         
         while current_model:
-            # --- УМНЫЙ ПРОПУСК ЗАБЛОКИРОВАННЫХ ПРОВАЙДЕРОВ ---
+            # --- УМНЫЙ ПРОПУСК ЗАБЛОКИРОВАННЫХ ПРОВАЙДЕРОВ И МОДЕЛЕЙ С ОТКРЫТЫМ CIRCUIT BREAKER ---
+            # DEFAULT_MODEL — последняя попытка, ее breaker не пропускает
             provider = self._determine_api_type(current_model)
+            skip_reason = None
             if provider in WorkflowTranslator.DISABLED_PROVIDERS:
-                print(f"[WorkflowTranslator] Провайдер '{provider}' заблокирован. Пропускаем модель '{current_model}'.")
+                skip_reason = f"провайдер '{provider}' заблокирован"
+            elif current_model != default_model_name and not breaker.allow_request(current_model):
+                skip_reason = "circuit breaker открыт"
+            if skip_reason:
+                print(f"[WorkflowTranslator] Пропускаем модель '{current_model}': {skip_reason}.")
                 
                 # Ищем следующую модель
                 next_model = self._get_fallback_model(operation_type, current_model)
@@ -1336,7 +1825,7 @@ class WorkflowTranslator:
                          current_model = default_model
                          continue
                     else:
-                        print(f"[WorkflowTranslator] Нет доступных альтернатив для заблокированного провайдера '{provider}'.")
+                        print(f"[WorkflowTranslator] Нет доступных альтернатив для модели '{current_model}' ({skip_reason}).")
                         break
                 
                 current_model = next_model
@@ -1346,18 +1835,39 @@ class WorkflowTranslator:
             level_key = self._get_model_level_key(operation_type, current_model) or "?"
             print(f"[WorkflowTranslator] Операция '{operation_type}' (попытка #{fallback_attempt}, уровень {level_key}): {current_model}, текст {len(text_to_translate)} символов")
             fallback_attempt += 1
-            result, actual_model = self._translate_segment(
-                text_to_translate,
-                target_language,
-                current_model,
-                operation_type,
-                prompt_ext,
-                dict_data,
-                section_id,
-                book_id,
-                admin=admin
-            )
+            segment_started = time.time()
+            try:
+                result, actual_model = self._translate_segment(
+                    text_to_translate,
+                    target_language,
+                    current_model,
+                    operation_type,
+                    prompt_ext,
+                    dict_data,
+                    section_id,
+                    book_id,
+                    admin=admin
+                )
+            except BaseException:
+                # Исключение тоже считается отказом: иначе зарезервированная allow_request
+                # пробная попытка half-open так и осталась бы "в полете" и модель не вернулась бы
+                breaker.record_failure(current_model, time.time() - segment_started)
+                raise
             
+            # Учитываем результат в circuit breaker у модели, которая реально отвечала
+            # (_translate_segment сам уходит на fallback, если Vertex недоступен). SAFETY и CONTEXT_LIMIT —
+            # свойства текста, а не модели; прочие маркеры ошибок (пустой ответ, нет конфига) — отказ.
+            segment_latency = time.time() - segment_started
+            outcome_model = actual_model or current_model
+            if outcome_model != current_model:
+                breaker.release(current_model)
+            if result in (SAFETY_FILTER_ERROR, CONTEXT_LIMIT_ERROR):
+                breaker.release(outcome_model)
+            elif result and result not in _TRANSLATION_MEMORY_REJECT:
+                breaker.record_success(outcome_model, segment_latency)
+            else:
+                breaker.record_failure(outcome_model, segment_latency)
+
             # --- ПРЕРЫВАНИЕ ПРИ SAFETY (F3 уровень) ---
             # Пробуем censored-модель перед тем как сдаться
             if result == SAFETY_FILTER_ERROR: